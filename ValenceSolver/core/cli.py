@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+import argparse
+import collections
+import concurrent.futures
+import fileinput
+import json
+import os
+import sys
+import time
+
+from .composition_inhouse import CompositionInHouse
+from .formula import get_el_amt, get_integer_el_amt
+from .precomputed import get_composition_key
+from .results import COMMENT_CODES
+
+"""
+Command line solver of oxidation states for pipelines, installed as valence-solve.
+Each input line is a formula (Fe2O3), a json string ("Fe2O3"), a json dict of
+{el: amount}, or a json dict with the field 'composition' whose other fields are
+copied to the output. One json result is written to stdout per input line as soon
+as it is solved:
+
+    {"input": "Fe2O3", "oxi_state": {"Fe": 3.0, "O": -2.0}, "is_usual": true, "comments": []}
+
+    cat formulas.txt | valence-solve --workers 8 --cache valence_cache.json > valence.jsonl
+
+Only a bounded number of lines are in flight, so memory does not grow with the input.
+The cache is optional and off by default. With --cache, at most --cache-size compositions
+are kept, the least recently used ones are dropped. Statistics are printed to stderr at
+the end.
+"""
+
+__author__ = 'Tanjin He'
+__maintainer__ = 'Tanjin He'
+__email__ = 'tanjin_he@berkeley.edu'
+
+DEFAULT_CACHE_SIZE = 100000
+
+# stage of the relaxation reached by a solution, by the code of its comment in KNOWN_COMMENTS
+STAGES = {
+    COMMENT_CODES['is alloy']: 'is alloy',
+    COMMENT_CODES['all possible positive valence states are used for metals']: 'compensator',
+    COMMENT_CODES['Warning: the input composition might be wrong']: 'composition warning',
+    COMMENT_CODES[CompositionInHouse.TIME_BUDGET_WARNING]: 'time budget exceeded',
+}
+
+
+def parse_line(line):
+    """
+    :param line: str. one line of input
+    :return: (record, composition). record is the dict of the output before adding the
+        result, composition is a plain dict or a formula string
+    """
+    try:
+        obj = json.loads(line)
+    except ValueError:
+        obj = line
+    if isinstance(obj, dict) and 'composition' in obj:
+        return dict(obj), obj['composition']
+    return {'input': obj}, obj
+
+
+def get_cache_key(composition, all_oxi_states=False):
+    """
+    the result only depends on the integer formula, e.g. FeO1.5 and Fe2O3 share a key
+
+    :return: str or None if the composition cannot be interpreted
+    """
+    try:
+        el_amt = get_el_amt(composition)
+        if el_amt is None:
+            el_amt = CompositionInHouse(composition).get_el_amt_dict()
+        if len(el_amt) == 0:
+            return None
+        key = get_composition_key(get_integer_el_amt(el_amt)[0]).decode('ascii')
+    except Exception:
+        return None
+    if all_oxi_states:
+        key += ' all_oxi_states'
+    return key
+
+
+def solve(composition, all_oxi_states=False):
+    """
+    :return: (oxi_state, is_usual, comments, error). error is None or the message of
+        the exception raised by the solver
+    """
+    try:
+        oxi_state, is_usual, comments = CompositionInHouse.get_most_possible_oxi_state_of_composition(
+            composition,
+            all_oxi_states=all_oxi_states,
+        )
+    except Exception as e:
+        return [], False, [], '{}: {}'.format(type(e).__name__, e)
+    return oxi_state, is_usual, comments, None
+
+
+def get_stage(result):
+    oxi_state, is_usual, comments, error = result
+    if error:
+        return 'error'
+    if not oxi_state:
+        return 'no solution'
+    stages = [STAGES[COMMENT_CODES[c]] for c in comments if COMMENT_CODES.get(c) in STAGES]
+    return stages[-1] if stages else 'usual'
+
+
+def load_cache(path, cache_size=DEFAULT_CACHE_SIZE):
+    """
+    :return: collections.OrderedDict of {cache key: [oxi_state, is_usual, comments]}
+        with at most the last cache_size entries of the file
+    """
+    cache = collections.OrderedDict()
+    if path and os.path.exists(path):
+        with open(path, 'r') as fr:
+            cache.update(json.load(fr, object_pairs_hook=collections.OrderedDict))
+    while len(cache) > cache_size:
+        cache.popitem(last=False)
+    return cache
+
+
+def save_cache(cache, path):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as fw:
+        json.dump(cache, fw)
+    os.replace(tmp_path, path)
+
+
+def solve_lines(lines, output, workers=1, cache=None, all_oxi_states=False, ordered=True,
+                cache_size=DEFAULT_CACHE_SIZE):
+    """
+    solve compositions line by line and write json lines
+
+    :param lines: iterable of str
+    :param output: file object, flushed after each result
+    :param workers: int. number of processes, 1 to solve in this process
+    :param cache: dict of {cache key: [oxi_state, is_usual, comments]}, updated in place,
+        or None for no cache
+    :param all_oxi_states: bool. same as get_most_possible_oxi_state_of_composition()
+    :param ordered: bool. write results in the order of the input. Otherwise, results
+        are written as soon as they are solved
+    :param cache_size: int. maximum number of entries in cache. The least recently used
+        ones are dropped, so that memory does not grow with the input
+    :return: collections.Counter of the number of lines in each stage
+    """
+    counter = collections.Counter()
+    executor = None
+    if workers > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    # (record, cache key, future or result of solve(), whether the result is cached)
+    pending = collections.deque()
+    max_pending = max(workers, 1) * 4
+
+    def write(record, key, result, cached):
+        oxi_state, is_usual, comments, error = result
+        if cached:
+            counter['cached'] += 1
+        else:
+            stage = get_stage(result)
+            counter[stage] += 1
+            if key is not None and stage not in {'error', 'time budget exceeded'}:
+                cache[key] = [oxi_state, is_usual, comments]
+                while len(cache) > cache_size:
+                    cache.pop(next(iter(cache)))
+        record['oxi_state'] = oxi_state[0] if oxi_state else None
+        record['is_usual'] = is_usual
+        record['comments'] = comments
+        if error:
+            record['error'] = error
+        output.write(json.dumps(record) + '\n')
+        output.flush()
+
+    def write_done(wait_for_one):
+        if ordered:
+            while pending and (not isinstance(pending[0][2], concurrent.futures.Future)
+                               or pending[0][2].done() or wait_for_one):
+                record, key, result, cached = pending.popleft()
+                if isinstance(result, concurrent.futures.Future):
+                    result = result.result()
+                write(record, key, result, cached)
+                wait_for_one = False
+        else:
+            futures = [item[2] for item in pending]
+            if wait_for_one:
+                concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for item in list(pending):
+                if item[2].done():
+                    pending.remove(item)
+                    write(item[0], item[1], item[2].result(), item[3])
+
+    try:
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            record, composition = parse_line(line)
+            key = get_cache_key(composition, all_oxi_states) if cache is not None else None
+            if key is not None and key in cache:
+                oxi_state, is_usual, comments = cache[key]
+                if isinstance(cache, collections.OrderedDict):
+                    cache.move_to_end(key)
+                result = (oxi_state, is_usual, comments, None)
+                if ordered and pending:
+                    pending.append((record, key, result, True))
+                    write_done(wait_for_one=len(pending) >= max_pending)
+                else:
+                    write(record, key, result, True)
+                continue
+            if executor is None:
+                write(record, key, solve(composition, all_oxi_states), False)
+                continue
+            pending.append((record, key, executor.submit(solve, composition, all_oxi_states), False))
+            write_done(wait_for_one=len(pending) >= max_pending)
+        while pending:
+            write_done(wait_for_one=True)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    return counter
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='valence-solve',
+        description='solve oxidation states of compositions, one json line per input line',
+    )
+    parser.add_argument('files', nargs='*', help='input files, stdin if none or -')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes')
+    parser.add_argument('--cache', help='json file of solved compositions, read and updated. '
+                                        'No cache by default')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE,
+                        help='maximum number of compositions in the cache')
+    parser.add_argument('--all-oxi-states', action='store_true',
+                        help='use all oxidation states in pymatgen instead of the ICSD ones')
+    parser.add_argument('--unordered', action='store_true',
+                        help='write results as soon as they are solved instead of in the input order')
+    args = parser.parse_args(argv)
+
+    cache = load_cache(args.cache, args.cache_size) if args.cache else None
+    start_time = time.monotonic()
+    try:
+        with fileinput.input(files=args.files or ('-', )) as lines:
+            counter = solve_lines(
+                lines,
+                sys.stdout,
+                workers=args.workers,
+                cache=cache,
+                all_oxi_states=args.all_oxi_states,
+                ordered=not args.unordered,
+                cache_size=args.cache_size,
+            )
+    finally:
+        if args.cache:
+            save_cache(cache, args.cache)
+    elapsed = time.monotonic() - start_time
+
+    num_lines = sum(counter.values())
+    sys.stderr.write('{} lines in {:.2f} s ({:.1f} lines/s)\n'.format(
+        num_lines, elapsed, num_lines / elapsed if elapsed > 0 else 0.0
+    ))
+    for stage, num in sorted(counter.items()):
+        if num:
+            sys.stderr.write('  {}: {}\n'.format(stage, num))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,18 +2,28 @@
 from __future__ import division, unicode_literals
 
 import pdb
+import heapq
 from itertools import product
 import os
+import threading
+import time
 from collections import defaultdict
 from monty.serialization import loadfn
 from six.moves import zip
 from functools import total_ordering
+from fractions import Fraction
 
 from pymatgen.core.periodic_table import Element, Specie
 from pymatgen.core import Composition
 
 import pulp
 
+from .valence_dp import get_marginal_oxi_states, get_max_score_by_charge
+from . import metrics
+from . import slow_log
+from .precomputed import get_precomputed_index
+from .formula import get_el_amt, get_integer_el_amt, is_metal
+
 """
 The module is modified based on the original Composition class in pymatgen 
 to make the function to guess oxidation states more efficiently.
@@ -30,6 +40,51 @@ __status__ = "Production"
 __date__ = "Nov 10, 2012"
 __modifiedBy__ = "Tanjin He"
 
+MODEL_SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def record_solve(problem, solver):
+    """
+    count a solve by CBC and the size of the model in metrics. Every solver entry point
+    calls it, so that the number of solves can be checked in tests and monitored.
+
+    :param problem: pulp.LpProblem
+    :param solver: str. name of the function solving the problem
+    """
+    metrics.inc(
+        'valence_solver_solver_calls',
+        help_text='Number of linear programming problems solved by CBC',
+        solver=solver,
+    )
+    metrics.observe(
+        'valence_solver_model_variables',
+        len(problem.variables()),
+        help_text='Number of variables of the linear programming problems',
+        buckets=MODEL_SIZE_BUCKETS,
+        solver=solver,
+    )
+    metrics.observe(
+        'valence_solver_model_constraints',
+        len(problem.constraints),
+        help_text='Number of constraints of the linear programming problems',
+        buckets=MODEL_SIZE_BUCKETS,
+        solver=solver,
+    )
+
+
+def is_stopped_by_time_limit(problem, time_limit):
+    """
+    :param problem: pulp.LpProblem solved by CBC
+    :param time_limit: float. timeLimit of CBC, None for no limit
+    :return: bool. CBC is stopped by the time limit before proving optimality or
+        infeasibility, with or without a feasible solution. An infeasible model is not
+        stopped although its sol_status is LpSolutionNoSolutionFound as well.
+    """
+    if time_limit is None:
+        return False
+    return (problem.status in {pulp.LpStatusNotSolved, pulp.LpStatusUndefined}
+            or problem.sol_status == pulp.LpSolutionIntegerFeasible)
+
 
 @total_ordering
 class CompositionInHouse(Composition):
@@ -76,6 +131,21 @@ class CompositionInHouse(Composition):
     # might be wrong composition when valence of X is too large
     # 0.3 is an arbitrary threshold for warning
     X_valence_warning_level = 0.3
+    # memoized oxidation states of (el, all_metal_oxi_states, all_oxi_states),
+    # see get_possible_oxi_states
+    _oxi_states_cache = {}
+    # memoized scores of (el, oxidation state), see get_oxi_state_score
+    # entries are immutable and written atomically, so it is safe to share among threads
+    _oxi_score_cache = {}
+    # guard the one-time loading of Composition.oxi_prob
+    _oxi_prob_lock = threading.Lock()
+    # default time budget (seconds) of solving one composition, None for no limit.
+    # e.g. set CompositionInHouse.default_time_budget = 10 for batch jobs
+    default_time_budget = None
+    TIME_BUDGET_WARNING = 'Warning: time budget exceeded, the solution might not be optimal'
+    # index of precomputed solutions consulted before solving, see precomputed.py.
+    # None for the default file next to icsd_bv.yaml, False to disable
+    precomputed_index_path = None
 
     def __init__(self, *args, **kwargs):  # allow_negative=False
         """
@@ -102,15 +172,28 @@ class CompositionInHouse(Composition):
                 ambiguity.
         """
         super().__init__(*args, **kwargs)
-        # Load prior probabilities of oxidation states, used to rank solutions
-        if not Composition.oxi_prob:
-            module_dir = os.path.join(os.path.
-                                      dirname(os.path.abspath(__file__)))
-            all_data = loadfn(os.path.join(module_dir,
-                                           "analysis", "icsd_bv.yaml"))
-            Composition.oxi_prob = {Specie.from_str(sp): data
-                                    for sp, data in
-                                    all_data["occurrence"].items()}
+        CompositionInHouse.load_oxi_prob()
+
+    @staticmethod
+    def load_oxi_prob():
+        """
+        Load prior probabilities of oxidation states, used to rank solutions.
+        The table is loaded only once. The loading is guarded by a lock and the table
+        is assigned after it is complete, so that concurrent threads never load it
+        twice or read a partial table.
+        """
+        if Composition.oxi_prob:
+            return
+        with CompositionInHouse._oxi_prob_lock:
+            if not Composition.oxi_prob:
+                module_dir = os.path.join(os.path.
+                                          dirname(os.path.abspath(__file__)))
+                all_data = loadfn(os.path.join(module_dir,
+                                               "analysis", "icsd_bv.yaml"))
+                oxi_prob = {Specie.from_str(sp): data
+                            for sp, data in
+                            all_data["occurrence"].items()}
+                Composition.oxi_prob = oxi_prob
 
     def get_oxid_state_guess_essentials(self,
                                         oxi_states_override=None,
@@ -169,20 +252,29 @@ class CompositionInHouse(Composition):
                 raise ValueError("Composition {} cannot accommodate max_sites "
                                  "setting!".format(comp))
 
-        oxi_states_override = oxi_states_override or {}
-
         # assert: Composition only has integer amounts
         if not all(amt == int(amt) for amt in comp.values()):
             raise ValueError("Charge balance analysis requires integer "
                              "values in Composition!")
 
-        el_amt = comp.get_el_amt_dict()
-        els = list(el_amt.keys())
-        all_oxids = {}
-        for idx, el in enumerate(els):
-            if oxi_states_override.get(el):
-                oxids = oxi_states_override[el]
-            elif all_oxi_states:
+        return CompositionInHouse.get_oxid_state_guess_essentials_of_el_amt(
+            comp.get_el_amt_dict(),
+            oxi_states_override=oxi_states_override,
+            all_metal_oxi_states=all_metal_oxi_states,
+            all_oxi_states=all_oxi_states,
+            add_compensator=add_compensator,
+            double_el_amt=double_el_amt
+        )
+
+    @staticmethod
+    def get_possible_oxi_states(el, all_metal_oxi_states=False, all_oxi_states=False):
+        """
+        :return: tuple of possible oxidation states of el from pymatgen,
+            see get_oxid_state_guess_essentials() for the parameters
+        """
+        key = (el, all_metal_oxi_states, all_oxi_states)
+        if key not in CompositionInHouse._oxi_states_cache:
+            if all_oxi_states:
                 oxids = Element(el).oxidation_states
             elif all_metal_oxi_states:
                 # icsd_oxidation_states + positive valence in all_oxi_states
@@ -196,6 +288,35 @@ class CompositionInHouse(Composition):
             else:
                 oxids = Element(el).icsd_oxidation_states or \
                         Element(el).oxidation_states
+            CompositionInHouse._oxi_states_cache[key] = oxids
+        return CompositionInHouse._oxi_states_cache[key]
+
+    @staticmethod
+    def get_oxid_state_guess_essentials_of_el_amt(el_amt,
+                                                  oxi_states_override=None,
+                                                  all_metal_oxi_states=False,
+                                                  all_oxi_states=False,
+                                                  add_compensator=False,
+                                                  double_el_amt=False):
+        """
+        the same as get_oxid_state_guess_essentials() for a plain dict of integer amounts
+
+        :param el_amt: dict of {el: amount}
+        :return: (els, el_amt, all_oxids)
+        """
+        oxi_states_override = oxi_states_override or {}
+        el_amt = dict(el_amt)
+        els = list(el_amt.keys())
+        all_oxids = {}
+        for idx, el in enumerate(els):
+            if oxi_states_override.get(el):
+                oxids = oxi_states_override[el]
+            else:
+                oxids = CompositionInHouse.get_possible_oxi_states(
+                    el,
+                    all_metal_oxi_states=all_metal_oxi_states,
+                    all_oxi_states=all_oxi_states,
+                )
             all_oxids[el] = oxids
         if add_compensator and 'O' in el_amt:
             el_amt['X'] = el_amt['O']
@@ -251,10 +372,6 @@ class CompositionInHouse(Composition):
         """
         all_sols = []  # will contain all solutions
         all_scores = []  # will contain a score for each solution
-        # for each element, determine all possible sum of oxidations
-        # (taking into account nsites for that particular element)
-        el_sums = []  # matrix: dim1= el_idx, dim2=possible sums
-        el_sum_scores = defaultdict(set)  # dict of el_idx, sum -> score
 
         els, el_amt, all_oxids = self.get_oxid_state_guess_essentials(
             oxi_states_override=oxi_states_override,
@@ -264,27 +381,12 @@ class CompositionInHouse(Composition):
             add_compensator=add_compensator,
             double_el_amt=double_el_amt
         )
-        for idx, el in enumerate(els):
-            el_sum_scores[idx] = {}
-            el_sums.append([])
-            # Attention: this is to keep the same as pymatgen when searching for all possible solutions
-            # However, the original solution is not complete because it selects
-            # the solution with highest probability for each sum value for each element,
-            # which is what implemented here.
-            # To get the really all possible solutions regardless of probability,
-            # we can use linear programing without optimization
-            # (or optimization for a constant objective function),
-            # which returns all points on the boundary
-            all_sums, sum_scores = CompositionInHouse.get_possible_sums(
-                el,
-                all_oxids[el],
-                int(el_amt[el]),
-                add_compensator=add_compensator
-            )
-            for tmp_index, tmp_sum in enumerate(all_sums):
-                el_sums[idx].append(tmp_sum)
-                score = sum_scores[tmp_index]
-                el_sum_scores[idx][tmp_sum] = max(el_sum_scores[idx].get(tmp_sum, 0), score)
+        el_sums, el_sum_scores = CompositionInHouse.get_el_sum_scores(
+            els,
+            all_oxids,
+            el_amt,
+            add_compensator=add_compensator
+        )
 
         for x in product(*el_sums):
             # each x is a trial of one possible oxidation sum for each element
@@ -311,11 +413,215 @@ class CompositionInHouse(Composition):
 
         return all_sols
 
+    def iter_oxi_state_guesses(self,
+                               oxi_states_override=None,
+                               target_charge=0,
+                               all_metal_oxi_states=False,
+                               all_oxi_states=False,
+                               max_sites=None,
+                               add_compensator=False,
+                               double_el_amt=False,
+                               max_solutions=None,
+                               min_score=None,
+                               return_scores=False):
+        """
+        Lazy version of oxi_state_guesses(). Charge-balanced solutions are yielded from
+        most to least probable without enumerating the full cross product of the sums
+        of each element. A best-first search assigns the sum of one element at a time.
+        The priority of a partial assignment is its score plus the best score that the
+        remaining elements can reach for the remaining charge, which is tabulated in
+        advance, so that every popped complete assignment is the next best solution and
+        the memory is bounded by the search frontier. The solutions and the order
+        (including ties) are the same as oxi_state_guesses().
+
+        :param oxi_states_override, target_charge, all_metal_oxi_states, all_oxi_states,
+            max_sites, add_compensator, double_el_amt: same as oxi_state_guesses()
+        :param max_solutions: int. stop after this many solutions (top-k)
+        :param min_score: float. stop when the score of next solution is lower than this value
+        :param return_scores: bool. yield (solution, score) instead of solution
+        :return: generator of dicts - each dict reports an element symbol and average
+                oxidation state across all sites in that composition.
+        """
+        els, el_amt, all_oxids = self.get_oxid_state_guess_essentials(
+            oxi_states_override=oxi_states_override,
+            all_metal_oxi_states=all_metal_oxi_states,
+            all_oxi_states=all_oxi_states,
+            max_sites=max_sites,
+            add_compensator=add_compensator,
+            double_el_amt=double_el_amt
+        )
+        el_sums, el_sum_scores = CompositionInHouse.get_el_sum_scores(
+            els,
+            all_oxids,
+            el_amt,
+            add_compensator=add_compensator
+        )
+
+        # best_rest[idx]: dict of charge -> best score of elements idx, idx+1, ...
+        # summing up to that charge. This is an exact upper bound for the search.
+        best_rest = [None]*len(els) + [{0: 0}]
+        for idx in range(len(els)-1, -1, -1):
+            best_rest[idx] = {}
+            for tmp_sum in el_sums[idx]:
+                for rest_sum, rest_score in best_rest[idx+1].items():
+                    score = el_sum_scores[idx][tmp_sum] + rest_score
+                    if score > best_rest[idx].get(tmp_sum + rest_sum, float('-inf')):
+                        best_rest[idx][tmp_sum + rest_sum] = score
+
+        num_sols = 0
+        # frontier item: (-upper bound of score, indices of sums assigned, charge, score)
+        frontier = []
+        if target_charge in best_rest[0]:
+            frontier.append((-best_rest[0][target_charge], (), 0, 0))
+        while frontier:
+            if max_solutions is not None and num_sols >= max_solutions:
+                return
+            neg_bound, indices, charge, score = heapq.heappop(frontier)
+            if min_score is not None and -neg_bound < min_score:
+                return
+            idx = len(indices)
+            if idx == len(els):
+                x = [el_sums[i][j] for i, j in enumerate(indices)]
+                sol = {el: v / el_amt[el] for el, v in zip(els, x)}
+                score = 0
+                for i, v in enumerate(x):
+                    score += el_sum_scores[i][v]
+                num_sols += 1
+                yield (sol, score) if return_scores else sol
+                continue
+            for j, tmp_sum in enumerate(el_sums[idx]):
+                rest_charge = target_charge - charge - tmp_sum
+                if rest_charge not in best_rest[idx+1]:
+                    continue
+                new_score = score + el_sum_scores[idx][tmp_sum]
+                heapq.heappush(frontier, (
+                    -(new_score + best_rest[idx+1][rest_charge]),
+                    indices + (j, ),
+                    charge + tmp_sum,
+                    new_score,
+                ))
+
+        # elementary materials are not solved but the valence should be 0
+        if num_sols == 0 and len(els) == 1:
+            sol = {el: 0.0 for el in els}
+            yield (sol, 0) if return_scores else sol
+
+    def oxi_state_guesses_by_charge(self,
+                                    min_charge,
+                                    max_charge,
+                                    oxi_states_override=None,
+                                    all_metal_oxi_states=False,
+                                    all_oxi_states=False,
+                                    max_sites=None,
+                                    add_compensator=False,
+                                    double_el_amt=False,
+                                    return_details=False):
+        """
+        most possible oxidation states for every total charge in a range at the cost of
+        one solve, e.g. to classify a charged fragment such as PO4 or a ligand.
+        Composition must have integer values.
+
+        :param min_charge: int. lowest total charge
+        :param max_charge: int. highest total charge
+        :param oxi_states_override, all_metal_oxi_states, all_oxi_states,
+            max_sites, add_compensator, double_el_amt: same as oxi_state_guesses()
+        :param return_details: bool. return number of each type of ions or not
+        :return: dict of {charge: (oxi_state, score)} for each feasible charge, or
+            {charge: (oxi_state, score, oxi_details)} if return_details.
+            oxi_state is a dict of {el: average valence} and score is the same objective
+            as oxi_state_guesses_most_possible() with return_scores
+        """
+        els, el_amt, all_oxids = self.get_oxid_state_guess_essentials(
+            oxi_states_override=oxi_states_override,
+            all_metal_oxi_states=all_metal_oxi_states,
+            all_oxi_states=all_oxi_states,
+            max_sites=max_sites,
+            add_compensator=add_compensator,
+            double_el_amt=double_el_amt
+        )
+        results = {}
+        for charge, (solution, score, valence_detail) in \
+                CompositionInHouse.get_most_possible_solutions_by_charge(
+                    els,
+                    all_oxids,
+                    el_amt,
+                    min_charge,
+                    max_charge,
+                    add_compensator=add_compensator,
+                ).items():
+            if return_details:
+                results[charge] = (solution, score, valence_detail)
+            else:
+                results[charge] = (solution, score)
+        return results
+
+    def get_oxi_state_marginals(self,
+                                oxi_states_override=None,
+                                target_charge=0,
+                                all_metal_oxi_states=False,
+                                all_oxi_states=False,
+                                max_sites=None,
+                                add_compensator=False,
+                                double_el_amt=False):
+        """
+        Distribution of the oxidation states of each element over all charge-balanced
+        assignments, weighted by ICSD occurrence. Each ion takes a state with a probability
+        proportional to its occurrence (states not observed in ICSD are excluded unless no
+        state of the element is observed) and the distribution is conditioned on charge
+        balance. The marginals are computed exactly with a sum-product dynamic programming
+        over charge sums rather than by enumerating solutions. Composition must have
+        integer values.
+
+        :param oxi_states_override, target_charge, all_metal_oxi_states, all_oxi_states,
+            max_sites, add_compensator, double_el_amt: same as oxi_state_guesses()
+        :return: dict of {el: {state: probability}}. probability that an ion of the element
+            takes the oxidation state. If the composition is not charge balanced, an empty
+            dict is returned.
+        """
+        els, el_amt, all_oxids = self.get_oxid_state_guess_essentials(
+            oxi_states_override=oxi_states_override,
+            all_metal_oxi_states=all_metal_oxi_states,
+            all_oxi_states=all_oxi_states,
+            max_sites=max_sites,
+            add_compensator=add_compensator,
+            double_el_amt=double_el_amt
+        )
+        all_weights = {}
+        for el in els:
+            all_weights[el] = {}
+            for tmp_state in all_oxids[el]:
+                score = CompositionInHouse.get_oxi_state_score(
+                    el, tmp_state, add_compensator=add_compensator
+                )
+                all_weights[el][tmp_state] = max(score or 0, 0)
+            if sum(all_weights[el].values()) == 0:
+                all_weights[el] = {tmp_state: 1 for tmp_state in all_oxids[el]}
+
+        # elementary materials are not solved but the valence should be 0
+        if len(els) == 1 and target_charge == 0:
+            return {els[0]: {0: 1.0}}
+
+        return get_marginal_oxi_states(
+            els,
+            all_oxids,
+            el_amt,
+            all_weights,
+            target_charge=target_charge,
+        )
+
+    @slow_log.logged(
+        'oxi_state_guesses_most_possible',
+        get_input=lambda arguments: arguments['self'].get_el_amt_dict(),
+        get_output=lambda result: list(result[:3]),
+        skip=('self', ),
+    )
     def oxi_state_guesses_most_possible(
         self,
         oxi_states_override=None,
         return_details=False,
         all_oxi_states=False,
+        time_budget=None,
+        initial_solution=None,
     ):
         """
         guess the most possible oxidation states based on the same method in pymatggen.
@@ -326,6 +632,12 @@ class CompositionInHouse(Composition):
         :param oxi_states_override: dict. dict of str->list to override an
                 element's common oxidation states, e.g. {"V": [2,3,4,5]}
         :param return_details: bool. return number of each type of ions or not
+        :param time_budget: float. maximum seconds for all stages of solving. When the budget
+                runs out, the best solution found so far (or an empty list if none) is returned
+                and TIME_BUDGET_WARNING is appended to comments. If None,
+                CompositionInHouse.default_time_budget is used (no limit by default).
+        :param initial_solution: dict of {el: average valence}. hint to warm start the
+                solver, see get_most_possible_solution()
         :return: (oxi_state, is_usual, comments)
             oxi_state: dict of oxidation state {el: valence}
             is_usual: bool. if True. The solution is the same as the default solution from
@@ -337,18 +649,32 @@ class CompositionInHouse(Composition):
         """
         is_usual = True
         comments = []
+        # relaxation stages that are reached, recorded in metrics
+        outcomes = []
         el_amt = self.get_el_amt_dict()
+        if time_budget is None:
+            time_budget = CompositionInHouse.default_time_budget
+        deadline = None if time_budget is None else time.monotonic() + time_budget
+
+        def remaining_time():
+            if deadline is None:
+                return None
+            return max(deadline - time.monotonic(), 0)
 
         # solution same as pymatgen, but much faster,
         # so that we can do relaxation if no solution found
-        oxi_state, oxi_details = self._oxi_state_guesses_most_possible(
-            oxi_states_override=oxi_states_override,
-            all_metal_oxi_states=False,
-            all_oxi_states=all_oxi_states,
-            add_compensator=False,
-            double_el_amt=False,
-            return_details=True,
-        )
+        with slow_log.stage('default'):
+            oxi_state, oxi_details, timed_out = self._oxi_state_guesses_most_possible(
+                oxi_states_override=oxi_states_override,
+                all_metal_oxi_states=False,
+                all_oxi_states=all_oxi_states,
+                add_compensator=False,
+                double_el_amt=False,
+                return_details=True,
+                time_limit=remaining_time(),
+                initial_solution=initial_solution,
+                return_timed_out=True,
+            )
 
         # deal with alloy
         if len(oxi_state) == 0 and self.is_alloy():
@@ -360,19 +686,29 @@ class CompositionInHouse(Composition):
             ]
             is_usual = False
             comments = ['is alloy']
+            outcomes.append('is alloy')
+            # the solution of an alloy does not depend on the solver
+            timed_out = False
 
         # solve again with relaxation
-        if len(oxi_state) == 0:
-            oxi_state, oxi_details = self._oxi_state_guesses_most_possible(
-                oxi_states_override=oxi_states_override,
-                all_metal_oxi_states=True,
-                all_oxi_states=all_oxi_states,
-                add_compensator=True,
-                double_el_amt=False,
-                return_details=True,
-            )
+        if len(oxi_state) == 0 and timed_out:
+            is_usual = False
+        elif len(oxi_state) == 0:
+            with slow_log.stage('compensator'):
+                oxi_state, oxi_details, timed_out = self._oxi_state_guesses_most_possible(
+                    oxi_states_override=oxi_states_override,
+                    all_metal_oxi_states=True,
+                    all_oxi_states=all_oxi_states,
+                    add_compensator=True,
+                    double_el_amt=False,
+                    return_details=True,
+                    time_limit=remaining_time(),
+                    initial_solution=initial_solution,
+                    return_timed_out=True,
+                )
             is_usual = False
             comments.append('all possible positive valence states are used for metals')
+            outcomes.append('compensator')
 
         # might be wrong composition when valence of X is too large
         # solve again for large X
@@ -392,16 +728,25 @@ class CompositionInHouse(Composition):
                 for k in list(oxi_details[0].keys()):
                     if k[0] == 'X':
                         del oxi_details[0][k]
-            else:
+                outcomes.append('peroxide correction')
+            elif not timed_out:
                 # solve again by doubling the amount in case there is a valence skipping effect
-                oxi_state, oxi_details = self._oxi_state_guesses_most_possible(
-                    oxi_states_override=oxi_states_override,
-                    all_metal_oxi_states=True,
-                    all_oxi_states=all_oxi_states,
-                    add_compensator=True,
-                    double_el_amt=True,
-                    return_details=True,
-                )
+                with slow_log.stage('doubled amount'):
+                    doubled_state, doubled_details, timed_out = self._oxi_state_guesses_most_possible(
+                        oxi_states_override=oxi_states_override,
+                        all_metal_oxi_states=True,
+                        all_oxi_states=all_oxi_states,
+                        add_compensator=True,
+                        double_el_amt=True,
+                        return_details=True,
+                        time_limit=remaining_time(),
+                        initial_solution=initial_solution,
+                        return_timed_out=True,
+                    )
+                outcomes.append('doubled amount')
+                # keep the solution found so far if the budget runs out without a solution
+                if len(doubled_state) > 0 or not timed_out:
+                    oxi_state, oxi_details = doubled_state, doubled_details
 
         if (len(oxi_state) > 0 and 'X' in oxi_state[0]):
             if oxi_state[0]['X'] > 0:
@@ -410,9 +755,23 @@ class CompositionInHouse(Composition):
                 comments.append('possibly oxygen excess, or some elements are more reduced than usual')
             if abs(oxi_state[0]['X']) > CompositionInHouse.X_valence_warning_level:
                 comments.append('Warning: the input composition might be wrong')
+                outcomes.append('composition warning')
             del oxi_state[0]['X']
             if ('X', 0) in oxi_details[0]:
                 del oxi_details[0][('X', 0)]
+        if timed_out:
+            comments.append(CompositionInHouse.TIME_BUDGET_WARNING)
+            outcomes.append('time budget exceeded')
+        if len(oxi_state) == 0:
+            outcomes.append('no solution')
+        if not outcomes:
+            outcomes.append('usual')
+        for outcome in outcomes:
+            metrics.inc(
+                'valence_solver_relaxation_outcomes',
+                help_text='Number of compositions reaching each relaxation stage',
+                outcome=outcome,
+            )
         if return_details:
             return oxi_state, is_usual, comments, oxi_details
         else:
@@ -428,6 +787,11 @@ class CompositionInHouse(Composition):
         add_compensator=False,
         double_el_amt=False,
         return_details=False,
+        k=1,
+        return_scores=False,
+        time_limit=None,
+        initial_solution=None,
+        return_timed_out=False,
     ):
         """
         Checks if the composition is charge-balanced and returns back all
@@ -461,15 +825,29 @@ class CompositionInHouse(Composition):
                 sometimes there is a valence skipping effect but the amount is odd.
                 https://web.stanford.edu/group/fisher/research/valence_skipping_elements.html
         :param return_details: bool. return number of each type of ions or not
-        :return: a list of dicts - the length is always 1 or 0 because only the most
-                possible solution is returned. each dict reports an element symbol
+        :param k: int. number of solutions. if k > 1, the k most possible solutions with
+                distinct average oxidation states are returned, see
+                get_k_most_possible_solutions()
+        :param return_scores: bool. return the score of each solution or not
+        :param time_limit: float. maximum seconds for the solver. The best solution found
+                within the limit is returned, which might not be optimal.
+        :param initial_solution: dict of {el: average valence}. hint to warm start the
+                solver, see get_most_possible_solution()
+        :param return_timed_out: bool. return whether the solver is stopped by time_limit
+                or not. Solutions certified by the greedy fast path are never timed out.
+        :return: a list of dicts - the length is at most k (1 by default) because only the
+                most possible solutions are returned. each dict reports an element symbol
                 and average oxidation state across all sites in that composition.
                 If the composition is not charge balanced, an empty list is returned.
+                If return_details, a list of dicts {(el, state): number of ions} is returned
+                as well. If return_scores, a list of scores is returned. If return_timed_out,
+                a bool is returned as the last item.
         """
 
         all_sols = []  # will contain all solutions
         all_scores = []  # will contain a score for each solution
         all_details = [] # contain number of each type of ion
+        timed_out = False
         els, el_amt, all_oxids = self.get_oxid_state_guess_essentials(
             oxi_states_override=oxi_states_override,
             all_metal_oxi_states=all_metal_oxi_states,
@@ -478,26 +856,66 @@ class CompositionInHouse(Composition):
             add_compensator=add_compensator,
             double_el_amt=double_el_amt
         )
-        solution, score, valence_detail = CompositionInHouse.get_most_possible_solution(
-            els,
-            all_oxids,
-            el_amt,
-            add_compensator=add_compensator,
-            target_charge=target_charge,
-        )
-        if solution:
-            all_sols = [solution]
-            all_scores = [score]
-            all_details = [valence_detail]
+        if k > 1:
+            k_solutions, timed_out = CompositionInHouse.get_k_most_possible_solutions(
+                els,
+                all_oxids,
+                el_amt,
+                k=k,
+                add_compensator=add_compensator,
+                target_charge=target_charge,
+                time_limit=time_limit,
+                return_timed_out=True,
+            )
+            for solution, score, valence_detail in k_solutions:
+                all_sols.append(solution)
+                all_scores.append(score)
+                all_details.append(valence_detail)
+        else:
+            # fast path: most ordinary compounds are balanced by the most probable states
+            solution, score, valence_detail = CompositionInHouse.get_greedy_solution(
+                els,
+                all_oxids,
+                el_amt,
+                add_compensator=add_compensator,
+                target_charge=target_charge,
+            )
+            metrics.inc(
+                'valence_solver_greedy_attempts',
+                help_text='Number of attempts of the greedy fast path',
+                result='hit' if solution else 'miss',
+            )
+            if not solution:
+                solution, score, valence_detail, timed_out = CompositionInHouse.get_most_possible_solution(
+                    els,
+                    all_oxids,
+                    el_amt,
+                    add_compensator=add_compensator,
+                    target_charge=target_charge,
+                    time_limit=time_limit,
+                    initial_solution=initial_solution,
+                    return_timed_out=True,
+                )
+            if solution:
+                all_sols = [solution]
+                all_scores = [score]
+                all_details = [valence_detail]
 
         # elementary materials are not solved but the valence should be 0
         if not all_sols and len(els) == 1:
             all_sols = [{el:0.0 for el in els}]
+            all_scores = [0]
             all_details = [{(el, 0): el_amt[el] for el in els}]
+        results = [all_sols]
         if return_details:
-            return all_sols, all_details
-        else:
+            results.append(all_details)
+        if return_scores:
+            results.append(all_scores)
+        if return_timed_out:
+            results.append(timed_out)
+        if len(results) == 1:
             return all_sols
+        return tuple(results)
 
     @staticmethod
     def get_possible_sums(el, oxi_states, el_amt, add_compensator=False):
@@ -540,6 +958,7 @@ class CompositionInHouse(Composition):
                 [oxi_states[i]*oxi_vars[oxi_names[i]] for i in range(len(oxi_states))]
             ) == tmp_sum
             problem.solve(pulp.PULP_CBC_CMD(msg=False))
+            record_solve(problem, 'get_possible_sums')
             if pulp.LpStatus[problem.status] == 'Optimal':
                 all_sums.append(tmp_sum)
                 sum_scores.append(pulp.value(problem.objective))
@@ -548,16 +967,122 @@ class CompositionInHouse(Composition):
         return all_sums, sum_scores
 
     @staticmethod
-    def get_most_possible_solution(all_els,
-                                   all_oxi_states,
-                                   all_el_amts,
-                                   add_compensator=False,
-                                   target_charge=0):
-        # goal
+    def get_el_sum_scores(els, all_oxids, el_amt, add_compensator=False):
+        """
+        for each element, determine all possible sum of oxidations
+        (taking into account nsites for that particular element)
+
+        :return: (el_sums, el_sum_scores)
+            el_sums: matrix: dim1= el_idx, dim2=possible sums
+            el_sum_scores: dict of el_idx, sum -> score
+        """
+        el_sums = []
+        el_sum_scores = defaultdict(set)
+        for idx, el in enumerate(els):
+            el_sum_scores[idx] = {}
+            el_sums.append([])
+            # Attention: this is to keep the same as pymatgen when searching for all possible solutions
+            # However, the original solution is not complete because it selects
+            # the solution with highest probability for each sum value for each element,
+            # which is what implemented here.
+            # To get the really all possible solutions regardless of probability,
+            # we can use linear programing without optimization
+            # (or optimization for a constant objective function),
+            # which returns all points on the boundary
+            all_sums, sum_scores = CompositionInHouse.get_possible_sums(
+                el,
+                all_oxids[el],
+                int(el_amt[el]),
+                add_compensator=add_compensator
+            )
+            for tmp_index, tmp_sum in enumerate(all_sums):
+                el_sums[idx].append(tmp_sum)
+                score = sum_scores[tmp_index]
+                el_sum_scores[idx][tmp_sum] = max(el_sum_scores[idx].get(tmp_sum, 0), score)
+        return el_sums, el_sum_scores
+
+    @staticmethod
+    def get_oxi_state_score(el, oxi_state, add_compensator=False):
+        """
+        score of one ion used in the objective of the solvers, i.e. the ICSD occurrence
+        of the oxidation state. Lookups are memoized because creating Specie is slow.
+
+        :param el: str. element symbol, or "X" for the compensator
+        :param oxi_state: int. oxidation state
+        :param add_compensator: bool. if True, "X" is scored as the charge compensator
+        :return: float or None if the ion cannot be scored
+        """
+        if add_compensator and el == 'X':
+            return {
+                0: CompositionInHouse.LARGE_PROBABILITY,
+                1: 1,
+                -1: 1,
+            }.get(oxi_state)
+        if el not in Element.__members__:
+            return None
+        key = (el, oxi_state)
+        if key not in CompositionInHouse._oxi_score_cache:
+            CompositionInHouse._oxi_score_cache[key] = Composition.oxi_prob.get(
+                Specie(el, oxi_state), -CompositionInHouse.LARGE_PROBABILITY
+            )
+        return CompositionInHouse._oxi_score_cache[key]
+
+    @staticmethod
+    def get_greedy_solution(all_els,
+                            all_oxi_states,
+                            all_el_amts,
+                            add_compensator=False,
+                            target_charge=0):
+        """
+        fast path before get_most_possible_solution. Every element takes its most probable
+        oxidation state. The sum of amount * best score over all elements is an upper bound
+        of the objective, so if the greedy assignment is charge balanced it reaches the bound
+        and is optimal. The best state is required to be unique for each element so that the
+        optimum is unique and identical to the one from the linear programming.
+
+        :return: (solution, score, valence_detail) in the same format as
+            get_most_possible_solution. solution is empty if the certificate fails.
+        """
         solution = {}
-        score = 0
         valence_detail = {}
+        score = 0
+        charge = 0
+        for el in all_els:
+            scores = [
+                CompositionInHouse.get_oxi_state_score(el, tmp_state, add_compensator=add_compensator)
+                for tmp_state in all_oxi_states[el]
+            ]
+            if len(scores) == 0 or None in scores:
+                return {}, 0, {}
+            best_score = max(scores)
+            if scores.count(best_score) > 1:
+                return {}, 0, {}
+            best_state = all_oxi_states[el][scores.index(best_score)]
+            for tmp_state in all_oxi_states[el]:
+                valence_detail[(el, tmp_state)] = 0.0
+            valence_detail[(el, best_state)] = float(all_el_amts[el])
+            solution[el] = float(best_state)
+            score += best_score * all_el_amts[el]
+            charge += best_state * all_el_amts[el]
+        if charge != target_charge:
+            return {}, 0, {}
+        return solution, float(score), valence_detail
+
+    @staticmethod
+    def get_score_problem(all_els,
+                          all_oxi_states,
+                          all_el_amts,
+                          add_compensator=False,
+                          target_charge=0):
+        """
+        integer linear programming model used by get_most_possible_solution. The number of
+        ions of each oxidation state is a variable and the total score is maximized subject
+        to the amount of each element and charge balance.
 
+        :return: (problem, oxi_vars)
+            problem: pulp.LpProblem
+            oxi_vars: dict of {el+str(state): pulp.LpVariable}
+        """
         oxi_names = []
         costs = {}
         for el in all_els:
@@ -591,8 +1116,137 @@ class CompositionInHouse(Composition):
         problem += pulp.lpSum(
             [tmp_state*oxi_vars[el+str(tmp_state)] for el in all_els for tmp_state in all_oxi_states[el]
              ]) == target_charge, 'sumOfValence'
+        return problem, oxi_vars
+
+    @staticmethod
+    def get_initial_counts(all_els,
+                           all_oxi_states,
+                           all_el_amts,
+                           initial_solution,
+                           add_compensator=False,
+                           target_charge=0):
+        """
+        number of ions of each oxidation state close to the average oxidation states of a
+        similar composition, used as the start of the linear programming. The ions of each
+        element are split between the two states around the average, and then ions are
+        moved to adjacent states until the charge is balanced.
+
+        :param initial_solution: dict of {el: average valence}, e.g. the solution of a
+            composition in the same chemical system. Elements not in it take the most
+            probable state.
+        :return: dict of {(el, state): number of ions} or None if the charge cannot be balanced
+        """
+        counts = {}
+        for el in all_els:
+            states = sorted(all_oxi_states[el])
+            amt = int(all_el_amts[el])
+            for tmp_state in states:
+                counts[(el, tmp_state)] = 0
+            if len(states) == 0:
+                return None
+            avg = initial_solution.get(el)
+            if avg is None:
+                scores = [
+                    CompositionInHouse.get_oxi_state_score(el, tmp_state, add_compensator=add_compensator) or 0
+                    for tmp_state in states
+                ]
+                counts[(el, states[scores.index(max(scores))])] = amt
+                continue
+            low = max([st for st in states if st <= avg] or [states[0]])
+            high = min([st for st in states if st >= avg] or [states[-1]])
+            num_high = 0
+            if high != low:
+                num_high = min(max(int(round(amt * (avg - low) / (high - low))), 0), amt)
+            counts[(el, high)] += num_high
+            counts[(el, low)] += amt - num_high
+
+        # move one ion at a time to the state reducing the charge residual the most
+        residual = sum(tmp_state * n for (el, tmp_state), n in counts.items()) - target_charge
+        while residual != 0:
+            best_move = None
+            for (el, tmp_state), n in counts.items():
+                if n == 0:
+                    continue
+                for new_state in all_oxi_states[el]:
+                    new_residual = residual + new_state - tmp_state
+                    if abs(new_residual) < abs(residual) and (
+                        best_move is None or abs(new_residual) < abs(best_move[3])
+                    ):
+                        best_move = (el, tmp_state, new_state, new_residual)
+            if best_move is None:
+                return None
+            el, tmp_state, new_state, residual = best_move
+            counts[(el, tmp_state)] -= 1
+            counts[(el, new_state)] += 1
+        return counts
+
+    @staticmethod
+    def get_most_possible_solution(all_els,
+                                   all_oxi_states,
+                                   all_el_amts,
+                                   add_compensator=False,
+                                   target_charge=0,
+                                   time_limit=None,
+                                   initial_solution=None,
+                                   return_timed_out=False):
+        """
+        most possible solution by integer linear programming, see get_score_problem()
+
+        :param time_limit: float. maximum seconds for CBC
+        :param initial_solution: dict of {el: average valence}. hint of the solution, e.g.
+            the solution of the nearest cached composition in the same chemical system.
+            It is converted to a feasible start of CBC (MIP start) by get_initial_counts(),
+            so that branch and bound starts with a good incumbent.
+        :param return_timed_out: bool. return whether CBC is stopped by time_limit or not,
+            i.e. the solution (or the lack of one) is not proven optimal (infeasible)
+        :return: (solution, score, valence_detail), with timed_out appended if return_timed_out
+        """
+        # goal
+        solution = {}
+        score = 0
+        valence_detail = {}
+        start_time = time.perf_counter()
+
+        problem, oxi_vars = CompositionInHouse.get_score_problem(
+            all_els,
+            all_oxi_states,
+            all_el_amts,
+            add_compensator=add_compensator,
+            target_charge=target_charge,
+        )
+
+        # no time left to solve
+        if time_limit is not None and time_limit <= 0:
+            if return_timed_out:
+                return solution, score, valence_detail, True
+            return solution, score, valence_detail
 
-        problem.solve(pulp.PULP_CBC_CMD(msg=False))
+        initial_counts = None
+        if initial_solution:
+            initial_counts = CompositionInHouse.get_initial_counts(
+                all_els,
+                all_oxi_states,
+                all_el_amts,
+                initial_solution,
+                add_compensator=add_compensator,
+                target_charge=target_charge,
+            )
+        if initial_counts:
+            for (el, tmp_state), n in initial_counts.items():
+                oxi_vars[el+str(tmp_state)].setInitialValue(n)
+        problem.solve(pulp.PULP_CBC_CMD(msg=False, timeLimit=time_limit, warmStart=bool(initial_counts)))
+        record_solve(problem, 'get_most_possible_solution')
+        slow_log.record_model(
+            all_els,
+            all_oxi_states,
+            all_el_amts,
+            seconds=time.perf_counter() - start_time,
+            status=pulp.LpStatus[problem.status],
+            add_compensator=add_compensator,
+            target_charge=target_charge,
+            time_limit=time_limit,
+            initial_solution=initial_solution,
+        )
         if pulp.LpStatus[problem.status] == 'Optimal':
             for el in all_els:
                 solution[el] = pulp.value(
@@ -602,17 +1256,184 @@ class CompositionInHouse(Composition):
                     valence_detail[(el, tmp_state)] = pulp.value(oxi_vars[el+str(tmp_state)])
             score = pulp.value(problem.objective)
 
+        if return_timed_out:
+            return solution, score, valence_detail, is_stopped_by_time_limit(problem, time_limit)
         return solution, score, valence_detail
 
+    @staticmethod
+    def get_k_most_possible_solutions(all_els,
+                                      all_oxi_states,
+                                      all_el_amts,
+                                      k=1,
+                                      add_compensator=False,
+                                      target_charge=0,
+                                      time_limit=None,
+                                      return_timed_out=False):
+        """
+        k best solutions of the model in get_most_possible_solution. After each solve,
+        the found combination of the sum of oxidation states of all elements is excluded
+        by a cut, so that the solutions are distinct in the average oxidation states and
+        each one is the best distribution of ions for its oxidation states, the same as
+        the solutions from oxi_state_guesses(). For each element e with charge sum y_e
+        and excluded value y*_e, binary variables up_e and down_e are added with
+            y_e >= y*_e + 1 - M_e*(1-up_e)
+            y_e <= y*_e - 1 + M_e*(1-down_e)
+            sum_e (up_e + down_e) >= 1
+
+        :param k: int. maximum number of solutions
+        :param time_limit: float. maximum seconds for all solves. Solutions proven optimal
+            within the limit are returned.
+        :param return_timed_out: bool. return whether the time limit stops the search
+            before k solutions are found or no more solution is proven to exist
+        :return: list of (solution, score, valence_detail) from most to least probable,
+            each in the same format as get_most_possible_solution.
+            (all_solutions, timed_out) if return_timed_out
+        """
+        all_solutions = []
+        timed_out = False
+        problem, oxi_vars = CompositionInHouse.get_score_problem(
+            all_els,
+            all_oxi_states,
+            all_el_amts,
+            add_compensator=add_compensator,
+            target_charge=target_charge,
+        )
+        el_sums = {
+            el: pulp.lpSum([tmp_state*oxi_vars[el+str(tmp_state)] for tmp_state in all_oxi_states[el]])
+            for el in all_els
+        }
+        # elements with a single oxidation state cannot change their sum
+        var_els = [el for el in all_els if len(set(all_oxi_states[el])) > 1]
+
+        deadline = None if time_limit is None else time.monotonic() + time_limit
+        while len(all_solutions) < k:
+            remaining_time = None
+            if deadline is not None:
+                remaining_time = deadline - time.monotonic()
+                if remaining_time <= 0:
+                    timed_out = True
+                    break
+            problem.solve(pulp.PULP_CBC_CMD(msg=False, timeLimit=remaining_time))
+            record_solve(problem, 'get_k_most_possible_solutions')
+            # an incumbent found within the time limit is not the next best solution
+            if problem.sol_status != pulp.LpSolutionOptimal:
+                timed_out = is_stopped_by_time_limit(problem, remaining_time)
+                break
+            solution = {}
+            valence_detail = {}
+            for el in all_els:
+                solution[el] = pulp.value(el_sums[el])/float(all_el_amts[el])
+                for tmp_state in all_oxi_states[el]:
+                    valence_detail[(el, tmp_state)] = pulp.value(oxi_vars[el+str(tmp_state)])
+            all_solutions.append((solution, pulp.value(problem.objective), valence_detail))
+            if len(var_els) == 0:
+                break
+
+            # exclude the sums of this solution
+            cut_index = len(all_solutions)
+            indicators = []
+            for el in var_els:
+                big_m = all_el_amts[el]*(max(all_oxi_states[el]) - min(all_oxi_states[el])) + 1
+                last_sum = round(solution[el]*all_el_amts[el])
+                up = pulp.LpVariable('cut_{}_up_{}'.format(cut_index, el), cat=pulp.LpBinary)
+                down = pulp.LpVariable('cut_{}_down_{}'.format(cut_index, el), cat=pulp.LpBinary)
+                problem += el_sums[el] >= last_sum + 1 - big_m*(1-up), \
+                           'cut_{}_up_{}'.format(cut_index, el)
+                problem += el_sums[el] <= last_sum - 1 + big_m*(1-down), \
+                           'cut_{}_down_{}'.format(cut_index, el)
+                indicators.extend([up, down])
+            problem += pulp.lpSum(indicators) >= 1, 'cut_{}'.format(cut_index)
+
+        if return_timed_out:
+            return all_solutions, timed_out
+        return all_solutions
+
+    @staticmethod
+    def get_most_possible_solutions_by_charge(all_els,
+                                              all_oxi_states,
+                                              all_el_amts,
+                                              min_charge,
+                                              max_charge,
+                                              add_compensator=False):
+        """
+        get_most_possible_solution() for every target charge in [min_charge, max_charge]
+        in one pass, by a max-plus dynamic programming over charge sums instead of a
+        linear programming per charge. The optimal score of each charge is the same as
+        get_most_possible_solution(target_charge=charge). When several assignments have the
+        optimal score, the one returned might differ.
+
+        :return: dict of {charge: (solution, score, valence_detail)} in the same format as
+            get_most_possible_solution, for each charge with a solution
+        """
+        all_scores = {}
+        for el in all_els:
+            all_scores[el] = {
+                tmp_state: CompositionInHouse.get_oxi_state_score(
+                    el, tmp_state, add_compensator=add_compensator
+                )
+                for tmp_state in all_oxi_states[el]
+            }
+        solutions = {}
+        for charge, (score, counts) in get_max_score_by_charge(
+            all_els,
+            all_oxi_states,
+            all_el_amts,
+            all_scores,
+            min_charge,
+            max_charge,
+        ).items():
+            solution = {}
+            valence_detail = {}
+            for el in all_els:
+                solution[el] = sum(
+                    tmp_state * num for tmp_state, num in counts[el].items()
+                ) / float(all_el_amts[el])
+                for tmp_state in all_oxi_states[el]:
+                    valence_detail[(el, tmp_state)] = float(counts[el].get(tmp_state, 0))
+            solutions[charge] = (solution, score, valence_detail)
+        return solutions
+
+    @staticmethod
+    def snap_amounts(el_amt, max_denominator=12, tolerance=1e-3):
+        """
+        snap noisy decimal amounts to nearby simple fractions, e.g. 0.667 -> 2/3 and
+        0.1667 -> 1/6, so that the integer formula stays small
+
+        :param el_amt: dict of {el: amount}
+        :param max_denominator: int. maximum denominator of the fractions
+        :param tolerance: float. maximum difference between an amount and its fraction
+        :return: (el_amt, snapped_amts)
+            el_amt: dict of {el: amount} after snapping
+            snapped_amts: dict of {el: (original amount, Fraction)} for snapped amounts
+        """
+        new_el_amt = {}
+        snapped_amts = {}
+        for el, amt in el_amt.items():
+            frac = Fraction(amt).limit_denominator(max_denominator)
+            if float(frac) != amt and frac > 0 and abs(frac - amt) <= tolerance:
+                new_el_amt[el] = float(frac)
+                snapped_amts[el] = (amt, frac)
+            else:
+                new_el_amt[el] = amt
+        return new_el_amt, snapped_amts
+
     def is_alloy(self):
         return all([Element(el).is_metal for el in self.get_el_amt_dict()])
 
     @staticmethod
+    @metrics.timed(
+        'valence_solver_composition_seconds',
+        help_text='Latency of get_most_possible_oxi_state_of_composition in seconds',
+    )
     def get_most_possible_oxi_state_of_composition(
         composition,
         oxi_states_override=None,
         return_details=False,
         all_oxi_states=False,
+        snap_max_denominator=None,
+        snap_tolerance=1e-3,
+        time_budget=None,
+        initial_solution=None,
     ):
         """
         a wrapper using the method oxi_state_guesses_most_possible to guess the most possible
@@ -623,6 +1444,15 @@ class CompositionInHouse(Composition):
         :param oxi_states_override: dict. dict of str->list to override an
                 element's common oxidation states, e.g. {"V": [2,3,4,5]}
         :param return_details: bool. return number of each type of ions or not
+        :param snap_max_denominator: int. if set, amounts are snapped to the nearest fraction
+                with a denominator no larger than this value before integerization, e.g.
+                0.667 -> 2/3. Otherwise, NaNb0.667Cr0.667(PO4)3 becomes a huge integer formula.
+                The snapping is recorded in comments.
+        :param snap_tolerance: float. amounts are only snapped when the difference is no
+                larger than this value
+        :param time_budget: float. maximum seconds of solving, see oxi_state_guesses_most_possible()
+        :param initial_solution: dict of {el: average valence}. hint to warm start the
+                solver, e.g. the solution of a similar composition
         :return: (oxi_state, is_usual, comments)
             oxi_state: dict of oxidation state {el: valence}
             is_usual: bool. if True. The solution is the same as the default solution from
@@ -632,15 +1462,46 @@ class CompositionInHouse(Composition):
                 oxidized/reduced metal states, etc.
             comments: list of strings. Details when is_usual == False.
         """
-        valence_comp = CompositionInHouse(composition)
-        if len(valence_comp) > 0:
-            valence_comp, inte_factor = valence_comp.get_integer_formula_and_factor()
-            valence_comp = CompositionInHouse(valence_comp)
-            oxi_state, is_usual, comments, oxi_details = valence_comp.oxi_state_guesses_most_possible(
-                oxi_states_override=oxi_states_override,
-                return_details=True,
-                all_oxi_states=all_oxi_states,
+        CompositionInHouse.load_oxi_prob()
+        # plain dicts and simple formulas are parsed and integerized without pymatgen
+        el_amt = get_el_amt(composition)
+        if el_amt is None:
+            el_amt = CompositionInHouse(composition).get_el_amt_dict()
+        snapped_amts = {}
+        if len(el_amt) > 0 and snap_max_denominator:
+            el_amt, snapped_amts = CompositionInHouse.snap_amounts(
+                el_amt,
+                max_denominator=snap_max_denominator,
+                tolerance=snap_tolerance,
             )
+        if len(el_amt) > 0:
+            el_amt, inte_factor = get_integer_el_amt(el_amt)
+            valence_comp = PlainComposition(el_amt)
+            result = None
+            if (not oxi_states_override
+                and not all_oxi_states
+                and CompositionInHouse.precomputed_index_path is not False):
+                index = get_precomputed_index(CompositionInHouse.precomputed_index_path)
+                if index is not None:
+                    result = index.lookup(valence_comp.get_el_amt_dict())
+                    metrics.inc(
+                        'valence_solver_precomputed_lookups',
+                        help_text='Number of lookups in the index of precomputed solutions',
+                        result='hit' if result else 'miss',
+                    )
+            if result is None:
+                result = valence_comp.oxi_state_guesses_most_possible(
+                    oxi_states_override=oxi_states_override,
+                    return_details=True,
+                    all_oxi_states=all_oxi_states,
+                    time_budget=time_budget,
+                    initial_solution=initial_solution,
+                )
+            oxi_state, is_usual, comments, oxi_details = result
+            if snapped_amts:
+                comments.append('amounts are snapped to simple fractions: ' + ', '.join(
+                    '{} {} -> {}'.format(el, amt, frac) for el, (amt, frac) in snapped_amts.items()
+                ))
         else:
             oxi_state = []
             is_usual = False
@@ -652,3 +1513,61 @@ class CompositionInHouse(Composition):
             return oxi_state, is_usual, comments
 
 
+class PlainComposition(object):
+    """
+    composition of integer amounts as a plain dict, solved by the methods of
+    CompositionInHouse without constructing a pymatgen Composition
+    """
+    __slots__ = ('el_amt', )
+
+    def __init__(self, el_amt):
+        """
+        :param el_amt: dict of {el: amount}
+        """
+        self.el_amt = el_amt
+
+    def __len__(self):
+        return len(self.el_amt)
+
+    def get_el_amt_dict(self):
+        return dict(self.el_amt)
+
+    def is_alloy(self):
+        return all(is_metal(el) for el in self.el_amt)
+
+    def get_oxid_state_guess_essentials(self,
+                                        oxi_states_override=None,
+                                        all_metal_oxi_states=False,
+                                        all_oxi_states=False,
+                                        max_sites=None,
+                                        add_compensator=False,
+                                        double_el_amt=False):
+        """
+        same as CompositionInHouse.get_oxid_state_guess_essentials()
+        """
+        if max_sites:
+            return self.to_composition().get_oxid_state_guess_essentials(
+                oxi_states_override=oxi_states_override,
+                all_metal_oxi_states=all_metal_oxi_states,
+                all_oxi_states=all_oxi_states,
+                max_sites=max_sites,
+                add_compensator=add_compensator,
+                double_el_amt=double_el_amt
+            )
+        return CompositionInHouse.get_oxid_state_guess_essentials_of_el_amt(
+            self.el_amt,
+            oxi_states_override=oxi_states_override,
+            all_metal_oxi_states=all_metal_oxi_states,
+            all_oxi_states=all_oxi_states,
+            add_compensator=add_compensator,
+            double_el_amt=double_el_amt
+        )
+
+    def to_composition(self):
+        """
+        :return: CompositionInHouse object, only built when asked for
+        """
+        return CompositionInHouse(self.el_amt)
+
+    oxi_state_guesses_most_possible = CompositionInHouse.oxi_state_guesses_most_possible
+    _oxi_state_guesses_most_possible = CompositionInHouse._oxi_state_guesses_most_possible
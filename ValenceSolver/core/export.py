@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+import ast
+import csv
+import math
+import os
+
+import numpy as np
+from pymatgen.core import Composition
+
+from .results import OxiStateResult
+
+"""
+Columnar export of solved compositions for analytics. Each row is one element of one
+composition with its amount, valence, is_usual flag, comment flags and the number of
+ions of each oxidation state (details of get_most_possible_oxi_state_of_composition()).
+Rows are written in chunks to a .npy file of a structured array, which can be appended
+to later and read with numpy.load(path, mmap_mode='r') without loading it into memory.
+Files ending with .csv are written with the same columns instead.
+
+    with ValenceExporter('valence.npy') as exporter:
+        for composition in compositions:
+            exporter.add(composition, CompositionInHouse.get_most_possible_oxi_state_of_composition(
+                composition, return_details=True
+            ))
+    rows = load_valence_rows('valence.npy')
+"""
+
+__author__ = 'Tanjin He'
+__maintainer__ = 'Tanjin He'
+__email__ = 'tanjin_he@berkeley.edu'
+
+# oxidation states with a column of ion counts
+MIN_OXI_STATE = -5
+MAX_OXI_STATE = 8
+OXI_STATES = tuple(range(MIN_OXI_STATE, MAX_OXI_STATE + 1))
+
+# comment_flags: bit i is set for the comment of code i in results.KNOWN_COMMENTS,
+# bit 0 for any other comment
+ROW_DTYPE = np.dtype([
+    ('composition_id', '<i8'),
+    ('element', 'S2'),
+    # amount in the composition, 0 for the compensator X
+    ('amount', '<f8'),
+    # nan if there is no solution
+    ('valence', '<f8'),
+    ('is_usual', '?'),
+    ('comment_flags', 'u1'),
+    ('ion_counts', '<f8', (len(OXI_STATES), )),
+])
+
+CSV_COLUMNS = [
+    name for name in ROW_DTYPE.names if name != 'ion_counts'
+] + ['ion_counts_{}'.format(state) for state in OXI_STATES]
+
+
+def _get_npy_header(num_rows, header_size=None):
+    """
+    :param num_rows: int
+    :param header_size: int. total size of the header. If None, the header is padded
+        to hold any number of rows, so that rows can be appended by rewriting the header
+    :return: bytes
+    """
+    header = "{{'descr': {}, 'fortran_order': False, 'shape': ({}, ), }}".format(
+        repr(np.lib.format.dtype_to_descr(ROW_DTYPE)),
+        num_rows,
+    )
+    prefix_size = len(np.lib.format.MAGIC_PREFIX) + 2 + 2
+    if header_size is None:
+        # room for the largest shape, aligned to 64 bytes
+        header_size = prefix_size + len(header) + 20 + 1
+        header_size = (header_size + 63) // 64 * 64
+    num_padding = header_size - prefix_size - len(header) - 1
+    if num_padding < 0:
+        raise ValueError('the header of the .npy file has no room for {} rows'.format(num_rows))
+    header = (header + ' ' * num_padding + '\n').encode('latin1')
+    return np.lib.format.magic(1, 0) + np.uint16(len(header)).tobytes() + header
+
+
+class _NpyWriter(object):
+    """
+    append rows to a .npy file. The header is rewritten after each chunk,
+    so the file is always a valid array of the rows written so far.
+    """
+
+    def __init__(self, path):
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            self.fw = open(path, 'r+b')
+            version = np.lib.format.read_magic(self.fw)
+            if version == (1, 0):
+                shape, _, dtype = np.lib.format.read_array_header_1_0(self.fw)
+            else:
+                shape, _, dtype = np.lib.format.read_array_header_2_0(self.fw)
+            if dtype != ROW_DTYPE:
+                raise ValueError('{} is not an export of valence'.format(path))
+            self.header_size = self.fw.tell()
+            self.num_rows = shape[0]
+            # rows written after the last update of the header are incomplete
+            self.fw.truncate(self.header_size + self.num_rows * ROW_DTYPE.itemsize)
+        else:
+            self.fw = open(path, 'w+b')
+            self.num_rows = 0
+            self.header_size = len(_get_npy_header(0))
+            self._write_header()
+
+    def _write_header(self):
+        self.fw.seek(0)
+        self.fw.write(_get_npy_header(self.num_rows, self.header_size))
+
+    def get_last_composition_id(self):
+        if self.num_rows == 0:
+            return -1
+        self.fw.seek(self.header_size + (self.num_rows - 1) * ROW_DTYPE.itemsize)
+        return int(np.frombuffer(self.fw.read(ROW_DTYPE.itemsize), dtype=ROW_DTYPE)['composition_id'][0])
+
+    def append(self, rows):
+        self.fw.seek(0, os.SEEK_END)
+        self.fw.write(rows.tobytes())
+        self.fw.flush()
+        self.num_rows += len(rows)
+        self._write_header()
+        self.fw.flush()
+
+    def close(self):
+        self.fw.close()
+
+
+class _CSVWriter(object):
+
+    def __init__(self, path):
+        self.last_composition_id = -1
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, 'r', newline='') as fr:
+                for row in csv.DictReader(fr):
+                    self.last_composition_id = int(row['composition_id'])
+            self.fw = open(path, 'a', newline='')
+            self.writer = csv.writer(self.fw)
+        else:
+            self.fw = open(path, 'w', newline='')
+            self.writer = csv.writer(self.fw)
+            self.writer.writerow(CSV_COLUMNS)
+
+    def get_last_composition_id(self):
+        return self.last_composition_id
+
+    def append(self, rows):
+        for row in rows.tolist():
+            *values, ion_counts = row
+            values[1] = values[1].decode('ascii')
+            self.writer.writerow(values + list(ion_counts))
+        self.fw.flush()
+
+    def close(self):
+        self.fw.close()
+
+
+class ValenceExporter(object):
+    """
+    write results of compositions as rows of ROW_DTYPE in chunks.
+    An existing file is appended to, with composition ids continuing from the last one.
+    """
+
+    def __init__(self, path, file_format=None, chunk_size=10000):
+        """
+        :param path: str
+        :param file_format: 'npy' or 'csv'. If None, decided by the extension of path
+        :param chunk_size: int. number of rows kept in memory before writing
+        """
+        if file_format is None:
+            file_format = 'csv' if path.endswith('.csv') else 'npy'
+        if file_format == 'npy':
+            self.writer = _NpyWriter(path)
+        elif file_format == 'csv':
+            self.writer = _CSVWriter(path)
+        else:
+            raise ValueError('unknown file format: {}'.format(file_format))
+        self.chunk_size = chunk_size
+        self.next_composition_id = self.writer.get_last_composition_id() + 1
+        self.buffer = []
+
+    def add(self, composition, result):
+        """
+        :param composition: str or dict of {ele: amount}
+        :param result: OxiStateResult or returned values of
+            get_most_possible_oxi_state_of_composition(), preferably with return_details=True
+        :return: int. id of the composition
+        """
+        if not isinstance(result, OxiStateResult):
+            result = OxiStateResult(*result)
+        if isinstance(composition, str):
+            composition = Composition(composition).get_el_amt_dict()
+        valence = result.valence or {}
+        comment_flags = 0
+        for code in result.comment_codes:
+            comment_flags |= 1 << code
+        ion_counts = {}
+        for (el, state), num in result.details.items():
+            if state < MIN_OXI_STATE or state > MAX_OXI_STATE:
+                raise ValueError('oxidation state {} of {} has no column'.format(state, el))
+            ion_counts.setdefault(el, [0.0] * len(OXI_STATES))[state - MIN_OXI_STATE] = num
+
+        composition_id = self.next_composition_id
+        self.next_composition_id += 1
+        elements = list(composition) + [el for el in ion_counts if el not in composition]
+        for el in elements:
+            self.buffer.append((
+                composition_id,
+                el.encode('ascii'),
+                composition.get(el, 0.0),
+                valence.get(el, math.nan),
+                result.is_usual,
+                comment_flags,
+                ion_counts.get(el, [0.0] * len(OXI_STATES)),
+            ))
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+        return composition_id
+
+    def flush(self):
+        if self.buffer:
+            self.writer.append(np.array(self.buffer, dtype=ROW_DTYPE))
+            self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def export_valence_results(items, path, **kwargs):
+    """
+    :param items: iterable of (composition, result) as parameters of ValenceExporter.add()
+    :param path: str
+    :param kwargs: other parameters of ValenceExporter
+    :return: int. number of compositions exported
+    """
+    num_compositions = 0
+    with ValenceExporter(path, **kwargs) as exporter:
+        for composition, result in items:
+            exporter.add(composition, result)
+            num_compositions += 1
+    return num_compositions
+
+
+def load_valence_rows(path, mmap=True):
+    """
+    :param path: str. .npy or .csv file written by ValenceExporter
+    :param mmap: bool. memory map a .npy file instead of reading it
+    :return: structured numpy array of ROW_DTYPE
+    """
+    if not path.endswith('.csv'):
+        return np.load(path, mmap_mode='r' if mmap else None)
+    rows = []
+    with open(path, 'r', newline='') as fr:
+        reader = csv.reader(fr)
+        next(reader)
+        for row in reader:
+            rows.append((
+                int(row[0]),
+                row[1].encode('ascii'),
+                float(row[2]),
+                float(row[3]),
+                ast.literal_eval(row[4]),
+                int(row[5]),
+                [float(x) for x in row[6:]],
+            ))
+    return np.array(rows, dtype=ROW_DTYPE)
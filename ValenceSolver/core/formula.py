@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import math
+import re
+from collections import defaultdict
+from functools import lru_cache
+from numbers import Real
+
+from monty.fractions import gcd_float
+from pymatgen.core import Composition
+from pymatgen.core.periodic_table import Element, get_el_sp
+
+"""
+Fast ingestion of compositions without constructing pymatgen Composition objects.
+Plain dicts of {symbol: amount} and simple formulas such as Nb(PO4)3 are parsed and
+integerized here with the same results and the same order of elements as
+Composition(...).get_integer_formula_and_factor(). Anything else (e.g. species or
+unusual notations) is left to pymatgen by returning None.
+"""
+
+__author__ = 'Tanjin He'
+__maintainer__ = 'Tanjin He'
+__email__ = 'tanjin_he@berkeley.edu'
+
+# the same patterns as the formula parser of pymatgen
+FORMULA_INVALID_RE = re.compile(r'[\s\d.*/]*$')
+FORMULA_GROUP_RE = re.compile(r'([A-Z][a-z]*)\s*([-*\.e\d]*)')
+FORMULA_PAREN_RE = re.compile(r'\(([^\(\)]+)\)\s*([\.e\d]*)')
+
+ELEMENT_SYMBOLS = frozenset(el.symbol for el in Element)
+
+
+def _get_sym_dict(formula, factor):
+    sym_dict = defaultdict(float)
+    for match in FORMULA_GROUP_RE.finditer(formula):
+        amt = 1.0
+        if match.group(2).strip() != '':
+            amt = float(match.group(2))
+        sym_dict[match.group(1)] += amt * factor
+        formula = formula.replace(match.group(), '', 1)
+    if formula.strip():
+        raise ValueError('{} is an invalid formula!'.format(formula))
+    return sym_dict
+
+
+@lru_cache(maxsize=65536)
+def parse_formula(formula):
+    """
+    :param formula: str. e.g. 'Fe2O3', 'Li3Fe2(PO4)3'
+    :return: tuple of (symbol, amount) in the order of pymatgen, or None if the formula
+        is not a simple formula of elements
+    """
+    if FORMULA_INVALID_RE.match(formula):
+        return None
+    formula = formula.replace('@', '').translate(str.maketrans('[]{}', '()()'))
+    try:
+        match = FORMULA_PAREN_RE.search(formula)
+        while match:
+            factor = 1.0
+            if match.group(2) != '':
+                factor = float(match.group(2))
+            unit_sym_dict = _get_sym_dict(match.group(1), factor)
+            expanded_sym = ''.join('{}{}'.format(el, amt) for el, amt in unit_sym_dict.items())
+            formula = formula.replace(match.group(), expanded_sym, 1)
+            match = FORMULA_PAREN_RE.search(formula)
+        sym_dict = _get_sym_dict(formula, 1)
+    except ValueError:
+        return None
+    if not all(el in ELEMENT_SYMBOLS for el in sym_dict):
+        return None
+    return tuple(sym_dict.items())
+
+
+def get_el_amt(composition):
+    """
+    :param composition: plain dict of {symbol: amount} or str of a formula
+    :return: dict of {symbol: amount} the same as Composition(composition).get_el_amt_dict(),
+        or None if pymatgen is needed to interpret the composition
+    """
+    if isinstance(composition, str):
+        items = parse_formula(composition)
+    elif isinstance(composition, dict):
+        items = composition.items()
+    else:
+        return None
+    if items is None:
+        return None
+    el_amt = {}
+    for el, amt in items:
+        if (el not in ELEMENT_SYMBOLS
+            or not isinstance(amt, Real)
+            or isinstance(amt, bool)
+            or math.isnan(amt)
+            or amt < -Composition.amount_tolerance):
+            return None
+        if abs(amt) >= Composition.amount_tolerance:
+            el_amt[el] = el_amt.get(el, 0.0) + float(amt)
+    return el_amt
+
+
+@lru_cache(maxsize=None)
+def is_metal(el):
+    return Element(el).is_metal
+
+
+@lru_cache(maxsize=None)
+def get_sort_key(el):
+    """
+    :return: key to order elements as pymatgen, by electronegativity and then by symbol
+    """
+    x = get_el_sp(el).X
+    return float('inf') if math.isnan(x) else x, el
+
+
+@lru_cache(maxsize=65536)
+def _get_integer_el_amt(el_amt_items, max_denominator):
+    el_amt = dict(el_amt_items)
+    _gcd = gcd_float(list(el_amt.values()), 1 / max_denominator)
+    int_amt = {el: round(amt / _gcd) for el, amt in el_amt.items()}
+    els = sorted(int_amt, key=get_sort_key)
+    els = [el for el in els if abs(int_amt[el]) > Composition.amount_tolerance]
+    factor = abs(math.gcd(*int_amt.values()))
+    reduced_amt = tuple((el, float(int_amt[el] / factor)) for el in els)
+    # formula without the grouping of polyanions, which only appears in special formulas
+    formula = ''.join(
+        el + ('' if amt == 1 else str(round(amt))) for el, amt in reduced_amt
+    )
+    if formula in Composition.special_formulas:
+        reduced_amt = parse_formula(Composition.special_formulas[formula])
+        factor /= 2
+    return reduced_amt, factor * _gcd
+
+
+def get_integer_el_amt(el_amt, max_denominator=10000):
+    """
+    integerize a composition without constructing pymatgen objects
+
+    :param el_amt: dict of {symbol: amount}
+    :param max_denominator: int. same as Composition.get_integer_formula_and_factor()
+    :return: (integer_el_amt, factor)
+        integer_el_amt: dict of {symbol: amount}. the same as
+            Composition(Composition(el_amt).get_integer_formula_and_factor()[0]).get_el_amt_dict()
+        factor: float. el_amt is integer_el_amt * factor
+    """
+    reduced_amt, factor = _get_integer_el_amt(tuple(el_amt.items()), max_denominator)
+    return dict(reduced_amt), factor
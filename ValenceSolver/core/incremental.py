@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+
+from .utils import get_composition_and_fraction_vars
+from .utils import to_GeneralMat_obj, get_material_valence
+
+"""
+Incremental annotation of valence across versions of a dataset.
+Each material is identified by a key (e.g. reaction id + role) and its input is hashed
+after normalization. The index from the previous run maps keys to hashes and hashes
+to valence, so that only new or changed materials are solved again.
+"""
+
+__author__ = 'Tanjin He'
+__maintainer__ = 'Tanjin He'
+__email__ = 'tanjin_he@berkeley.edu'
+
+# bump when the solver changes so that old indexes are not reused
+INDEX_VERSION = 1
+
+
+def hash_material_input(composition, amounts_vars=None, elements_vars=None):
+    """
+    hash of the normalized input of a material. Fields not affecting the valence
+    (e.g. 'formula') and the order of keys are ignored.
+
+    :param composition: same as to_GeneralMat_obj()
+    :param amounts_vars: same as to_GeneralMat_obj()
+    :param elements_vars: same as to_GeneralMat_obj()
+    :return: str. sha1 hex digest
+    """
+    composition, fraction_vars = get_composition_and_fraction_vars(
+        composition,
+        amounts_vars=amounts_vars,
+        elements_vars=elements_vars,
+    )
+    normalized = json.dumps(
+        {'composition': composition, 'fraction_vars': fraction_vars},
+        sort_keys=True,
+    )
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+
+def get_empty_index():
+    return {'version': INDEX_VERSION, 'materials': {}, 'valence': {}}
+
+
+def load_valence_index(path):
+    """
+    :param path: str. json file written by save_valence_index()
+    :return: dict of {'version': int, 'materials': {key: hash}, 'valence': {hash: valence}}.
+        An empty index if the file does not exist or is from another version.
+    """
+    if not os.path.exists(path):
+        return get_empty_index()
+    with open(path, 'r') as fr:
+        index = json.load(fr)
+    if index.get('version') != INDEX_VERSION:
+        return get_empty_index()
+    return index
+
+
+def save_valence_index(index, path):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as fw:
+        json.dump(index, fw)
+    os.replace(tmp_path, path)
+
+
+def annotate_materials_incrementally(materials, index=None, valence_cache=None):
+    """
+    solve valence of materials, reusing the results in the index of the previous run
+    for materials whose input is unchanged
+
+    :param materials: dict of {key: {'composition': ..., 'amounts_vars': ...,
+        'elements_vars': ...}}. key is a str identifying the material across versions
+    :param index: dict from load_valence_index(). None to solve all materials
+    :param valence_cache: dict. cache of solved compositions, see get_material_valence()
+    :return: (all_valence, new_index, report)
+        all_valence: dict of {key: valence}. valence is the same as get_material_valence()
+        new_index: index of this run, to be saved by save_valence_index()
+        report: dict of
+            'added': list of keys not in the previous index
+            'removed': list of keys in the previous index but not in materials
+            'changed': list of {'key': key, 'old': valence, 'new': valence} for materials
+                with a changed input and a different valence
+            'num_reused': number of materials not solved again
+            'num_solved': number of materials solved
+    """
+    index = index or get_empty_index()
+    if valence_cache is None:
+        valence_cache = {}
+    new_index = get_empty_index()
+    all_valence = {}
+    report = {
+        'added': [],
+        'removed': sorted(set(index['materials']) - set(materials)),
+        'changed': [],
+        'num_reused': 0,
+        'num_solved': 0,
+    }
+    for key, material in materials.items():
+        composition = material['composition']
+        amounts_vars = material.get('amounts_vars')
+        elements_vars = material.get('elements_vars')
+        input_hash = hash_material_input(composition, amounts_vars, elements_vars)
+        if input_hash in new_index['valence']:
+            valence = new_index['valence'][input_hash]
+            report['num_reused'] += 1
+        elif input_hash in index['valence']:
+            valence = index['valence'][input_hash]
+            report['num_reused'] += 1
+        else:
+            tmp_mat_obj = to_GeneralMat_obj(
+                composition=composition,
+                amounts_vars=amounts_vars,
+                elements_vars=elements_vars
+            )
+            valence = get_material_valence(tmp_mat_obj, valence_cache=valence_cache)
+            report['num_solved'] += 1
+        new_index['materials'][key] = input_hash
+        new_index['valence'][input_hash] = valence
+        all_valence[key] = valence
+
+        old_hash = index['materials'].get(key)
+        if old_hash is None:
+            report['added'].append(key)
+        elif old_hash != input_hash:
+            old_valence = index['valence'].get(old_hash)
+            if old_valence != valence:
+                report['changed'].append({'key': key, 'old': old_valence, 'new': valence})
+    return all_valence, new_index, report
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+import collections
+import copy
+import hashlib
+import json
+import os
+
+from . import metrics
+from .utils import to_GeneralMat_obj, get_material_valence
+
+"""
+Cache of the valence of whole materials, one level above the valence_cache of compositions.
+A material is keyed by a hash of its raw input (composition, amounts_vars, elements_vars),
+so that a repeated mention is answered without to_GeneralMat_obj(), the expansion into
+critical compositions and the merge of their valence. The cache is a LRU of bounded size
+and can be saved to and loaded from a json file.
+
+    material_cache = MaterialValenceCache(max_size=100000, path='generated/material_cache.json')
+    valence = material_cache.get_material_valence(composition, amounts_vars, elements_vars)
+    material_cache.save()
+"""
+
+__author__ = 'Tanjin He'
+__maintainer__ = 'Tanjin He'
+__email__ = 'tanjin_he@berkeley.edu'
+
+# bump when the solver changes so that old files are not reused
+CACHE_VERSION = 1
+
+MATERIAL_CACHE_REQUESTS_HELP = 'Number of lookups of materials in the material valence cache'
+
+
+def get_material_key(composition, amounts_vars=None, elements_vars=None):
+    """
+    hash of the input of a material. Only fields used by to_GeneralMat_obj() are kept
+    (e.g. 'formula' is ignored) and keys are sorted. Unlike hash_material_input() in
+    incremental.py, expressions are not parsed, so the key is cheap to compute but
+    equivalent expressions written differently have different keys.
+
+    :param composition: same as to_GeneralMat_obj()
+    :param amounts_vars: same as to_GeneralMat_obj()
+    :param elements_vars: same as to_GeneralMat_obj()
+    :return: str. sha1 hex digest
+    """
+    if isinstance(composition, dict):
+        # the amount of a single composition is ignored by to_GeneralMat_obj()
+        structs = {'elements': composition['elements']}
+    else:
+        structs = [
+            {'elements': tmp_struct['elements'], 'amount': tmp_struct.get('amount', '1.0')}
+            for tmp_struct in composition
+        ]
+    fraction_vars = {
+        k: [v.get('values') or [], v.get('min_value'), v.get('max_value')]
+        for k, v in (amounts_vars or {}).items()
+    }
+    normalized = json.dumps(
+        [structs, fraction_vars, elements_vars or {}],
+        sort_keys=True,
+    )
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+
+class MaterialValenceCache(object):
+    """
+    LRU cache of {material key: valence}, valence as returned by get_material_valence().
+    Values are copied in and out, so that callers may modify the returned valence.
+    """
+
+    def __init__(self, max_size=100000, path=None):
+        """
+        :param max_size: int. maximum number of materials, the least recently used
+            ones are evicted
+        :param path: str. json file to load the cache from if it exists, and the
+            default path of save()
+        """
+        self.max_size = max_size
+        self.path = path
+        self._entries = collections.OrderedDict()
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """
+        :param key: str from get_material_key()
+        :return: valence of the material, or default if it is not cached
+        """
+        if key not in self._entries:
+            metrics.inc('valence_solver_material_cache_requests',
+                        help_text=MATERIAL_CACHE_REQUESTS_HELP, result='miss')
+            return default
+        metrics.inc('valence_solver_material_cache_requests',
+                    help_text=MATERIAL_CACHE_REQUESTS_HELP, result='hit')
+        self._entries.move_to_end(key)
+        return copy.deepcopy(self._entries[key])
+
+    def put(self, key, valence):
+        """
+        :param key: str from get_material_key()
+        :param valence: list of valence dicts or None, as returned by get_material_valence()
+        """
+        self._entries[key] = copy.deepcopy(valence)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def get_material_valence(self, composition, amounts_vars=None, elements_vars=None,
+                             valence_cache=None, time_budget=None):
+        """
+        the same as get_material_valence(to_GeneralMat_obj(...)), answered from the cache
+        when the same input was solved before. Results cut by the time budget are not cached.
+
+        :param composition: same as to_GeneralMat_obj()
+        :param amounts_vars: same as to_GeneralMat_obj()
+        :param elements_vars: same as to_GeneralMat_obj()
+        :param valence_cache: same as get_material_valence()
+        :param time_budget: same as get_material_valence()
+        :return: list of valence dicts or None
+        """
+        key = get_material_key(composition, amounts_vars, elements_vars)
+        if key in self._entries:
+            return self.get(key)
+        metrics.inc('valence_solver_material_cache_requests',
+                    help_text=MATERIAL_CACHE_REQUESTS_HELP, result='miss')
+        tmp_mat_obj = to_GeneralMat_obj(
+            composition=composition,
+            amounts_vars=amounts_vars,
+            elements_vars=elements_vars
+        )
+        valence, timed_out = get_material_valence(
+            tmp_mat_obj,
+            valence_cache=valence_cache,
+            time_budget=time_budget,
+            return_timed_out=True,
+        )
+        if not timed_out:
+            self.put(key, valence)
+        return valence
+
+    def load(self, path):
+        """
+        add the materials in a json file written by save(). A file of another version
+        is ignored.
+
+        :param path: str
+        """
+        with open(path, 'r') as fr:
+            data = json.load(fr)
+        if data.get('version') != CACHE_VERSION:
+            return
+        # entries are saved from the least to the most recently used
+        for key, valence in data['materials']:
+            self._entries[key] = valence
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def save(self, path=None):
+        """
+        :param path: str. self.path if None
+        """
+        path = path or self.path
+        if path is None:
+            raise ValueError('no path to save the material cache')
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as fw:
+            json.dump({'version': CACHE_VERSION, 'materials': list(self._entries.items())}, fw)
+        os.replace(tmp_path, path)
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+import os
+import bisect
+import threading
+import time
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+"""
+Solver telemetry in Prometheus/OpenMetrics text format.
+Metrics are always collected. Each update is a dict lookup and an addition
+under a lock, so that it is cheap enough to stay on in production.
+Expose them with get_metrics_text(), write_textfile() for the textfile
+collector of node_exporter, or start_http_server() for a local endpoint.
+"""
+
+__author__ = 'Tanjin He'
+__maintainer__ = 'Tanjin He'
+__email__ = 'tanjin_he@berkeley.edu'
+
+
+# upper bounds of latency buckets in seconds
+LATENCY_BUCKETS = (
+    0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0
+)
+
+_lock = threading.Lock()
+# name -> (type, help)
+_families = {}
+# name -> {labels: value}, labels is a tuple of (key, value)
+_counters = {}
+# name -> {labels: [bucket counts..., sum, count]}
+_histograms = {}
+
+
+def _register(name, metric_type, help_text):
+    if name not in _families:
+        _families[name] = (metric_type, help_text)
+
+
+def inc(name, value=1, help_text='', **labels):
+    """
+    increase a counter
+
+    :param name: str. name of the counter without the suffix _total
+    :param value: number to add
+    :param help_text: str. description of the counter
+    :param labels: label values of the sample
+    """
+    key = tuple(sorted(labels.items()))
+    with _lock:
+        _register(name, 'counter', help_text)
+        samples = _counters.setdefault(name, {})
+        samples[key] = samples.get(key, 0) + value
+
+
+def observe(name, value, help_text='', buckets=LATENCY_BUCKETS, **labels):
+    """
+    add an observation to a histogram
+
+    :param name: str. name of the histogram
+    :param value: float. observed value, e.g. latency in seconds
+    :param help_text: str. description of the histogram
+    :param buckets: tuple of upper bounds of buckets
+    :param labels: label values of the sample
+    """
+    key = tuple(sorted(labels.items()))
+    index = bisect.bisect_left(buckets, value)
+    with _lock:
+        _register(name, 'histogram', help_text)
+        samples = _histograms.setdefault(name, {})
+        if key not in samples:
+            samples[key] = [buckets, [0] * len(buckets), 0.0, 0]
+        sample = samples[key]
+        if index < len(buckets):
+            sample[1][index] += 1
+        sample[2] += value
+        sample[3] += 1
+
+
+def timed(name, help_text=''):
+    """
+    decorator to record the latency of a function in a histogram
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - start, help_text=help_text)
+        return wrapper
+    return decorator
+
+
+def get_counter(name, **labels):
+    """
+    :return: current value of a counter, 0 if never increased
+    """
+    key = tuple(sorted(labels.items()))
+    with _lock:
+        return _counters.get(name, {}).get(key, 0)
+
+
+def get_histogram(name, **labels):
+    """
+    :return: dict of {'buckets': {upper bound: cumulative count}, 'sum': float, 'count': int}
+        or None if nothing is observed
+    """
+    key = tuple(sorted(labels.items()))
+    with _lock:
+        sample = _histograms.get(name, {}).get(key)
+        if sample is None:
+            return None
+        buckets, counts, total, count = sample
+        cumulative = {}
+        num = 0
+        for bound, bucket_count in zip(buckets, counts):
+            num += bucket_count
+            cumulative[bound] = num
+        cumulative[float('inf')] = count
+        return {'buckets': cumulative, 'sum': total, 'count': count}
+
+
+def reset():
+    """
+    clear all metrics
+    """
+    with _lock:
+        _families.clear()
+        _counters.clear()
+        _histograms.clear()
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(
+            k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        )
+        for k, v in labels
+    ) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def get_metrics_text(openmetrics=False):
+    """
+    all metrics in the Prometheus text exposition format
+
+    :param openmetrics: bool. if True, use the OpenMetrics format instead, where counter
+        families are named without the suffix _total and the text ends with # EOF
+    :return: str
+    """
+    lines = []
+    with _lock:
+        for name in sorted(_families):
+            metric_type, help_text = _families[name]
+            family = name if (openmetrics or metric_type != 'counter') else name + '_total'
+            if help_text:
+                lines.append('# HELP {} {}'.format(family, help_text))
+            lines.append('# TYPE {} {}'.format(family, metric_type))
+            if metric_type == 'counter':
+                for labels, value in sorted(_counters.get(name, {}).items()):
+                    lines.append('{}_total{} {}'.format(
+                        name, _format_labels(labels), _format_value(value)
+                    ))
+            else:
+                for labels, (buckets, counts, total, count) in sorted(_histograms.get(name, {}).items()):
+                    cumulative = 0
+                    for bound, bucket_count in zip(buckets, counts):
+                        cumulative += bucket_count
+                        lines.append('{}_bucket{} {}'.format(
+                            name, _format_labels(labels, [('le', _format_value(float(bound)))]), cumulative
+                        ))
+                    lines.append('{}_bucket{} {}'.format(
+                        name, _format_labels(labels, [('le', '+Inf')]), count
+                    ))
+                    lines.append('{}_sum{} {}'.format(name, _format_labels(labels), _format_value(total)))
+                    lines.append('{}_count{} {}'.format(name, _format_labels(labels), count))
+    if openmetrics:
+        lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(path):
+    """
+    write all metrics to a file for the textfile collector of node_exporter.
+    The file is written to a temporary file first and then renamed, so that
+    the collector never reads a partial file.
+
+    :param path: str. path of the .prom file
+    """
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as fw:
+        fw.write(get_metrics_text())
+    os.replace(tmp_path, path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        openmetrics = 'application/openmetrics-text' in self.headers.get('Accept', '')
+        body = get_metrics_text(openmetrics=openmetrics).encode('utf-8')
+        self.send_response(200)
+        if openmetrics:
+            self.send_header('Content-Type', 'application/openmetrics-text; version=1.0.0; charset=utf-8')
+        else:
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, addr='127.0.0.1'):
+    """
+    serve the metrics on http://addr:port/ from a daemon thread
+
+    :return: HTTPServer. call shutdown() to stop it
+    """
+    server = HTTPServer((addr, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
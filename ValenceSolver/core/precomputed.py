@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+import argparse
+import bisect
+import hashlib
+import itertools
+import json
+import mmap
+import os
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from math import gcd
+from functools import reduce
+
+"""
+Precomputed solutions of oxi_state_guesses_most_possible for common compositions.
+The index is a binary file, memory-mapped and searched by bisection, so that a worker
+answers common compositions with no solver call and without loading the whole file.
+
+File layout (little endian):
+    header: magic (8 bytes), fingerprint of the solver (16 bytes),
+        number of entries n (uint64), key size (uint64)
+    keys: n sorted keys, each padded with b'\\0' to the key size
+    offsets: n + 1 uint64 offsets of values relative to the start of values
+    values: json of (oxi_state, is_usual, comments, oxi_details) for each key
+
+An index whose fingerprint differs from the current solver (i.e. built from another
+oxi_prob table, SOLVER_VERSION or version of pymatgen) or written in another format
+is not used.
+
+Build the default index next to icsd_bv.yaml with
+    python -m ValenceSolver.core.precomputed
+"""
+
+__author__ = 'Tanjin He'
+__maintainer__ = 'Tanjin He'
+__email__ = 'tanjin_he@berkeley.edu'
+
+MAGIC = b'VSIDX002'
+HEADER = struct.Struct('<8s16sQQ')
+# bump when the solution of a composition changes, so that old indexes are not used
+SOLVER_VERSION = 1
+OFFSET = struct.Struct('<Q')
+DEFAULT_INDEX_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'analysis', 'oxi_state_index.bin'
+)
+# elements of common precursors and simple oxides, carbonates, nitrates, phosphates, etc.
+DEFAULT_ELEMENTS = [
+    'H', 'Li', 'B', 'C', 'N', 'O', 'F', 'Na', 'Mg', 'Al', 'Si', 'P', 'S', 'Cl', 'K',
+    'Ca', 'Ti', 'V', 'Cr', 'Mn', 'Fe', 'Co', 'Ni', 'Cu', 'Zn', 'Ga', 'Ge', 'Sr', 'Y',
+    'Zr', 'Nb', 'Mo', 'Ag', 'In', 'Sn', 'Sb', 'Ba', 'La', 'Ce', 'Nd', 'W', 'Bi',
+]
+DEFAULT_MAX_ATOMS = 9
+DEFAULT_MAX_ELEMENTS = 3
+
+_index_lock = threading.Lock()
+_fingerprint = None
+# path -> PrecomputedIndex or None if the file does not exist
+_loaded_indexes = {}
+
+
+def get_solver_fingerprint():
+    """
+    :return: bytes. hash of SOLVER_VERSION, the oxi_prob table, the parameters of
+        the relaxation and the oxidation states of elements in pymatgen (with its
+        version), written into the header of an index
+    """
+    global _fingerprint
+    if _fingerprint is None:
+        import pymatgen.core
+        from pymatgen.core.periodic_table import Element
+        from .composition_inhouse import CompositionInHouse
+
+        CompositionInHouse.load_oxi_prob()
+        content = json.dumps([
+            SOLVER_VERSION,
+            CompositionInHouse.LARGE_PROBABILITY,
+            CompositionInHouse.X_valence_warning_level,
+            sorted((str(sp), prob) for sp, prob in CompositionInHouse.oxi_prob.items()),
+            pymatgen.core.__version__,
+            [
+                [el.symbol, el.icsd_oxidation_states, el.oxidation_states, el.is_metal]
+                for el in Element
+            ],
+        ])
+        _fingerprint = hashlib.blake2b(content.encode('utf-8'), digest_size=16).digest()
+    return _fingerprint
+
+
+def get_composition_key(el_amt):
+    """
+    :param el_amt: dict of {el: amount}. amounts must be integers
+    :return: bytes. canonical key, e.g. b'Fe2O3', or None if amounts are not integers
+    """
+    key = []
+    for el in sorted(el_amt):
+        amt = el_amt[el]
+        if amt != int(amt):
+            return None
+        key.append('{}{}'.format(el, int(amt)))
+    return ''.join(key).encode('ascii')
+
+
+def encode_result(oxi_state, is_usual, comments, oxi_details):
+    return json.dumps([
+        oxi_state,
+        is_usual,
+        comments,
+        [[[el, state, amt] for (el, state), amt in details.items()] for details in oxi_details],
+    ], separators=(',', ':')).encode('utf-8')
+
+
+def decode_result(value):
+    oxi_state, is_usual, comments, oxi_details = json.loads(value.decode('utf-8'))
+    oxi_details = [
+        {(el, state): amt for el, state, amt in details} for details in oxi_details
+    ]
+    return oxi_state, is_usual, comments, oxi_details
+
+
+class PrecomputedIndex(object):
+    """
+    read-only view of an index file. Keys are compared as bytes in the memory map,
+    so that lookups cost O(log n) and only touch the pages needed.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as fr:
+            self._mmap = mmap.mmap(fr.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            self._mmap.close()
+            raise ValueError('{} is not an index of oxidation states of this version'.format(path))
+        _, self.fingerprint, self.num_entries, self.key_size = HEADER.unpack_from(self._mmap, 0)
+        self._keys_start = HEADER.size
+        self._offsets_start = self._keys_start + self.num_entries * self.key_size
+        self._values_start = self._offsets_start + (self.num_entries + 1) * OFFSET.size
+
+    def __len__(self):
+        return self.num_entries
+
+    def __getitem__(self, i):
+        """
+        :return: bytes. the i-th key, used by bisect
+        """
+        start = self._keys_start + i * self.key_size
+        return self._mmap[start: start + self.key_size].rstrip(b'\0')
+
+    def get_value(self, i):
+        start, end = struct.unpack_from('<QQ', self._mmap, self._offsets_start + i * OFFSET.size)
+        return self._mmap[self._values_start + start: self._values_start + end]
+
+    def lookup(self, el_amt):
+        """
+        :param el_amt: dict of {el: amount} of the integer composition to solve
+        :return: (oxi_state, is_usual, comments, oxi_details) or None if not in the index
+        """
+        key = get_composition_key(el_amt)
+        if key is None or len(key) > self.key_size:
+            return None
+        i = bisect.bisect_left(self, key)
+        if i < self.num_entries and self[i] == key:
+            return decode_result(self.get_value(i))
+        return None
+
+    def close(self):
+        self._mmap.close()
+
+
+def get_precomputed_index(path=None):
+    """
+    :param path: str. path of the index file. DEFAULT_INDEX_PATH by default
+    :return: PrecomputedIndex or None if the file does not exist, is in another format,
+        or is built by another version of the solver. The index is opened once per path
+        and shared by all threads.
+    """
+    path = path or DEFAULT_INDEX_PATH
+    if path not in _loaded_indexes:
+        with _index_lock:
+            if path not in _loaded_indexes:
+                _loaded_indexes[path] = _open_index(path)
+    return _loaded_indexes[path]
+
+
+def _open_index(path):
+    if not os.path.exists(path):
+        return None
+    try:
+        index = PrecomputedIndex(path)
+    except ValueError:
+        return None
+    if index.fingerprint != get_solver_fingerprint():
+        index.close()
+        return None
+    return index
+
+
+def write_index(entries, path, fingerprint=None):
+    """
+    :param entries: dict of {key: value} in bytes
+    :param path: str. path of the index file
+    :param fingerprint: bytes. get_solver_fingerprint() by default
+    """
+    fingerprint = fingerprint or get_solver_fingerprint()
+    keys = sorted(entries)
+    key_size = max([len(k) for k in keys] + [1])
+    values = [entries[k] for k in keys]
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as fw:
+        fw.write(HEADER.pack(MAGIC, fingerprint, len(keys), key_size))
+        for k in keys:
+            fw.write(k.ljust(key_size, b'\0'))
+        offset = 0
+        fw.write(OFFSET.pack(offset))
+        for v in values:
+            offset += len(v)
+            fw.write(OFFSET.pack(offset))
+        for v in values:
+            fw.write(v)
+    os.replace(tmp_path, path)
+
+
+def enumerate_compositions(elements, max_atoms, max_elements, required_elements=None):
+    """
+    all reduced integer compositions with at most max_atoms atoms and
+    at most max_elements elements
+
+    :param elements: list of element symbols
+    :param required_elements: list of element symbols. if given, only compositions
+        containing at least one of them are enumerated
+    :return: generator of dicts {el: amount}
+    """
+    required_elements = set(required_elements or [])
+    for num_els in range(1, max_elements + 1):
+        for els in itertools.combinations(sorted(elements), num_els):
+            if required_elements and not required_elements & set(els):
+                continue
+            for amts in itertools.product(range(1, max_atoms - num_els + 2), repeat=num_els):
+                if sum(amts) > max_atoms or reduce(gcd, amts) != 1:
+                    continue
+                yield dict(zip(els, amts))
+
+
+def solve_composition(el_amt, time_budget=None):
+    """
+    :return: (key, value) of the index, or None if the solution is not complete
+    """
+    from .composition_inhouse import CompositionInHouse
+
+    formula, _ = CompositionInHouse(el_amt).get_integer_formula_and_factor()
+    valence_comp = CompositionInHouse(formula)
+    result = valence_comp.oxi_state_guesses_most_possible(
+        return_details=True,
+        time_budget=time_budget,
+    )
+    if CompositionInHouse.TIME_BUDGET_WARNING in result[2]:
+        return None
+    return get_composition_key(valence_comp.get_el_amt_dict()), encode_result(*result)
+
+
+def build_index(path=None,
+                elements=None,
+                max_atoms=DEFAULT_MAX_ATOMS,
+                max_elements=DEFAULT_MAX_ELEMENTS,
+                required_elements=('O', ),
+                max_workers=None,
+                time_budget=60):
+    """
+    precompute the solutions of compositions enumerated by enumerate_compositions()
+    and write them to an index file
+
+    :param path: str. DEFAULT_INDEX_PATH by default
+    :param elements: list of element symbols. DEFAULT_ELEMENTS by default
+    :param max_workers: int. number of threads solving in parallel
+    :param time_budget: float. maximum seconds for each composition. Compositions
+        not solved within the budget are not stored.
+    :return: int. number of entries
+    """
+    path = path or DEFAULT_INDEX_PATH
+    elements = elements or DEFAULT_ELEMENTS
+    all_el_amt = list(enumerate_compositions(
+        elements, max_atoms, max_elements, required_elements=required_elements
+    ))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(lambda x: solve_composition(x, time_budget=time_budget), all_el_amt)
+        entries = dict(r for r in results if r is not None)
+    write_index(entries, path)
+    # reopen on the next lookup
+    with _index_lock:
+        _loaded_indexes.pop(path, None)
+    return len(entries)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='build the index of precomputed oxidation states')
+    parser.add_argument('--output', default=DEFAULT_INDEX_PATH)
+    parser.add_argument('--elements', default=','.join(DEFAULT_ELEMENTS),
+                        help='comma separated element symbols')
+    parser.add_argument('--required-elements', default='O',
+                        help='comma separated element symbols, one of them must be in the '
+                             'composition. empty to enumerate all')
+    parser.add_argument('--max-atoms', type=int, default=DEFAULT_MAX_ATOMS)
+    parser.add_argument('--max-elements', type=int, default=DEFAULT_MAX_ELEMENTS)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--time-budget', type=float, default=60)
+    args = parser.parse_args()
+    num_entries = build_index(
+        path=args.output,
+        elements=args.elements.split(','),
+        max_atoms=args.max_atoms,
+        max_elements=args.max_elements,
+        required_elements=[el for el in args.required_elements.split(',') if el],
+        max_workers=args.workers,
+        time_budget=args.time_budget,
+    )
+    print('{} compositions are written to {}'.format(num_entries, args.output))
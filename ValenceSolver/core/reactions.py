@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+import collections
+import copy
+from concurrent.futures import ThreadPoolExecutor
+
+from . import metrics
+from .composition_inhouse import CompositionInHouse
+from .material_cache import get_material_key
+from .utils import dictOrdered, to_GeneralMat_obj, CACHE_REQUESTS_HELP
+from .utils import store_in_valence_cache, collect_material_valence
+
+"""
+Valence of the targets and precursors of synthesis reactions in batch. Compositions of
+all materials in a batch of reactions are gathered and deduplicated first, the ones not
+in the cache are solved together in a thread pool, and the valence is written back to
+each material, the same as get_material_valence() material by material.
+
+The reactions are in the schema of the text-mined synthesis dataset, e.g.
+    {
+        'reaction': {'element_substitution': {...}, ...},
+        'target': {'composition': [...], 'amounts_vars': {...}, ...},
+        'precursors': [{'composition': [...], 'amounts_vars': {...}, ...}, ...],
+    }
+"""
+
+__author__ = 'Tanjin He'
+__maintainer__ = 'Tanjin He'
+__email__ = 'tanjin_he@berkeley.edu'
+
+
+def get_reaction_material_inputs(reaction):
+    """
+    :param reaction: dict of a reaction
+    :return: list of (record, composition, amounts_vars, elements_vars). record is the
+        dict to write 'valence' into, i.e. the target and each composition of the
+        precursors. The others are parameters of to_GeneralMat_obj()
+    """
+    elements_vars = reaction['reaction'].get('element_substitution')
+    materials = [(
+        reaction['target'],
+        reaction['target']['composition'],
+        reaction['target'].get('amounts_vars'),
+        elements_vars,
+    )]
+    for tmp_pre in reaction['precursors']:
+        for tmp_comp in tmp_pre['composition']:
+            materials.append((tmp_comp, tmp_comp, tmp_pre.get('amounts_vars'), elements_vars))
+    return materials
+
+
+def get_reaction_materials(reaction):
+    """
+    :param reaction: dict of a reaction
+    :return: list of (record, mat_obj). record is the dict to write 'valence' into,
+        i.e. the target and each composition of the precursors
+    """
+    return [
+        (record, to_GeneralMat_obj(
+            composition=composition,
+            amounts_vars=amounts_vars,
+            elements_vars=elements_vars
+        ))
+        for record, composition, amounts_vars, elements_vars in get_reaction_material_inputs(reaction)
+    ]
+
+
+def _solve_composition(composition):
+    try:
+        return CompositionInHouse.get_most_possible_oxi_state_of_composition(composition)
+    except Exception:
+        return [], False, []
+
+
+def annotate_reactions(reactions, valence_cache=None, max_workers=None, material_cache=None):
+    """
+    add the field 'valence' to the target and to each composition of the precursors
+    of reactions in place
+
+    :param reactions: list of dicts of reactions
+    :param valence_cache: dict or ValenceCache. cache of solved compositions, updated in place
+    :param max_workers: int. number of threads solving the compositions not in the cache
+    :param material_cache: MaterialValenceCache. cache of solved materials, updated in place.
+        Materials in it are not parsed again, and repeated materials in the batch are
+        parsed only once
+    :return: collections.Counter of statistics, e.g. the number of compositions solved
+    """
+    if valence_cache is None:
+        valence_cache = {}
+    counter = collections.Counter()
+
+    # gather compositions of all materials
+    all_materials = []
+    # material key -> records of the material in the batch
+    batch_records = {}
+    to_solve = collections.OrderedDict()
+    for reaction in reactions:
+        for record, composition, amounts_vars, elements_vars in get_reaction_material_inputs(reaction):
+            material_key = None
+            if material_cache is not None:
+                material_key = get_material_key(composition, amounts_vars, elements_vars)
+                if material_key in batch_records:
+                    batch_records[material_key].append(record)
+                    counter['materials cached'] += 1
+                    continue
+                if material_key in material_cache:
+                    record['valence'] = material_cache.get(material_key)
+                    counter['materials cached'] += 1
+                    continue
+                batch_records[material_key] = [record]
+            mat_obj = to_GeneralMat_obj(
+                composition=composition,
+                amounts_vars=amounts_vars,
+                elements_vars=elements_vars
+            )
+            all_comps, var_mapping = [], []
+            if mat_obj:
+                all_comps, var_mapping = mat_obj.get_critical_compositions(
+                    skip_wrong_composition=True,
+                    return_variable_mapping=True
+                )
+            all_keys = [
+                str(dictOrdered(tmp_comp.composition)) if tmp_comp else None
+                for tmp_comp in all_comps
+            ]
+            for tmp_comp, key in zip(all_comps, all_keys):
+                if key is None:
+                    continue
+                # the first request of a composition out of the cache is a miss
+                if key in valence_cache or key in to_solve:
+                    metrics.inc('valence_solver_cache_requests', help_text=CACHE_REQUESTS_HELP, result='hit')
+                else:
+                    metrics.inc('valence_solver_cache_requests', help_text=CACHE_REQUESTS_HELP, result='miss')
+                    to_solve[key] = tmp_comp.composition
+            all_materials.append((record, material_key, mat_obj, all_comps, var_mapping, all_keys))
+
+    # solve unique compositions in bulk
+    solutions = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(_solve_composition, to_solve.values())
+        for (key, composition), (oxi_state, is_usual, comments) in zip(to_solve.items(), results):
+            solutions[key] = store_in_valence_cache(
+                valence_cache, key, composition, oxi_state, is_usual, comments
+            )
+    counter['compositions solved'] = len(to_solve)
+
+    # write back
+    for record, material_key, mat_obj, all_comps, var_mapping, all_keys in all_materials:
+        all_oxi_states = [
+            solutions[key] if key in solutions else valence_cache.get(key)
+            for key in all_keys
+        ]
+        valence = collect_material_valence(all_comps, var_mapping, all_oxi_states)
+        record['valence'] = valence
+        if material_key is not None:
+            material_cache.put(material_key, valence)
+            for tmp_record in batch_records[material_key][1:]:
+                tmp_record['valence'] = copy.deepcopy(valence)
+        if mat_obj is None:
+            counter['no mat_obj'] += 1
+        elif valence is None:
+            counter['valence not solved'] += 1
+        else:
+            counter['valence solved'] += 1
+    return counter
+
+
+def annotate_reaction(reaction, valence_cache=None, material_cache=None):
+    """
+    same as annotate_reactions() for a single reaction
+
+    :return: the reaction with valence added
+    """
+    annotate_reactions(
+        [reaction],
+        valence_cache=valence_cache,
+        max_workers=1,
+        material_cache=material_cache,
+    )
+    return reaction
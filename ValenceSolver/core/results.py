@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+import math
+import sys
+from array import array
+
+from .composition_inhouse import CompositionInHouse
+
+"""
+Compact result of CompositionInHouse.get_most_possible_oxi_state_of_composition().
+The result is usually a tuple of a list holding one dict, a bool, a list of comments and
+a list holding one dict with (el, state) keys, which is wasteful when millions of results
+are kept in memory. OxiStateResult has no instance dict, shares element symbols by interning,
+stores common comments as small integers and the valence and the number of ions in arrays.
+"""
+
+__author__ = 'Tanjin He'
+__maintainer__ = 'Tanjin He'
+__email__ = 'tanjin_he@berkeley.edu'
+
+# comments of oxi_state_guesses_most_possible(). code 0 is for other comments stored as text
+KNOWN_COMMENTS = (
+    None,
+    'is alloy',
+    'all possible positive valence states are used for metals',
+    'possibly oxygen deficient, or some elements are more oxidized than usual',
+    'possibly oxygen excess, or some elements are more reduced than usual',
+    'Warning: the input composition might be wrong',
+    CompositionInHouse.TIME_BUDGET_WARNING,
+)
+COMMENT_CODES = {comment: code for code, comment in enumerate(KNOWN_COMMENTS) if comment}
+
+
+# tuples of element symbols are shared by results of the same chemical system
+_elements_pool = {}
+
+
+class OxiStateResult(object):
+    """
+    slotted result of oxidation states. Convert to the usual format with to_tuple() or to_dict().
+    """
+    __slots__ = (
+        'elements',
+        'values',
+        'ions',
+        'is_usual',
+        'comment_codes',
+        'other_comments',
+    )
+
+    def __init__(self, oxi_state, is_usual, comments, oxi_details=None):
+        """
+        same as the returned values of get_most_possible_oxi_state_of_composition()
+
+        :param oxi_state: list of at most one dict {el: valence}
+        :param is_usual: bool
+        :param comments: list of str
+        :param oxi_details: list of at most one dict {(el, state): number of ions}
+        """
+        if len(oxi_state) > 1 or (oxi_details and len(oxi_details) > 1):
+            raise ValueError('only one solution is supported')
+        valence = oxi_state[0] if oxi_state else {}
+        details = oxi_details[0] if oxi_details else {}
+
+        elements = list(valence)
+        for el, _ in details:
+            if el not in elements:
+                elements.append(el)
+        elements = tuple(sys.intern(str(el)) for el in elements)
+        # elements: tuple of element symbols, including those only in details (e.g. X)
+        self.elements = _elements_pool.setdefault(elements, elements)
+        # values: valence of each element (nan if not in the solution) and number of each ion
+        self.values = array('d', [valence.get(el, math.nan) for el in elements])
+        self.values.extend(details.values())
+        # ions: index of element and oxidation state + 128 of each ion
+        ions = []
+        for el, state in details:
+            if state != int(state) or not -128 <= state < 128:
+                raise ValueError(
+                    'oxidation state {} of {} cannot be stored, only integers '
+                    'in [-128, 127] are supported'.format(state, el)
+                )
+            ions.extend((elements.index(el), int(state) + 128))
+        self.ions = bytes(ions)
+        self.is_usual = bool(is_usual)
+        # comments: codes in KNOWN_COMMENTS, 0 for comments in other_comments
+        self.comment_codes = bytes(COMMENT_CODES.get(comment, 0) for comment in comments)
+        other_comments = tuple(comment for comment in comments if comment not in COMMENT_CODES)
+        self.other_comments = other_comments or None
+
+    @property
+    def valence(self):
+        """
+        :return: dict of {el: valence} or None if there is no solution
+        """
+        if len(self.elements) == 0:
+            return None
+        return {
+            el: v for el, v in zip(self.elements, self.values) if not math.isnan(v)
+        }
+
+    @property
+    def comments(self):
+        """
+        :return: list of str
+        """
+        other_comments = iter(self.other_comments or ())
+        return [
+            KNOWN_COMMENTS[code] if code else next(other_comments)
+            for code in self.comment_codes
+        ]
+
+    @property
+    def details(self):
+        """
+        :return: dict of {(el, state): number of ions}
+        """
+        num_elements = len(self.elements)
+        return {
+            (self.elements[self.ions[2*i]], self.ions[2*i+1] - 128): self.values[num_elements+i]
+            for i in range(len(self.ions) // 2)
+        }
+
+    def to_tuple(self, return_details=False):
+        """
+        :return: the same as get_most_possible_oxi_state_of_composition(return_details)
+        """
+        valence = self.valence
+        oxi_state = [valence] if valence is not None else []
+        if return_details:
+            oxi_details = [self.details] if valence is not None else []
+            return oxi_state, self.is_usual, self.comments, oxi_details
+        return oxi_state, self.is_usual, self.comments
+
+    def to_dict(self):
+        """
+        :return: dict of {'valence': {el: valence} or None, 'is_usual': bool, 'comments': list of str}
+        """
+        return {
+            'valence': self.valence,
+            'is_usual': self.is_usual,
+            'comments': self.comments,
+        }
+
+    def __eq__(self, other):
+        if not isinstance(other, OxiStateResult):
+            return NotImplemented
+        return self.to_tuple(return_details=True) == other.to_tuple(return_details=True)
+
+    def __hash__(self):
+        # consistent with __eq__, which compares the converted dicts
+        return hash((
+            frozenset(self.valence.items()) if self.valence is not None else None,
+            self.is_usual,
+            tuple(self.comments),
+            frozenset(self.details.items()),
+        ))
+
+    def __repr__(self):
+        return 'OxiStateResult({}, is_usual={}, comments={})'.format(
+            self.valence, self.is_usual, self.comments
+        )
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+import argparse
+import hashlib
+import json
+import os
+
+from .incremental import hash_material_input
+from .utils import to_GeneralMat_obj, get_material_valence
+
+"""
+Annotation of a dataset split across machines. Materials are assigned to shards by
+a stable hash of their normalized input, so that identical materials are always solved
+in the same shard against its local cache. Each node writes its shard to files in a
+shared directory, and the merge step reassembles the records in the original order.
+Nodes only coordinate through files.
+
+    python -m ValenceSolver.core.sharding annotate --input materials.json --output-dir out --shard 0 --num-shards 4
+    ...
+    python -m ValenceSolver.core.sharding merge --input materials.json --output-dir out --num-shards 4 --output annotated.json
+
+The input is a json list (or json lines) of materials
+{'composition': ..., 'amounts_vars': ..., 'elements_vars': ...}, parameters of to_GeneralMat_obj().
+"""
+
+__author__ = 'Tanjin He'
+__maintainer__ = 'Tanjin He'
+__email__ = 'tanjin_he@berkeley.edu'
+
+
+def get_shard(material, num_shards):
+    """
+    :param material: dict of {'composition': ..., 'amounts_vars': ..., 'elements_vars': ...}
+    :param num_shards: int
+    :return: int. index of the shard, the same on every machine and python process
+    """
+    input_hash = hash_material_input(
+        material['composition'],
+        material.get('amounts_vars'),
+        material.get('elements_vars'),
+    )
+    return int(hashlib.sha1(input_hash.encode('utf-8')).hexdigest(), 16) % num_shards
+
+
+def load_materials(path):
+    with open(path, 'r') as fr:
+        if path.endswith('.jsonl'):
+            return [json.loads(line) for line in fr if line.strip()]
+        return json.load(fr)
+
+
+def get_shard_paths(output_dir, shard, num_shards):
+    """
+    :return: (path of the annotated records, path of the valence cache) of a shard
+    """
+    prefix = os.path.join(output_dir, 'shard-{:05d}-of-{:05d}'.format(shard, num_shards))
+    return prefix + '.jsonl', prefix + '.cache.json'
+
+
+def _write_atomically(path, write_func):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as fw:
+        write_func(fw)
+    os.replace(tmp_path, path)
+
+
+def annotate_shard(input_path, output_dir, shard, num_shards):
+    """
+    solve the materials of one shard. The cache of the shard from a previous run is reused.
+    The output files only appear when complete.
+
+    :return: int. number of materials in the shard
+    """
+    materials = load_materials(input_path)
+    records_path, cache_path = get_shard_paths(output_dir, shard, num_shards)
+    valence_cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r') as fr:
+            valence_cache = json.load(fr)
+
+    records = []
+    for i, material in enumerate(materials):
+        if get_shard(material, num_shards) != shard:
+            continue
+        tmp_mat_obj = to_GeneralMat_obj(
+            composition=material['composition'],
+            amounts_vars=material.get('amounts_vars'),
+            elements_vars=material.get('elements_vars')
+        )
+        valence = get_material_valence(tmp_mat_obj, valence_cache=valence_cache)
+        records.append({'index': i, 'valence': valence})
+
+    os.makedirs(output_dir, exist_ok=True)
+    _write_atomically(cache_path, lambda fw: json.dump(valence_cache, fw, sort_keys=True))
+    _write_atomically(records_path, lambda fw: fw.writelines(
+        json.dumps(r, sort_keys=True) + '\n' for r in records
+    ))
+    return len(records)
+
+
+def merge_shards(input_path, output_dir, num_shards, output_path=None, cache_output_path=None):
+    """
+    reassemble the outputs of all shards. The result only depends on the input and
+    the shard outputs, not on the order in which the shards finished.
+
+    :param output_path: str. if given, the annotated materials are written as json
+    :param cache_output_path: str. if given, the merged valence cache is written as json
+    :return: (materials, valence_cache). materials are in the original order, each with
+        the field 'valence' added
+    :raise ValueError: if a shard is missing or a material is not annotated exactly once
+    """
+    materials = load_materials(input_path)
+    all_valence = [None] * len(materials)
+    annotated = [False] * len(materials)
+    valence_cache = {}
+    for shard in range(num_shards):
+        records_path, cache_path = get_shard_paths(output_dir, shard, num_shards)
+        if not os.path.exists(records_path) or not os.path.exists(cache_path):
+            raise ValueError('shard {} of {} is not finished'.format(shard, num_shards))
+        with open(records_path, 'r') as fr:
+            for line in fr:
+                record = json.loads(line)
+                if annotated[record['index']]:
+                    raise ValueError('material {} is annotated twice'.format(record['index']))
+                annotated[record['index']] = True
+                all_valence[record['index']] = record['valence']
+        with open(cache_path, 'r') as fr:
+            for k, v in json.load(fr).items():
+                valence_cache.setdefault(k, v)
+    if not all(annotated):
+        raise ValueError('material {} is not annotated'.format(annotated.index(False)))
+
+    for material, valence in zip(materials, all_valence):
+        material['valence'] = valence
+    if output_path:
+        _write_atomically(output_path, lambda fw: json.dump(materials, fw, indent=2))
+    if cache_output_path:
+        _write_atomically(cache_output_path, lambda fw: json.dump(valence_cache, fw, sort_keys=True))
+    return materials, valence_cache
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='annotate valence of a dataset in shards')
+    parser.add_argument('command', choices=['annotate', 'merge'])
+    parser.add_argument('--input', required=True)
+    parser.add_argument('--output-dir', required=True)
+    parser.add_argument('--num-shards', type=int, required=True)
+    parser.add_argument('--shard', type=int, help='index of the shard to annotate')
+    parser.add_argument('--output', help='path of the merged output')
+    parser.add_argument('--cache-output', help='path of the merged valence cache')
+    args = parser.parse_args()
+    if args.command == 'annotate':
+        if args.shard is None:
+            parser.error('--shard is required to annotate')
+        num_materials = annotate_shard(args.input, args.output_dir, args.shard, args.num_shards)
+        print('shard {} of {}: {} materials'.format(args.shard, args.num_shards, num_materials))
+    else:
+        merge_shards(
+            args.input,
+            args.output_dir,
+            args.num_shards,
+            output_path=args.output,
+            cache_output_path=args.cache_output,
+        )
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import multiprocessing
+import struct
+from multiprocessing import shared_memory
+
+"""
+A valence cache shared by the processes of a pool. It is a fixed-size open-addressing
+hash table with linear probing over a multiprocessing.shared_memory buffer.
+
+Each slot is: state (1 byte), hash of key (8 bytes), length of key (2 bytes),
+length of value (2 bytes), key and value (json), padded to the slot size.
+Writers hold a lock and publish a slot by setting its state last, after the key and
+value are written. Entries are never modified or removed, so readers do not need
+the lock: a slot is either empty or complete when its state is read.
+"""
+
+__author__ = 'Tanjin He'
+__maintainer__ = 'Tanjin He'
+__email__ = 'tanjin_he@berkeley.edu'
+
+HEADER = struct.Struct('<QQQ')  # number of slots, slot size, number of entries
+SLOT_HEADER = struct.Struct('<BQHH')
+EMPTY = 0
+READY = 1
+# inserts are dropped above this load factor to keep probing short
+MAX_LOAD_FACTOR = 0.75
+
+
+def _hash_key(key):
+    # the builtin hash() is randomized per process
+    return struct.unpack('<Q', hashlib.blake2b(key, digest_size=8).digest())[0]
+
+
+class SharedValenceCache(object):
+    """
+    dict-like cache of {composition string: valence} shared across processes,
+    can be used as valence_cache in get_material_valence(). Entries whose key and
+    value do not fit in a slot, or inserted when the table is full, are not cached.
+    Create it in the parent process, pass it to the workers (e.g. in the initargs
+    of multiprocessing.Pool), and call unlink() when the pool is done. It holds a
+    multiprocessing lock, so it can only be passed when processes are started, not
+    in the arguments of tasks such as Pool.map().
+    """
+
+    def __init__(self, num_slots=65536, slot_size=512, name=None, lock=None):
+        """
+        :param num_slots: int. capacity of the table
+        :param slot_size: int. bytes of each slot
+        :param name: str. name of an existing shared memory to attach to
+        :param lock: multiprocessing.Lock shared by the writers
+        """
+        if name is None:
+            self._shm = shared_memory.SharedMemory(
+                create=True, size=HEADER.size + num_slots * slot_size
+            )
+            HEADER.pack_into(self._shm.buf, 0, num_slots, slot_size, 0)
+            self._owner = True
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+            self._owner = False
+        self.num_slots, self.slot_size, _ = HEADER.unpack_from(self._shm.buf, 0)
+        self._lock = lock or multiprocessing.Lock()
+
+    def __getstate__(self):
+        # the lock can only be inherited, fail early with a clear message otherwise
+        multiprocessing.context.assert_spawning(self)
+        return {'name': self._shm.name, 'lock': self._lock}
+
+    def __setstate__(self, state):
+        self.__init__(name=state['name'], lock=state['lock'])
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def _slot_offset(self, index):
+        return HEADER.size + index * self.slot_size
+
+    def _find(self, key):
+        """
+        :return: (index of the slot, value in bytes or None if the key is not found)
+        """
+        key_hash = _hash_key(key)
+        buf = self._shm.buf
+        index = key_hash % self.num_slots
+        for _ in range(self.num_slots):
+            offset = self._slot_offset(index)
+            state, slot_hash, key_len, value_len = SLOT_HEADER.unpack_from(buf, offset)
+            if state == EMPTY:
+                return index, None
+            if slot_hash == key_hash:
+                start = offset + SLOT_HEADER.size
+                if bytes(buf[start: start + key_len]) == key:
+                    return index, bytes(buf[start + key_len: start + key_len + value_len])
+            index = (index + 1) % self.num_slots
+        return None, None
+
+    def get(self, key, default=None):
+        _, value = self._find(str(key).encode('utf-8'))
+        if value is None:
+            return default
+        return json.loads(value.decode('utf-8'))
+
+    def __getitem__(self, key):
+        value = self.get(key, default=KeyError)
+        if value is KeyError:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self._find(str(key).encode('utf-8'))[1] is not None
+
+    def __setitem__(self, key, value):
+        key = str(key).encode('utf-8')
+        value = json.dumps(value, separators=(',', ':')).encode('utf-8')
+        if SLOT_HEADER.size + len(key) + len(value) > self.slot_size:
+            return
+        with self._lock:
+            if len(self) >= self.num_slots * MAX_LOAD_FACTOR:
+                return
+            index, old_value = self._find(key)
+            if index is None or old_value is not None:
+                return
+            buf = self._shm.buf
+            offset = self._slot_offset(index)
+            start = offset + SLOT_HEADER.size
+            buf[start: start + len(key)] = key
+            buf[start + len(key): start + len(key) + len(value)] = value
+            struct.pack_into('<QHH', buf, offset + 1, _hash_key(key), len(key), len(value))
+            # publish the slot after the content is complete
+            buf[offset] = READY
+            HEADER.pack_into(buf, 0, self.num_slots, self.slot_size, len(self) + 1)
+
+    def __len__(self):
+        return HEADER.unpack_from(self._shm.buf, 0)[2]
+
+    def close(self):
+        self._shm.close()
+
+    def unlink(self):
+        """
+        close and free the shared memory, only called by the process creating it
+        """
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.unlink()
+
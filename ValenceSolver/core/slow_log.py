@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+import argparse
+import cProfile
+import inspect
+import json
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from . import metrics
+
+"""
+Opt-in log of slow calls of the solver for offline replay. When enabled, each call of
+oxi_state_guesses_most_possible() or get_material_valence() slower than the threshold
+is appended to a json lines file with its input, options, the relaxation stages run with
+their timings, and the exact inputs of every model passed to get_most_possible_solution().
+Nested calls are recorded as stages of the outermost one. Logging is off by default and
+costs one check per call when off.
+
+    from ValenceSolver.core import slow_log
+    slow_log.enable('slow_calls.jsonl', threshold=1.0)
+
+The logged cases can be re-run in isolation, e.g. to profile them or as benchmarks:
+
+    python -m ValenceSolver.core.slow_log slow_calls.jsonl --models --profile
+"""
+
+__author__ = 'Tanjin He'
+__maintainer__ = 'Tanjin He'
+__email__ = 'tanjin_he@berkeley.edu'
+
+_path = None
+# seconds, None if logging is disabled
+_threshold = None
+_write_lock = threading.Lock()
+# the call being recorded in each thread
+_local = threading.local()
+
+
+def enable(path, threshold=1.0):
+    """
+    :param path: str. json lines file the slow calls are appended to
+    :param threshold: float. minimum seconds of a call to be logged
+    """
+    global _path, _threshold
+    _path = path
+    _threshold = threshold
+
+
+def disable():
+    global _path, _threshold
+    _path = None
+    _threshold = None
+
+
+def _write_call(call):
+    line = json.dumps(call, default=str) + '\n'
+    with _write_lock:
+        with open(_path, 'a') as fw:
+            fw.write(line)
+    metrics.inc(
+        'valence_solver_slow_calls',
+        help_text='Number of calls written to the slow call log',
+        function=call['function'],
+    )
+
+
+def logged(function, get_input, get_output, skip=()):
+    """
+    decorator to record calls of a function in the slow call log
+
+    :param function: str. name of the function in the log
+    :param get_input: function of the dict of bound arguments returning the input to log
+    :param get_output: function of the returned value returning the output to log
+    :param skip: names of arguments not logged as options, e.g. the input and caches
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _threshold is None or getattr(_local, 'call', None) is not None:
+                return func(*args, **kwargs)
+            arguments = signature.bind(*args, **kwargs).arguments
+            call = {
+                'function': function,
+                'input': get_input(arguments),
+                'options': {k: v for k, v in arguments.items() if k not in skip},
+                'stages': [],
+                'models': [],
+            }
+            _local.call = call
+            _local.stages = []
+            threshold = _threshold
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+                call['output'] = get_output(result)
+                return result
+            except Exception as e:
+                call['error'] = '{}: {}'.format(type(e).__name__, e)
+                raise
+            finally:
+                _local.call = None
+                call['seconds'] = time.perf_counter() - start
+                if call['seconds'] >= threshold and _path is not None:
+                    # failures of the log must not change the result or the error of the call
+                    try:
+                        _write_call(call)
+                    except Exception as e:
+                        sys.stderr.write('failed to write the slow call log: {}: {}\n'.format(
+                            type(e).__name__, e
+                        ))
+                        metrics.inc(
+                            'valence_solver_slow_log_errors',
+                            help_text='Number of calls that failed to be written to the slow call log',
+                            function=function,
+                        )
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def stage(name):
+    """
+    record the time of a stage of the current call. The names of nested stages
+    are joined by ' > '
+    """
+    call = getattr(_local, 'call', None)
+    if call is None:
+        yield
+        return
+    _local.stages.append(name)
+    record = {'stage': ' > '.join(_local.stages)}
+    call['stages'].append(record)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record['seconds'] = time.perf_counter() - start
+        _local.stages.pop()
+
+
+def record_model(all_els, all_oxi_states, all_el_amts, seconds, status, **flags):
+    """
+    record the inputs of get_most_possible_solution() in the current call
+
+    :param seconds: float. time of building and solving the model
+    :param status: str. status of the solver, e.g. 'Optimal'
+    :param flags: other parameters of get_most_possible_solution()
+    """
+    call = getattr(_local, 'call', None)
+    if call is None:
+        return
+    call['models'].append(dict(
+        stage=' > '.join(_local.stages),
+        all_els=list(all_els),
+        all_oxi_states={el: list(states) for el, states in all_oxi_states.items()},
+        all_el_amts=dict(all_el_amts),
+        seconds=seconds,
+        status=status,
+        **flags
+    ))
+
+
+def load_slow_calls(path):
+    """
+    :param path: str. json lines file written by the slow call log
+    :return: list of dicts of calls
+    """
+    with open(path, 'r') as fr:
+        return [json.loads(line) for line in fr if line.strip()]
+
+
+def replay_model(model):
+    """
+    solve a logged model again
+
+    :param model: dict in the field 'models' of a logged call
+    :return: ((solution, score, valence_detail), seconds)
+    """
+    from .composition_inhouse import CompositionInHouse
+
+    start = time.perf_counter()
+    result = CompositionInHouse.get_most_possible_solution(
+        model['all_els'],
+        model['all_oxi_states'],
+        model['all_el_amts'],
+        add_compensator=model['add_compensator'],
+        target_charge=model['target_charge'],
+        time_limit=model['time_limit'],
+        initial_solution=model['initial_solution'],
+    )
+    return result, time.perf_counter() - start
+
+
+def replay_call(call):
+    """
+    run a logged call again with the same input and options. Caches of the original
+    call are not available, so all compositions of a material are solved.
+
+    :param call: dict of a logged call
+    :return: (output in the format of the log, seconds)
+    """
+    from .composition_inhouse import PlainComposition
+    from .utils import get_material_valence
+    from .variable_composition import VariableComposition
+
+    start = time.perf_counter()
+    if call['function'] == 'oxi_state_guesses_most_possible':
+        result = PlainComposition(call['input']).oxi_state_guesses_most_possible(**call['options'])
+        output = list(result[:3])
+    elif call['function'] == 'get_material_valence':
+        material = None
+        if call['input'] is not None:
+            material = VariableComposition(**call['input'])
+        output = get_material_valence(material, **call['options'])
+        if isinstance(output, tuple):
+            output = output[0]
+    else:
+        raise ValueError('unknown function: {}'.format(call['function']))
+    return output, time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='replay the calls in a slow call log')
+    parser.add_argument('path', help='json lines file of the slow call log')
+    parser.add_argument('--models', action='store_true',
+                        help='replay the logged models of get_most_possible_solution() '
+                             'instead of the whole calls')
+    parser.add_argument('--repeat', type=int, default=1, help='number of runs of each case')
+    parser.add_argument('--profile', action='store_true',
+                        help='print the profile of the replay to stderr')
+    args = parser.parse_args(argv)
+
+    profiler = cProfile.Profile() if args.profile else None
+    for i, call in enumerate(load_slow_calls(args.path)):
+        cases = [(call['input'], call, call['seconds'])]
+        if args.models:
+            cases = [(model['stage'], model, model['seconds']) for model in call['models']]
+        for name, case, logged_seconds in cases:
+            all_seconds = []
+            for _ in range(args.repeat):
+                if profiler is not None:
+                    profiler.enable()
+                if args.models:
+                    _, seconds = replay_model(case)
+                else:
+                    _, seconds = replay_call(case)
+                if profiler is not None:
+                    profiler.disable()
+                all_seconds.append(seconds)
+            sys.stdout.write('{}\t{}\t{}\tlogged {:.3f} s\treplayed {:.3f} s (min of {})\n'.format(
+                i, call['function'], json.dumps(name, default=str),
+                logged_seconds, min(all_seconds), args.repeat,
+            ))
+    if profiler is not None:
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(30)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,19 +2,29 @@
 import re
 from unidecode import unidecode
 import collections
+import itertools
+import time
 from sympy.parsing.sympy_parser import parse_expr
 from copy import deepcopy
-import pkgutil
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
 from pymatgen.core.periodic_table import Element
 from .composition_inhouse import CompositionInHouse
-
-if pkgutil.find_loader('Synthepedia'):
-    from Synthepedia.concepts.materials.complex import GeneralComposition
+from . import metrics
+from . import slow_log
+from .shared_cache import SharedValenceCache
+from .variable_composition import VariableComposition
+from .valence_cache import ValenceCache
+from .results import OxiStateResult
 
 __author__ = 'Tanjin He'
 __maintainer__ = 'Tanjin He'
 __email__ = 'tanjin_he@berkeley.edu'
 
+CACHE_REQUESTS_HELP = 'Number of lookups of compositions in the valence cache'
+# comment of points of get_material_valence_sweep() that are not solved
+INTERPOLATED_COMMENT = 'interpolated between solved compositions'
+
 # convert a dict into orderedDict
 def dictOrdered(unordered_dict):
     return collections.OrderedDict(sorted(unordered_dict.items(), key=lambda x:x[0]))
@@ -97,7 +107,7 @@ def get_valence_single_composition(composition,
     return oxi_state
 
 
-def get_composition_dict(struct_list, elements_vars = {}):
+def get_composition_dict(struct_list, elements_vars=None):
     """
     struct_list is from 'composition' field 
     e.g. [{'amount': '1.0',
@@ -106,6 +116,7 @@ def get_composition_dict(struct_list, elements_vars = {}):
                           'Sr': '6.0'},
              'formula': 'Sr6(Fe2O4)6'}]
     """
+    elements_vars = elements_vars or {}
     # goal
     combined_comp = {}
     all_comps = []
@@ -146,7 +157,7 @@ def get_composition_dict(struct_list, elements_vars = {}):
     return combined_comp
 
 
-def to_GeneralMat_obj(composition, amounts_vars={}, elements_vars={}):
+def get_composition_and_fraction_vars(composition, amounts_vars=None, elements_vars=None):
     """
     composition is either a single dict as following or a list of such dicts.
         e.g.     {'amount': '1.0',
@@ -154,11 +165,13 @@ def to_GeneralMat_obj(composition, amounts_vars={}, elements_vars={}):
                               'O': '24.0',
                               'Sr': '6.0'},
                     ... }
+    :return: (composition, fraction_vars)
+        composition: dict of {ele: expression of amount} after substituting elements variables
+        fraction_vars: dict of {var: list of values or {'min': min, 'max': max}}
     """
+    amounts_vars = amounts_vars or {}
     #     goal
-    mat_obj = None
     fraction_vars = {}
-    contain_vars = False
 
     # put composition in a list if it is a dict
     raw_composition = deepcopy(composition)
@@ -227,31 +240,43 @@ def to_GeneralMat_obj(composition, amounts_vars={}, elements_vars={}):
         if x in {'x', 'y', 'z'}:
             fraction_vars[x] = [0.0]                    
                     
-    if len(fraction_vars):
-        contain_vars = True
-        
-    # get GeneralComposition object
-    try:
-        mat_obj = GeneralComposition(
-            composition=composition, 
-            contain_vars=contain_vars, 
-            fraction_vars=fraction_vars, 
-            edge_composition=[]
-        )
-    except Exception as e:
-        pass
+    return composition, fraction_vars
+
 
+def to_GeneralMat_obj(composition, amounts_vars=None, elements_vars=None):
+    """
+    composition is either a single dict as following or a list of such dicts.
+        e.g.     {'amount': '1.0',
+                 'elements': {'Fe': '12.0',
+                              'O': '24.0',
+                              'Sr': '6.0'},
+                    ... }
+    :return: VariableComposition object or None if the material is not valid
+    """
+    #     goal
+    mat_obj = None
+
+    composition, fraction_vars = get_composition_and_fraction_vars(
+        composition,
+        amounts_vars=amounts_vars,
+        elements_vars=elements_vars,
+    )
+
+    # get VariableComposition object
     # check mat_obj is correctly generated
     # because some value of variables might be improper
     try:
+        mat_obj = VariableComposition(
+            composition=composition,
+            fraction_vars=fraction_vars,
+        )
         # some value of variables is incredibly large and make the number of element to be negative
         # set skip_wrong_composition = True to skip those wrong values
         # for more strict critera, set skip_wrong_composition = False to skip the entire material
-        edge_points = mat_obj.get_critical_compositions(
+        mat_obj.get_critical_compositions(
             skip_wrong_composition=True
         )
-        mat_obj.overlap_with(mat_obj)
-    except:
+    except Exception:
         mat_obj = None
     return mat_obj
 
@@ -306,7 +331,75 @@ def merge_valence(valence_combos):
         return merge_same_valence(valence_combos)
         
         
-def get_material_valence(material, valence_cache={}):
+def store_in_valence_cache(valence_cache, key, composition, oxi_state, is_usual, comments):
+    """
+    store a solution of get_most_possible_oxi_state_of_composition() in the cache of
+    get_material_valence(). Solutions cut by the time budget are not stored.
+
+    :param valence_cache: dict or ValenceCache
+    :param key: str. key of the composition in the cache
+    :param composition: dict of {ele: amount}
+    :return: dict of {ele: valence} or None if there is no solution
+    """
+    if not oxi_state or not oxi_state[0]:
+        return None
+    if CompositionInHouse.TIME_BUDGET_WARNING in comments:
+        return oxi_state[0]
+    if isinstance(valence_cache, ValenceCache):
+        valence_cache.add(key, composition, OxiStateResult(oxi_state[:1], is_usual, comments))
+    else:
+        valence_cache[key] = oxi_state[0]
+    return oxi_state[0]
+
+
+def collect_material_valence(all_comps, var_mapping, all_oxi_states):
+    """
+    :param all_comps: list of compositions from material.get_critical_compositions()
+    :param var_mapping: list of values of variables of each composition
+    :param all_oxi_states: list of dict of {ele: valence} or None of each composition
+    :return: list of valence dicts or None, as returned by get_material_valence()
+    """
+    all_valence = []
+    for i, (tmp_comp, oxi_state) in enumerate(zip(all_comps, all_oxi_states)):
+        if tmp_comp and oxi_state:
+            all_valence.append({
+                'valence': oxi_state,
+                'amounts_vars': var_mapping[i],
+                'elements': tmp_comp.composition,
+            })
+    all_valence = merge_valence(all_valence)
+    if len(all_valence) == 0:
+        all_valence = None
+    return all_valence
+
+
+@metrics.timed('valence_solver_material_seconds', help_text='Latency of get_material_valence in seconds')
+@slow_log.logged(
+    'get_material_valence',
+    get_input=lambda arguments: {
+        'composition': arguments['material'].composition,
+        'fraction_vars': arguments['material'].fraction_vars,
+    } if arguments['material'] else None,
+    get_output=lambda result: result[0] if isinstance(result, tuple) else result,
+    skip=('material', 'valence_cache'),
+)
+def get_material_valence(material, valence_cache=None, time_budget=None, return_timed_out=False):
+    """
+    :param material: VariableComposition object from to_GeneralMat_obj()
+    :param valence_cache: dict. cache of solved compositions, updated in place. If it is
+        a ValenceCache, the solver is warm started from the nearest cached composition
+    :param time_budget: float. maximum seconds for all compositions of the material.
+        When the budget runs out, the remaining compositions are skipped and the solution
+        of the composition being solved is the best one found so far. Such results are not
+        cached. If None, only CompositionInHouse.default_time_budget applies to each composition.
+    :param return_timed_out: bool. return whether the time budget ran out or not
+    :return: list of valence dicts or None. (all_valence, timed_out) if return_timed_out
+    """
+    # the cache is not shared among calls unless it is given explicitly
+    if valence_cache is None:
+        valence_cache = {}
+    deadline = None if time_budget is None else time.monotonic() + time_budget
+    timed_out = False
     target_valence = None
     if material:
         # some value of variables is incredibly large and make the number of element to be negative
@@ -319,8 +412,7 @@ def get_material_valence(material, valence_cache={}):
     else:
         all_comps = []
         var_mapping = []
-    all_valence = []
-    valence_state_counter = collections.Counter()
+    all_oxi_states = [None] * len(all_comps)
     for i, tmp_comp in enumerate(all_comps):
         if not tmp_comp:
             continue
@@ -328,28 +420,318 @@ def get_material_valence(material, valence_cache={}):
         oxi_state = None
         if mat_RCFormula in valence_cache:
             oxi_state = valence_cache[mat_RCFormula]
+            metrics.inc('valence_solver_cache_requests', help_text=CACHE_REQUESTS_HELP, result='hit')
+        elif timed_out:
+            continue
         else:
+            metrics.inc('valence_solver_cache_requests', help_text=CACHE_REQUESTS_HELP, result='miss')
+            remaining_time = None
+            if deadline is not None:
+                remaining_time = max(deadline - time.monotonic(), 0)
+            comments = []
+            # warm start from the nearest solved composition in the same chemical system
+            initial_solution = None
+            if isinstance(valence_cache, ValenceCache):
+                initial_solution = valence_cache.get_nearest(tmp_comp.composition)
+            is_usual = False
             try:
-                oxi_state, _, _ = CompositionInHouse.get_most_possible_oxi_state_of_composition(tmp_comp.composition)
+                with slow_log.stage(' '.join(
+                    '{}{}'.format(el, amt) for el, amt in tmp_comp.composition.items()
+                )):
+                    oxi_state, is_usual, comments = CompositionInHouse.get_most_possible_oxi_state_of_composition(
+                        tmp_comp.composition,
+                        time_budget=remaining_time,
+                        initial_solution=initial_solution,
+                    )
             except:
                 oxi_state = None
-            if oxi_state and oxi_state[0]:
-                oxi_state = oxi_state[0]
-                # store in cache:
-                valence_cache[mat_RCFormula] = oxi_state
-            else:
-                oxi_state = None
-        if oxi_state:
-            all_valence.append({
-                'valence': oxi_state,
-                'amounts_vars': var_mapping[i],
-                'elements': tmp_comp.composition,
-            })
-            
-    all_valence = merge_valence(all_valence)
-    if len(all_valence) == 0:
-        all_valence = None
+            # solutions certified within the budget are complete even if the clock ran out
+            if CompositionInHouse.TIME_BUDGET_WARNING in comments:
+                timed_out = True
+            oxi_state = store_in_valence_cache(
+                valence_cache,
+                mat_RCFormula,
+                tmp_comp.composition,
+                oxi_state,
+                is_usual,
+                comments,
+            )
+        all_oxi_states[i] = oxi_state
+
+    all_valence = collect_material_valence(all_comps, var_mapping, all_oxi_states)
 
+    if return_timed_out:
+        return all_valence, timed_out
     return all_valence
-    
 
+
+def get_valence_pattern(oxi_state, oxi_details, is_usual, comments):
+    """
+    pattern of a solution: elements with a fixed integer valence and elements with mixed
+    valence, together with is_usual and comments. The pattern is piecewise constant along
+    composition variables.
+
+    :param oxi_state: dict of {el: valence}
+    :param oxi_details: dict of {(el, state): number of ions}
+    :return: tuple
+    """
+    has_compensator = any(el == 'X' and v > 0 for (el, _), v in oxi_details.items())
+    return (
+        is_usual,
+        tuple(comments),
+        has_compensator,
+        tuple(sorted(
+            (el, v if float(v).is_integer() else None) for el, v in oxi_state.items()
+        )),
+    )
+
+
+def interpolate_valence(pattern, composition, low_valence, high_valence, target_charge=0):
+    """
+    get valence of a composition by charge balance, assuming the solutions at two ends
+    of an interval of variables have the same pattern. It only works when at most one
+    element has mixed valence and the valence is between the values at the two ends.
+
+    :param pattern: pattern from get_valence_pattern()
+    :param composition: dict of {ele: amount}
+    :param low_valence: dict of {ele: valence} at one end
+    :param high_valence: dict of {ele: valence} at the other end
+    :return: dict of {ele: valence} or None if the valence cannot be determined by the pattern
+    """
+    _, _, has_compensator, el_valence = pattern
+    el_valence = dict(el_valence)
+    # compensator "X" is not in the composition, so charge balance cannot be applied
+    if has_compensator or set(el_valence) != set(composition):
+        return None
+    mixed_els = [el for el, v in el_valence.items() if v is None]
+    if len(mixed_els) > 1:
+        return None
+    valence = {el: v for el, v in el_valence.items() if v is not None}
+    fixed_charge = sum(composition[el] * valence[el] for el in valence)
+    if len(mixed_els) == 0:
+        if abs(fixed_charge - target_charge) > 1e-6:
+            return None
+    else:
+        el = mixed_els[0]
+        valence[el] = (target_charge - fixed_charge) / composition[el]
+        bounds = (low_valence[el], high_valence[el])
+        if not (min(bounds) - 1e-9 <= valence[el] <= max(bounds) + 1e-9):
+            return None
+    return {el: valence[el] for el in composition}
+
+
+def get_material_valence_sweep(composition,
+                               amounts_vars=None,
+                               elements_vars=None,
+                               resolution=0.01):
+    """
+    valence map of a material with variables over a dense grid of values, e.g.
+    Li1+xMn2-xO4 with x from min_value to max_value in steps of resolution.
+    The pattern of the most possible solution (which element has mixed valence and the
+    valence of other elements) is piecewise constant along a variable. The compositions at both ends of an interval
+    are solved. If the patterns are the same and the valence of every point in between
+    is determined by charge balance, the interior points are interpolated. Otherwise,
+    the interval is bisected. Therefore, the solver is mainly called around the
+    breakpoints of the pattern rather than at every point.
+    The last variable with a range is swept, the other variables take all their values.
+
+    :param composition: same as to_GeneralMat_obj()
+    :param amounts_vars: same as to_GeneralMat_obj()
+    :param elements_vars: same as to_GeneralMat_obj()
+    :param resolution: float. step of variables given by min_value and max_value
+    :return: list of dicts, one for each valid point of variables
+        {
+            'amounts_vars': {var: value},
+            'elements': {ele: amount},
+            'valence': {ele: valence} or None,
+            'is_usual': bool,
+            'comments': list of str. INTERPOLATED_COMMENT is appended if interpolated,
+            'solved': bool. False if the valence is interpolated,
+        }
+    """
+    composition, fraction_vars = get_composition_and_fraction_vars(
+        composition,
+        amounts_vars=amounts_vars,
+        elements_vars=elements_vars,
+    )
+    try:
+        mat_obj = VariableComposition(composition, fraction_vars=fraction_vars)
+    except Exception:
+        return []
+    all_vars = mat_obj.all_vars
+
+    var_values = {}
+    sweep_var = None
+    for var in all_vars:
+        values = fraction_vars[var]
+        if isinstance(values, dict):
+            num_steps = int(round((values['max'] - values['min']) / resolution))
+            values = [
+                round(values['min'] + i * resolution, 10)
+                for i in range(max(num_steps, 0) + 1)
+            ]
+            sweep_var = var
+        var_values[var] = list(values)
+    other_vars = [var for var in all_vars if var != sweep_var]
+
+    def solve_point(comp, initial_solution=None):
+        try:
+            oxi_state, is_usual, comments, oxi_details = \
+                CompositionInHouse.get_most_possible_oxi_state_of_composition(
+                    comp,
+                    return_details=True,
+                    initial_solution=initial_solution,
+                )
+        except Exception:
+            oxi_state = None
+        if not oxi_state or not oxi_state[0]:
+            return None, None
+        return {
+            'valence': oxi_state[0],
+            'is_usual': is_usual,
+            'comments': comments,
+            'solved': True,
+        }, get_valence_pattern(oxi_state[0], oxi_details[0], is_usual, comments)
+
+    all_points = []
+    for other_values in itertools.product(*[var_values[var] for var in other_vars]):
+        line = []
+        sweep_values = var_values[sweep_var] if sweep_var else [None]
+        # amounts of all points on the line are evaluated at once
+        line_values = {var: [value] * len(sweep_values) for var, value in zip(other_vars, other_values)}
+        if sweep_var:
+            line_values[sweep_var] = sweep_values
+        try:
+            amounts, is_valid = mat_obj.evaluate(line_values)
+        except Exception:
+            continue
+        for i, sweep_value in enumerate(sweep_values):
+            # skip wrong compositions where the number of element is negative
+            if not is_valid[i]:
+                continue
+            point_vars = dict(zip(other_vars, other_values))
+            if sweep_var:
+                point_vars[sweep_var] = sweep_value
+            line.append({'amounts_vars': point_vars, 'elements': mat_obj.to_composition(amounts[i])})
+
+        # bisection along the sweep variable
+        patterns = [None] * len(line)
+        solved = [False] * len(line)
+
+        def solve_index(i, initial_solution=None):
+            if not solved[i]:
+                result, patterns[i] = solve_point(line[i]['elements'], initial_solution)
+                line[i].update(result or {
+                    'valence': None, 'is_usual': False, 'comments': [], 'solved': True,
+                })
+                solved[i] = True
+
+        intervals = [(0, len(line) - 1)] if line else []
+        while intervals:
+            low, high = intervals.pop()
+            solve_index(low)
+            # warm start from the other end of the interval
+            solve_index(high, line[low].get('valence'))
+            if high - low <= 1:
+                continue
+            interior = None
+            if patterns[low] is not None and patterns[low] == patterns[high]:
+                interior = []
+                for i in range(low + 1, high):
+                    valence = interpolate_valence(
+                        patterns[low],
+                        line[i]['elements'],
+                        line[low]['valence'],
+                        line[high]['valence'],
+                    )
+                    if valence is None:
+                        interior = None
+                        break
+                    interior.append(valence)
+            if interior is None:
+                mid = (low + high) // 2
+                intervals.append((mid, high))
+                intervals.append((low, mid))
+                continue
+            for i, valence in zip(range(low + 1, high), interior):
+                # is_usual and comments are those of the pattern shared by both ends
+                line[i].update({
+                    'valence': valence,
+                    'is_usual': line[low]['is_usual'],
+                    'comments': list(line[low]['comments']) + [INTERPOLATED_COMMENT],
+                    'solved': False,
+                })
+                solved[i] = True
+        all_points.extend(line)
+
+    return all_points
+
+
+def get_most_possible_oxi_states_in_threads(compositions, max_workers=None, **kwargs):
+    """
+    solve a batch of compositions with a thread pool, for thread-based workers where
+    processes are not available. The solvers are thread-safe: the table of oxidation
+    state probabilities is loaded once under a lock, each solve builds its own pulp
+    model, and CBC runs as a subprocess with uniquely named temporary files. Because
+    CBC runs outside the interpreter, threads also overlap the solving time.
+
+    :param compositions: list of plain dicts or plain strings that pymatgen can interpret
+    :param max_workers: int. number of threads, default of ThreadPoolExecutor if None
+    :param kwargs: other parameters of CompositionInHouse.get_most_possible_oxi_state_of_composition()
+    :return: list of results of CompositionInHouse.get_most_possible_oxi_state_of_composition()
+        in the same order as compositions
+    """
+    def solve(composition):
+        return CompositionInHouse.get_most_possible_oxi_state_of_composition(
+            composition,
+            **kwargs
+        )
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(solve, compositions))
+
+
+# cache of the current worker process, set by _init_valence_worker()
+_worker_valence_cache = None
+
+
+def _init_valence_worker(valence_cache):
+    global _worker_valence_cache
+    _worker_valence_cache = valence_cache
+
+
+def _solve_material_valence(material):
+    tmp_mat_obj = to_GeneralMat_obj(
+        composition=material['composition'],
+        amounts_vars=material.get('amounts_vars'),
+        elements_vars=material.get('elements_vars')
+    )
+    return get_material_valence(tmp_mat_obj, valence_cache=_worker_valence_cache)
+
+
+def get_material_valences_in_processes(materials, processes=None, valence_cache=None, chunksize=16):
+    """
+    solve valence of a batch of materials with a process pool. All workers share one
+    valence cache in shared memory, so that a composition solved by one worker is
+    reused by the others, the same as in a single process.
+
+    :param materials: list of dicts {'composition': ..., 'amounts_vars': ..., 'elements_vars': ...}
+        parameters of to_GeneralMat_obj()
+    :param processes: int. number of processes, os.cpu_count() if None
+    :param valence_cache: SharedValenceCache. if None, a cache is created for the batch
+    :param chunksize: int. number of materials sent to a worker at a time
+    :return: list of results of get_material_valence() in the same order as materials
+    """
+    own_cache = valence_cache is None
+    if own_cache:
+        valence_cache = SharedValenceCache()
+    try:
+        with multiprocessing.Pool(
+            processes=processes,
+            initializer=_init_valence_worker,
+            initargs=(valence_cache, ),
+        ) as pool:
+            return pool.map(_solve_material_valence, materials, chunksize=chunksize)
+    finally:
+        if own_cache:
+            valence_cache.unlink()
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+from collections.abc import ItemsView, ValuesView
+
+from .results import OxiStateResult
+
+"""
+Cache of solved compositions for get_material_valence(), which also finds the nearest
+cached composition in the same chemical system. Its solution is used as the hint to
+warm start the solver for compositions in doping series and variable sweeps.
+Solutions are kept as compact OxiStateResult objects and converted to valence dicts
+when read.
+"""
+
+__author__ = 'Tanjin He'
+__maintainer__ = 'Tanjin He'
+__email__ = 'tanjin_he@berkeley.edu'
+
+
+def _to_result(value):
+    if isinstance(value, OxiStateResult):
+        return value
+    return OxiStateResult([value] if value else [], True, [])
+
+
+class ValenceCache(dict):
+    """
+    dict of {composition string: valence} as valence_cache of get_material_valence(),
+    with an index of compositions by chemical system
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        # chemical system -> list of (atomic fractions, OxiStateResult)
+        self._chemsys_index = {}
+        self.update(*args, **kwargs)
+
+    def __getitem__(self, key):
+        return super().__getitem__(key).valence
+
+    def __setitem__(self, key, value):
+        """
+        :param value: dict of {ele: valence} or OxiStateResult
+        """
+        super().__setitem__(key, _to_result(value))
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def get_result(self, key):
+        """
+        :return: OxiStateResult with the comments of the solution
+        """
+        return super().__getitem__(key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def values(self):
+        return ValuesView(self)
+
+    def items(self):
+        return ItemsView(self)
+
+    def to_dict(self):
+        """
+        :return: dict of {composition string: valence}, the format of a plain dict cache
+            to be saved with json
+        """
+        return dict(self.items())
+
+    def __reduce__(self):
+        # the results and the chemsys index are restored by __setstate__()
+        return self.__class__, (), {
+            'results': dict(super().items()),
+            'chemsys_index': self._chemsys_index,
+        }
+
+    def __setstate__(self, state):
+        for key, result in state['results'].items():
+            super().__setitem__(key, result)
+        self._chemsys_index = state['chemsys_index']
+
+    def add(self, key, composition, result):
+        """
+        :param key: str. key of the composition in the cache
+        :param composition: dict of {ele: amount}
+        :param result: dict of {ele: valence} or OxiStateResult
+        """
+        result = _to_result(result)
+        self[key] = result
+        chemsys = tuple(sorted(composition))
+        total = float(sum(composition.values()))
+        fractions = {el: amt / total for el, amt in composition.items()}
+        self._chemsys_index.setdefault(chemsys, []).append((fractions, result))
+
+    def get_nearest(self, composition):
+        """
+        :param composition: dict of {ele: amount}
+        :return: valence of the cached composition in the same chemical system with the
+            smallest difference of atomic fractions, or None if there is no such composition
+        """
+        candidates = self._chemsys_index.get(tuple(sorted(composition)))
+        if not candidates:
+            return None
+        total = float(sum(composition.values()))
+        fractions = {el: amt / total for el, amt in composition.items()}
+        _, result = min(
+            candidates,
+            key=lambda x: sum(abs(x[0][el] - fractions[el]) for el in fractions)
+        )
+        return result.valence
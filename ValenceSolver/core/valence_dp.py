@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+"""
+Dynamic programming over charge sums for oxidation states.
+The functions here are pure numerical routines. The scores/weights of
+oxidation states are looked up by CompositionInHouse and passed in.
+"""
+
+__author__ = 'Tanjin He'
+__maintainer__ = 'Tanjin He'
+__email__ = 'tanjin_he@berkeley.edu'
+
+
+def _power_poly(base, n):
+    """
+    n-th power of a polynomial by repeated convolution
+
+    :param base: np.array. coefficients of the polynomial
+    :param n: int. power
+    :return: np.array. coefficients of base**n
+    """
+    result = np.ones(1)
+    for _ in range(n):
+        result = np.convolve(result, base)
+    return result
+
+
+def _tilt_weights(log_weights, states, theta):
+    """
+    exponential tilting of the weights of one element, w_s*exp(theta*s), normalized
+
+    :return: np.array of the tilted weights
+    """
+    tilted = log_weights + theta * states
+    tilted = np.exp(tilted - tilted.max())
+    return tilted / tilted.sum()
+
+
+def _get_tilt(all_log_weights, all_states, all_amts, target_charge):
+    """
+    find theta so that the mean charge of the tilted distribution is target_charge.
+    The mean is monotonically increasing with theta, so bisection is used.
+    """
+    def mean_charge(theta):
+        return sum(
+            amt * np.dot(_tilt_weights(log_w, states, theta), states)
+            for log_w, states, amt in zip(all_log_weights, all_states, all_amts)
+        )
+
+    low, high = -50.0, 50.0
+    for _ in range(100):
+        mid = (low + high) / 2
+        if mean_charge(mid) < target_charge:
+            low = mid
+        else:
+            high = mid
+    return (low + high) / 2
+
+
+def get_marginal_oxi_states(all_els,
+                            all_oxi_states,
+                            all_el_amts,
+                            all_weights,
+                            target_charge=0):
+    """
+    exact marginal distribution of oxidation states over all charge-balanced
+    assignments. Each ion independently takes an oxidation state with a probability
+    proportional to its weight, and the distribution is conditioned on the total
+    charge being target_charge. For each element the polynomial
+    (sum_s w_s*z^s)^amount is the distribution of its charge sum, the product of the
+    polynomials is the distribution of the total charge (sum-product DP over charge
+    sums), and the marginal of state s of element e is
+
+        amount_e*w_s*[z^(target-s)] (sum_s w_s*z^s)^(amount_e-1) prod_{f!=e} P_f / [z^target] prod_f P_f
+
+    The cost is polynomial in the number of atoms. To avoid underflow when the target
+    charge is far in the tail, the weights are exponentially tilted so that the mean
+    charge equals the target. The conditioned distribution is invariant to tilting.
+
+    :param all_els: list of elements
+    :param all_oxi_states: dict of {el: (v1, v2, ...)}. possible valence states for each element
+    :param all_el_amts: dict of {el: amount}. amounts must be integers
+    :param all_weights: dict of {el: {state: weight}}. non-negative weights of states
+    :param target_charge: int. total charge
+    :return: dict of {el: {state: probability}}. the probability that an ion of the
+        element takes the state. Empty if no charge-balanced assignment has positive weight
+    """
+    all_states = []
+    all_log_weights = []
+    all_amts = []
+    for el in all_els:
+        states = [s for s in all_oxi_states[el] if all_weights[el].get(s, 0) > 0]
+        if len(states) == 0:
+            return {}
+        states = np.array(sorted(states), dtype=float)
+        all_states.append(states)
+        all_log_weights.append(np.log([all_weights[el][s] for s in states]))
+        all_amts.append(int(all_el_amts[el]))
+
+    if not (sum(amt * states.min() for amt, states in zip(all_amts, all_states))
+            <= target_charge
+            <= sum(amt * states.max() for amt, states in zip(all_amts, all_states))):
+        return {}
+    theta = _get_tilt(all_log_weights, all_states, all_amts, target_charge)
+
+    # polynomials as (charge of the first coefficient, coefficients)
+    all_bases = []
+    all_polys = []
+    for log_w, states, amt in zip(all_log_weights, all_states, all_amts):
+        low = int(states.min())
+        base = np.zeros(int(states.max()) - low + 1)
+        base[states.astype(int) - low] = _tilt_weights(log_w, states, theta)
+        base_power = _power_poly(base, amt - 1)
+        all_bases.append((low, base, base_power))
+        all_polys.append((low * amt, np.convolve(base_power, base)))
+
+    # prefix[i] is the product of polynomials before i, suffix[i] after i
+    prefix = [(0, np.ones(1))]
+    for offset, poly in all_polys:
+        prefix.append((prefix[-1][0] + offset, np.convolve(prefix[-1][1], poly)))
+    suffix = [(0, np.ones(1))]
+    for offset, poly in reversed(all_polys):
+        suffix.append((suffix[-1][0] + offset, np.convolve(suffix[-1][1], poly)))
+    suffix = suffix[::-1][1:]
+
+    total_offset, total = prefix[-1]
+    if not (0 <= target_charge - total_offset < len(total)):
+        return {}
+    partition = total[target_charge - total_offset]
+    if partition <= 0:
+        return {}
+
+    marginals = {}
+    for i, el in enumerate(all_els):
+        low, base, base_power = all_bases[i]
+        rest_offset = low * (all_amts[i] - 1) + prefix[i][0] + suffix[i][0]
+        rest = np.convolve(np.convolve(prefix[i][1], suffix[i][1]), base_power)
+        marginals[el] = {}
+        for state in all_oxi_states[el]:
+            index = target_charge - state - rest_offset
+            prob = 0.0
+            if state - low >= 0 and state - low < len(base) and 0 <= index < len(rest):
+                prob = base[state - low] * rest[index] / partition
+            marginals[el][state] = float(prob)
+    return marginals
+
+
+def _max_plus_power(states, scores, amt):
+    """
+    best score of each charge sum of amt ions of one element (max-plus power of the
+    polynomial sum_s c_s*z^s), with the choice of each ion for backtracking
+
+    :return: (low, best, choices)
+        low: int. charge of best[0]
+        best: np.array. best[j] is the best score with charge sum low*amt + j, -inf if infeasible
+        choices: list of np.array. choices[k][j] is the index of the state of the k-th ion
+            in the best assignment of k+1 ions with charge sum low*(k+1) + j
+    """
+    low = int(states.min())
+    shifts = (states - low).astype(int)
+    best = np.zeros(1)
+    choices = []
+    for _ in range(amt):
+        candidates = np.full((len(states), len(best) + shifts.max()), -np.inf)
+        for i, (shift, score) in enumerate(zip(shifts, scores)):
+            candidates[i, shift: shift + len(best)] = best + score
+        choice = np.argmax(candidates, axis=0)
+        best = candidates[choice, np.arange(candidates.shape[1])]
+        choices.append(choice)
+    return low, best, choices
+
+
+def get_max_score_by_charge(all_els,
+                            all_oxi_states,
+                            all_el_amts,
+                            all_scores,
+                            min_charge,
+                            max_charge):
+    """
+    most possible assignment of oxidation states for every total charge in a range.
+    The score of an assignment is the sum of the scores of the ions, the same objective
+    as get_most_possible_solution(). The best score of each charge sum of one element is
+    a max-plus power of its states, and the best score of each total charge is the
+    max-plus product over elements (max-product DP over charge sums), so all target
+    charges are solved in one pass instead of one linear programming each.
+
+    :param all_els: list of elements
+    :param all_oxi_states: dict of {el: (v1, v2, ...)}. possible valence states for each element
+    :param all_el_amts: dict of {el: amount}. amounts must be integers
+    :param all_scores: dict of {el: {state: score}}
+    :param min_charge: int. lowest total charge
+    :param max_charge: int. highest total charge
+    :return: dict of {charge: (score, {el: {state: number of ions}})} for each feasible
+        charge in [min_charge, max_charge]
+    """
+    all_states = []
+    # (lowest state, choices of ions) of each element
+    all_tables = []
+    # best score of each total charge of the elements so far, with the charge sum of
+    # the last element in the best assignment
+    offset = 0
+    total = np.zeros(1)
+    all_parts = []
+    for el in all_els:
+        states = [s for s in all_oxi_states[el] if all_scores[el].get(s) is not None]
+        amt = int(all_el_amts[el])
+        if len(states) == 0 and amt > 0:
+            return {}
+        states = np.array(sorted(states), dtype=int)
+        scores = np.array([all_scores[el][s] for s in states], dtype=float)
+        if amt > 0:
+            low, best, choices = _max_plus_power(states, scores, amt)
+        else:
+            low, best, choices = 0, np.zeros(1), []
+        all_states.append(states)
+        all_tables.append((low, choices))
+
+        candidates = np.full((len(best), len(total) + len(best) - 1), -np.inf)
+        for j, score in enumerate(best):
+            candidates[j, j: j + len(total)] = total + score
+        part = np.argmax(candidates, axis=0)
+        total = candidates[part, np.arange(candidates.shape[1])]
+        all_parts.append(part)
+        offset += low * amt
+
+    solutions = {}
+    for charge in range(min_charge, max_charge + 1):
+        index = charge - offset
+        if not (0 <= index < len(total)) or total[index] == -np.inf:
+            continue
+        counts = {}
+        for i in reversed(range(len(all_els))):
+            el = all_els[i]
+            states = all_states[i]
+            low, choices = all_tables[i]
+            j = int(all_parts[i][index])
+            index -= j
+            counts[el] = {int(s): 0 for s in states}
+            for choice in reversed(choices):
+                state = int(states[choice[j]])
+                counts[el][state] += 1
+                j -= state - low
+        solutions[charge] = (
+            float(total[charge - offset]),
+            {el: counts[el] for el in all_els},
+        )
+    return solutions
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import itertools
+
+import numpy as np
+from sympy import lambdify
+from sympy.parsing.sympy_parser import parse_expr
+
+"""
+A lightweight model of compositions with variables, e.g. Li1+xMn2-xO4 with x in [0, 0.2].
+The amount of each element is an expression of variables, which is evaluated over
+many values of variables at once with numpy.
+"""
+
+__author__ = 'Tanjin He'
+__maintainer__ = 'Tanjin He'
+__email__ = 'tanjin_he@berkeley.edu'
+
+
+class CriticalComposition(object):
+    """
+    a composition instance after substituting values of variables
+    """
+    __slots__ = ('composition', )
+
+    def __init__(self, composition):
+        """
+        :param composition: dict of {ele: amount}
+        """
+        self.composition = composition
+
+    def __repr__(self):
+        return 'CriticalComposition({})'.format(self.composition)
+
+
+class VariableComposition(object):
+    """
+    composition whose amounts are expressions of variables. Same interface as
+    GeneralComposition in Synthepedia used by get_material_valence().
+    """
+
+    def __init__(self, composition, fraction_vars=None):
+        """
+        :param composition: dict of {ele: expression of amount}, e.g. {'Li': '1+x', 'O': '4'}
+        :param fraction_vars: dict of {var: list of values or {'min': min, 'max': max}}
+        :raise ValueError: if an expression cannot be parsed or contains unknown variables
+        """
+        self.composition = composition
+        self.fraction_vars = fraction_vars or {}
+        self.all_vars = sorted(self.fraction_vars.keys())
+        self.elements = list(composition.keys())
+        self._amount_funcs = []
+        for ele in self.elements:
+            try:
+                expr = parse_expr(str(composition[ele]))
+            except Exception:
+                raise ValueError('cannot parse amount of {}: {}'.format(ele, composition[ele]))
+            unknown_vars = set(str(x) for x in expr.free_symbols) - set(self.all_vars)
+            if unknown_vars:
+                raise ValueError('unknown variables {} in amount of {}'.format(unknown_vars, ele))
+            self._amount_funcs.append(lambdify(self.all_vars, expr, 'numpy'))
+
+    @property
+    def contain_vars(self):
+        return len(self.all_vars) > 0
+
+    def get_critical_values(self):
+        """
+        :return: dict of {var: list of values}. all values for a list of values, both ends
+            for a range
+        """
+        critical_values = {}
+        for var in self.all_vars:
+            values = self.fraction_vars[var]
+            if isinstance(values, dict):
+                values = [values.get('min', 0.0), values.get('max', 0.0)]
+            critical_values[var] = sorted(set(float(v) for v in values))
+        return critical_values
+
+    def evaluate(self, var_values):
+        """
+        amounts of all elements at many values of variables at once
+
+        :param var_values: dict of {var: np.array of values}. arrays have the same length n
+        :return: (amounts, is_valid)
+            amounts: np.array of shape (n, number of elements), rounded to 10 decimals
+            is_valid: np.array of bool of shape (n, ). False if any amount is negative or
+                not finite, or all amounts are 0
+        """
+        arrays = [np.asarray(var_values[var], dtype=float) for var in self.all_vars]
+        num_points = len(arrays[0]) if arrays else 1
+        amounts = np.empty((num_points, len(self.elements)))
+        with np.errstate(all='ignore'):
+            for i, func in enumerate(self._amount_funcs):
+                amounts[:, i] = np.broadcast_to(np.asarray(func(*arrays), dtype=float), (num_points, ))
+        amounts = np.round(amounts, 10)
+        is_valid = np.all(np.isfinite(amounts), axis=1)
+        is_valid &= np.all(np.nan_to_num(amounts) >= 0, axis=1)
+        is_valid &= np.any(np.nan_to_num(amounts) > 0, axis=1)
+        return amounts, is_valid
+
+    def to_composition(self, amounts):
+        """
+        :param amounts: one row of amounts from evaluate()
+        :return: dict of {ele: amount} without elements of amount 0
+        """
+        return {ele: float(amt) for ele, amt in zip(self.elements, amounts) if amt > 0}
+
+    def get_critical_compositions(self, skip_wrong_composition=False, return_variable_mapping=False):
+        """
+        composition instances at all combinations of critical values of variables
+
+        :param skip_wrong_composition: bool. if True, wrong compositions (negative amounts)
+            are None in the list. Otherwise, ValueError is raised.
+        :param return_variable_mapping: bool. return values of variables of each
+            composition or not
+        :return: list of CriticalComposition or None.
+            (compositions, variable mappings) if return_variable_mapping, where each
+            variable mapping is a dict of {var: value}
+        """
+        critical_values = self.get_critical_values()
+        all_mappings = [
+            dict(zip(self.all_vars, values))
+            for values in itertools.product(*[critical_values[var] for var in self.all_vars])
+        ]
+        var_values = {
+            var: np.array([mapping[var] for mapping in all_mappings]) for var in self.all_vars
+        }
+        amounts, is_valid = self.evaluate(var_values)
+        if not skip_wrong_composition and not np.all(is_valid):
+            raise ValueError('wrong composition for some values of variables: {}'.format(
+                self.composition
+            ))
+        all_comps = [
+            CriticalComposition(self.to_composition(amounts[i])) if is_valid[i] else None
+            for i in range(len(all_mappings))
+        ]
+        if return_variable_mapping:
+            return all_comps, all_mappings
+        return all_comps
@@ -7,6 +7,7 @@ import collections
 from pprint import pprint
 
 from ValenceSolver.core.utils import to_GeneralMat_obj, get_material_valence
+from ValenceSolver.core.reactions import annotate_reactions
 
 __author__ = 'Tanjin He'
 __maintainer__ = 'Tanjin He'
@@ -20,24 +21,23 @@ if __name__ == "__main__":
     reactions = reactions['reactions']
 
     print('len(reactions)', len(reactions))
-    solver_counter = collections.Counter()
     random.shuffle(reactions)
     valence_cache = {}
-    for i, reaction in enumerate(reactions):
-    #     target
-    #     generate Material object from entire composition for general usage
-        tmp_mat_obj = to_GeneralMat_obj(
-            composition=reaction['target']['composition'],
-            amounts_vars=reaction['target']['amounts_vars'],
-            elements_vars=reaction['reaction']['element_substitution']
-        )
-        valence = get_material_valence(tmp_mat_obj, valence_cache=valence_cache)
-        reaction['target']['valence'] = valence
+    # valence of the target and each composition of the precursors,
+    # solved in batches with compositions deduplicated across reactions
+    solver_counter = collections.Counter()
+    batch_size = 1000
+    for i in range(0, len(reactions), batch_size):
+        solver_counter.update(annotate_reactions(
+            reactions[i: i+batch_size],
+            valence_cache=valence_cache,
+            max_workers=8,
+        ))
 
     # #     generate Material object from each dict in composition
     # #     only use this when we want to generate valence for each dict in composition
+    # for reaction in reactions:
     #     for tmp_comp in reaction['target']['composition']:
-    #         solver_counter['target comp'] += 1
     #         tmp_mat_obj = to_GeneralMat_obj(
     #             composition=tmp_comp,
     #             amounts_vars=reaction['target']['amounts_vars'],
@@ -45,44 +45,6 @@ if __name__ == "__main__":
     #         )
     #         valence = get_material_valence(tmp_mat_obj, valence_cache=valence_cache)
     #         tmp_comp['valence'] = valence
-    #
-    #         if tmp_mat_obj is None:
-    #             solver_counter['target no mat_obj'] += 1
-    #         elif valence is None:
-    #             solver_counter['target valence not solved'] += 1
-    #         else:
-    #             solver_counter['target valence solved'] += 1
-    #
-    #         if valence is None and tmp_mat_obj is not None:
-    #             print(valence)
-    #             error_comps = tmp_mat_obj.get_critical_compositions(
-    #                     skip_wrong_composition=True
-    #             )
-    #             print(reaction['doi'])
-    #             pprint(reaction['targets_string'])
-    #             for c in error_comps:
-    #                 print(c.composition)
-
-    #     precursor
-        for tmp_pre in reaction['precursors']:
-            for tmp_comp in tmp_pre['composition']:
-                solver_counter['precursor comp'] += 1
-                tmp_mat_obj = to_GeneralMat_obj(
-                    composition=tmp_comp,
-                    amounts_vars=tmp_pre['amounts_vars'],
-                    elements_vars=reaction['reaction']['element_substitution']
-                )
-                valence = get_material_valence(tmp_mat_obj, valence_cache=valence_cache)
-                tmp_comp['valence'] = valence
-
-                if tmp_mat_obj is None:
-                    solver_counter['precursor no mat_obj'] += 1
-                elif valence is None:
-                    solver_counter['precursor valence not solved'] += 1
-                else:
-                    solver_counter['precursor valence solved'] += 1
-
-
 
     print('len(valence_cache)', len(valence_cache))
     print(solver_counter)
@@ -1,10 +1,35 @@
 # -*- coding: utf-8 -*-
+import collections
+import collections.abc
 import copy
+import io
+import json
+import os
+import pickle
+import tempfile
 import unittest
 from pprint import pprint
+from unittest import mock
+
+import numpy as np
+from pymatgen.core import Composition
 
 from ValenceSolver.core.composition_inhouse import CompositionInHouse
 from ValenceSolver.core.utils import get_valence_single_composition
+from ValenceSolver.core.utils import get_material_valence_sweep, INTERPOLATED_COMMENT
+from ValenceSolver.core.utils import to_GeneralMat_obj, get_material_valence
+from ValenceSolver.core import metrics
+from ValenceSolver.core import slow_log
+from ValenceSolver.core import precomputed
+from ValenceSolver.core.precomputed import build_index, get_precomputed_index
+from ValenceSolver.core.valence_cache import ValenceCache
+from ValenceSolver.core.results import OxiStateResult
+from ValenceSolver.core.export import ValenceExporter, load_valence_rows, OXI_STATES
+from ValenceSolver.core.formula import get_el_amt, get_integer_el_amt
+from ValenceSolver.core.reactions import annotate_reactions, annotate_reaction
+from ValenceSolver.core.cli import solve_lines
+from ValenceSolver.core.incremental import hash_material_input, annotate_materials_incrementally
+from ValenceSolver.core.material_cache import MaterialValenceCache, get_material_key
 
 __author__ = 'Tanjin He'
 __maintainer__ = 'Tanjin He'
@@ -429,3 +454,703 @@ class ValenceTest(unittest.TestCase):
             print(case['composition'])
             print(cal_valence)
             print()
+
+    def test_greedy_solution(self):
+        # composition: whether the greedy assignment is certified as optimal
+        for composition, is_greedy_hit in [
+            ('Li2CO3', True),
+            ('YFeO3', True),
+            ('SrFeO2.5', True),
+            ('LiFePO4', False),
+            ('Nb(PO4)3', False),
+        ]:
+            comp = CompositionInHouse(composition)
+            comp = CompositionInHouse(comp.get_integer_formula_and_factor()[0])
+            els, el_amt, all_oxids = comp.get_oxid_state_guess_essentials(
+                all_metal_oxi_states=True,
+                add_compensator=True,
+            )
+            greedy = CompositionInHouse.get_greedy_solution(
+                els, all_oxids, el_amt, add_compensator=True
+            )
+            milp = CompositionInHouse.get_most_possible_solution(
+                els, all_oxids, el_amt, add_compensator=True
+            )
+            if is_greedy_hit:
+                self.assertTrue(greedy[0], composition)
+                self.assertEqual(milp[0], greedy[0])
+                self.assertEqual(milp[2], greedy[2])
+                self.assertAlmostEqual(milp[1], greedy[1])
+            else:
+                self.assertEqual({}, greedy[0], composition)
+        # YFeO3 is certified by the greedy assignment
+        solution, _, _ = CompositionInHouse.get_greedy_solution(
+            ['Y', 'Fe', 'O'],
+            {'Y': (3, ), 'Fe': (2, 3), 'O': (-2, )},
+            {'Y': 1, 'Fe': 1, 'O': 3},
+        )
+        self.assertEqual({'Y': 3.0, 'Fe': 3.0, 'O': -2.0}, solution)
+
+    def test_iter_oxi_state_guesses(self):
+        for composition in ['Fe3O4', 'LiFePO4', 'SrFeO3']:
+            comp = CompositionInHouse(composition)
+            all_sols = comp.oxi_state_guesses(**self.conditions)
+            lazy_sols = list(comp.iter_oxi_state_guesses(**self.conditions))
+            self.assertEqual(all_sols, lazy_sols)
+            top_sols = list(comp.iter_oxi_state_guesses(max_solutions=2, **self.conditions))
+            self.assertEqual(all_sols[:2], top_sols)
+            scored_sols = list(comp.iter_oxi_state_guesses(return_scores=True, **self.conditions))
+            scores = [score for _, score in scored_sols]
+            self.assertEqual(sorted(scores, reverse=True), scores)
+            cut_sols = list(comp.iter_oxi_state_guesses(min_score=scores[0], **self.conditions))
+            self.assertEqual(scores.count(scores[0]), len(cut_sols))
+
+    def test_oxi_state_marginals(self):
+        for composition in ['Fe3O4', 'CuFeO2', 'LiMnO2']:
+            comp = CompositionInHouse(composition)
+            marginals = comp.get_oxi_state_marginals(all_metal_oxi_states=True)
+            el_amt = comp.get_el_amt_dict()
+            for el in marginals:
+                self.assertAlmostEqual(1.0, sum(marginals[el].values()))
+            # the expected total charge is balanced
+            self.assertAlmostEqual(0.0, sum(
+                el_amt[el] * state * prob
+                for el in marginals for state, prob in marginals[el].items()
+            ))
+        marginals = CompositionInHouse('CuFeO2').get_oxi_state_marginals()
+        self.assertAlmostEqual(marginals['Cu'][1], marginals['Fe'][3])
+        self.assertEqual({}, CompositionInHouse('SrFeO3').get_oxi_state_marginals())
+
+    def test_k_most_possible_solutions(self):
+        comp = CompositionInHouse('Fe3O4')
+        conditions = {
+            'all_metal_oxi_states': True,
+            'add_compensator': True,
+        }
+        best_sols = comp._oxi_state_guesses_most_possible(**conditions)
+        all_sols, all_details, all_scores = comp._oxi_state_guesses_most_possible(
+            k=3, return_details=True, return_scores=True, **conditions
+        )
+        self.assertEqual(3, len(all_sols))
+        self.assertEqual(best_sols[0], all_sols[0])
+        self.assertEqual(sorted(all_scores, reverse=True), all_scores)
+        self.assertEqual(len(all_sols), len(set(str(sorted(sol.items())) for sol in all_sols)))
+        # same as the lazy enumeration of the distinct solutions
+        lazy_sols = list(comp.iter_oxi_state_guesses(max_solutions=3, **conditions))
+        self.assertEqual(lazy_sols, all_sols)
+        for sol, details in zip(all_sols, all_details):
+            self.assertEqual(sum(v for (el, _), v in details.items() if el == 'Fe'), 3)
+
+    def test_material_valence_sweep(self):
+        composition = {
+            'amount': '1.0',
+            'elements': {'Li': '1+x', 'Mn': '2-x', 'O': '4'},
+            'formula': 'Li1+xMn2-xO4',
+        }
+        amounts_vars = {'x': {'values': [], 'min_value': 0.0, 'max_value': 0.2}}
+        valence_map = get_material_valence_sweep(composition, amounts_vars, resolution=0.01)
+        self.assertEqual(21, len(valence_map))
+        self.assertLess(sum(point['solved'] for point in valence_map), len(valence_map))
+        for point in valence_map:
+            cal_valence, _, _ = CompositionInHouse.get_most_possible_oxi_state_of_composition(
+                point['elements']
+            )
+            for el, v in cal_valence[0].items():
+                self.assertAlmostEqual(v, point['valence'][el])
+            self.assertEqual(not point['solved'], INTERPOLATED_COMMENT in point['comments'])
+
+    def test_snap_amounts(self):
+        cal_valence, _, comments = CompositionInHouse.get_most_possible_oxi_state_of_composition(
+            'Na2Nb0.333Cr1.333(PO4)3',
+            snap_max_denominator=12,
+        )
+        self.assertEqual({'Na': 1.0, 'Nb': 5.0, 'Cr': 4.0, 'P': 5.0, 'O': -2.0}, cal_valence[0])
+        self.assertIn('Nb 0.333 -> 1/3', comments[-1])
+        # amounts already simple are not changed
+        _, snapped_amts = CompositionInHouse.snap_amounts({'Sr': 0.7, 'La': 0.3, 'O': 3.0})
+        self.assertEqual({}, snapped_amts)
+
+    def test_time_budget(self):
+        cal_valence, is_usual, comments = CompositionInHouse.get_most_possible_oxi_state_of_composition(
+            'SrFeO3',
+            time_budget=0,
+        )
+        self.assertEqual([], cal_valence)
+        self.assertIn(CompositionInHouse.TIME_BUDGET_WARNING, comments)
+        self.assertEqual(
+            CompositionInHouse.get_most_possible_oxi_state_of_composition('SrFeO3'),
+            CompositionInHouse.get_most_possible_oxi_state_of_composition('SrFeO3', time_budget=60),
+        )
+        # solutions certified by the greedy path are complete without any budget
+        self.assertEqual(
+            ([{'Fe': 3.0, 'O': -2.0}], True, []),
+            CompositionInHouse('Fe2O3').oxi_state_guesses_most_possible(time_budget=0),
+        )
+        material = to_GeneralMat_obj({'amount': '1.0', 'elements': {'Fe': '2', 'O': '3'}})
+        valence_cache = {}
+        valence, timed_out = get_material_valence(
+            material, valence_cache=valence_cache, time_budget=0, return_timed_out=True
+        )
+        self.assertFalse(timed_out)
+        self.assertEqual({'Fe': 3.0, 'O': -2.0}, valence[0]['valence'])
+        self.assertEqual(1, len(valence_cache))
+        material_cache = MaterialValenceCache()
+        material_cache.get_material_valence({'elements': {'Fe': '2', 'O': '3'}}, time_budget=0)
+        self.assertEqual(1, len(material_cache))
+
+    def test_infeasible_stage_is_not_timed_out(self):
+        with mock.patch.object(CompositionInHouse, 'precomputed_index_path', False):
+            # the default stage is infeasible, which is not a time out without any budget
+            self.assertEqual(
+                (
+                    [{'Ca': 2.0, 'Dy': 2.0, 'Si': 4.0, 'O': -2.0}],
+                    False,
+                    ['all possible positive valence states are used for metals'],
+                ),
+                CompositionInHouse.get_most_possible_oxi_state_of_composition('Ca2.97Dy0.03Si2O7'),
+            )
+            self.assertEqual(
+                ([{'Si': 0.0}], True, []),
+                CompositionInHouse.get_most_possible_oxi_state_of_composition('Si'),
+            )
+            # the solution of an alloy is complete without any budget
+            self.assertEqual(
+                ([{'Fe': 0.0, 'Ni': 0.0}], False, ['is alloy']),
+                CompositionInHouse.get_most_possible_oxi_state_of_composition('FeNi', time_budget=0),
+            )
+        _, timed_out = CompositionInHouse('Fe3O4')._oxi_state_guesses_most_possible(k=3, return_timed_out=True)
+        self.assertFalse(timed_out)
+        _, timed_out = CompositionInHouse('Fe3O4')._oxi_state_guesses_most_possible(
+            k=3, time_limit=0, return_timed_out=True
+        )
+        self.assertTrue(timed_out)
+
+    def test_metrics(self):
+        metrics.reset()
+        CompositionInHouse.get_most_possible_oxi_state_of_composition('Fe3O4')
+        CompositionInHouse.get_most_possible_oxi_state_of_composition('FeNi')
+        self.assertEqual(1, metrics.get_counter('valence_solver_relaxation_outcomes', outcome='is alloy'))
+        self.assertEqual(
+            2, metrics.get_counter('valence_solver_greedy_attempts', result='hit')
+            + metrics.get_counter('valence_solver_greedy_attempts', result='miss')
+        )
+        text = metrics.get_metrics_text()
+        self.assertIn('# TYPE valence_solver_composition_seconds histogram', text)
+        self.assertIn('valence_solver_composition_seconds_count 2', text)
+        self.assertIn('valence_solver_composition_seconds_bucket{le="+Inf"} 2', text)
+        self.assertIn('valence_solver_relaxation_outcomes_total{outcome="is alloy"} 1', text)
+        self.assertTrue(metrics.get_metrics_text(openmetrics=True).endswith('# EOF\n'))
+
+    def test_incremental_annotation(self):
+        composition = {'amount': '1.0', 'elements': {'Li': '1+x', 'Mn': '2-x', 'O': '4'}, 'formula': 'Li1+xMn2-xO4'}
+        amounts_vars = {'x': {'values': [0.1, 0.2]}}
+        input_hash = hash_material_input(composition, amounts_vars)
+        reordered = {'formula': 'LiMnO', 'elements': {'O': '4', 'Mn': '2-x', 'Li': '1+x'}, 'amount': '1.0'}
+        self.assertEqual(input_hash, hash_material_input(reordered, amounts_vars))
+        self.assertNotEqual(input_hash, hash_material_input(composition, {'x': {'values': [0.1]}}))
+
+        materials = {
+            'a': {'composition': composition, 'amounts_vars': amounts_vars},
+            'b': {'composition': {'amount': '1.0', 'elements': {'Fe': '2', 'O': '3'}}},
+        }
+        _, index, report = annotate_materials_incrementally(materials)
+        self.assertEqual(['a', 'b'], report['added'])
+        self.assertEqual(2, report['num_solved'])
+        # unchanged materials are taken from the index without solving
+        index['valence'][input_hash] = [{'valence': {'Li': 1.0}}]
+        materials['b'] = {'composition': {'amount': '1.0', 'elements': {'Fe': '3', 'O': '4'}}}
+        materials['c'] = {'composition': reordered, 'amounts_vars': amounts_vars}
+        del materials['a']
+        all_valence, new_index, report = annotate_materials_incrementally(materials, index=index)
+        self.assertEqual([{'valence': {'Li': 1.0}}], all_valence['c'])
+        self.assertEqual(['c'], report['added'])
+        self.assertEqual(['a'], report['removed'])
+        self.assertEqual(1, report['num_reused'])
+        self.assertEqual(1, report['num_solved'])
+        self.assertEqual({'b', 'c'}, set(new_index['materials']))
+
+    def test_precomputed_index(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'index.bin')
+            num_entries = build_index(path, elements=['Li', 'Fe', 'O'], max_atoms=7, max_elements=2)
+            self.assertEqual(num_entries, len(get_precomputed_index(path)))
+            default_path = CompositionInHouse.precomputed_index_path
+            try:
+                CompositionInHouse.precomputed_index_path = False
+                solved = CompositionInHouse.get_most_possible_oxi_state_of_composition('Fe2O3', return_details=True)
+                CompositionInHouse.precomputed_index_path = path
+                metrics.reset()
+                # Fe4O6 is reduced to Fe2O3 before lookup
+                for formula in ['Fe2O3', 'Fe4O6', 'Li2O', 'Fe3O4']:
+                    self.assertIsNotNone(get_precomputed_index(path).lookup(
+                        CompositionInHouse(formula).reduced_composition.get_el_amt_dict()
+                    ))
+                self.assertEqual(
+                    solved,
+                    CompositionInHouse.get_most_possible_oxi_state_of_composition('Fe4O6', return_details=True)
+                )
+                self.assertEqual(0, metrics.get_counter('valence_solver_greedy_attempts', result='hit'))
+                self.assertEqual(0, metrics.get_counter('valence_solver_greedy_attempts', result='miss'))
+                self.assertIsNone(get_precomputed_index(path).lookup({'Fe': 3, 'O': 5}))
+            finally:
+                CompositionInHouse.precomputed_index_path = default_path
+                get_precomputed_index(path).close()
+
+    def test_precomputed_index_mismatch(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'index.bin')
+            build_index(path, elements=['Fe', 'O'], max_atoms=5, max_elements=2)
+            old_format_path = os.path.join(tmp_dir, 'old_index.bin')
+            with open(old_format_path, 'wb') as fw:
+                fw.write(b'VSIDX001' + bytes(16))
+            self.assertIsNone(get_precomputed_index(old_format_path))
+            # an index built from another oxi_prob table or solver version is not used
+            with mock.patch.object(precomputed, '_fingerprint', b'\xff' * 16), \
+                    mock.patch.dict(precomputed._loaded_indexes, clear=True), \
+                    mock.patch.object(CompositionInHouse, 'precomputed_index_path', path):
+                self.assertIsNone(get_precomputed_index(path))
+                metrics.reset()
+                CompositionInHouse.get_most_possible_oxi_state_of_composition('Fe2O3')
+                self.assertEqual(0, metrics.get_counter('valence_solver_precomputed_lookups', result='hit'))
+                self.assertEqual(1, metrics.get_counter('valence_solver_greedy_attempts', result='hit'))
+            self.assertIsNotNone(get_precomputed_index(path).lookup({'Fe': 2, 'O': 3}))
+            get_precomputed_index(path).close()
+        # the fingerprint changes with the oxidation states of pymatgen
+        fingerprint = precomputed.get_solver_fingerprint()
+        with mock.patch.object(precomputed, '_fingerprint', None), \
+                mock.patch('pymatgen.core.__version__', '0.0.0'):
+            self.assertNotEqual(fingerprint, precomputed.get_solver_fingerprint())
+        self.assertEqual(fingerprint, precomputed.get_solver_fingerprint())
+
+    def test_variable_composition(self):
+        composition = {
+            'amount': '1.0',
+            'elements': {'Bi': 'x + 2.5', 'Na': '-x + 0.5', 'Nb': '2.0', 'O': '9.0'},
+            'formula': 'Na0.5-xBi2.5+xNb2O9',
+        }
+        mat_obj = to_GeneralMat_obj(composition, amounts_vars={'x': {'values': [0.05, 0.1]}})
+        valence = get_material_valence(mat_obj)
+        self.assertEqual([{'x': 0.05}], valence[0]['amounts_vars'])
+        self.assertEqual([{'Bi': 2.55, 'Na': 0.45, 'Nb': 2.0, 'O': 9.0}], valence[0]['elements'])
+        self.assertEqual({'Bi': 3.0, 'Na': 1.0, 'Nb': 4.95, 'O': -2.0}, valence[0]['valence'])
+        self.assertEqual({'Bi': 3.0, 'Na': 1.0, 'Nb': 4.9, 'O': -2.0}, valence[1]['valence'])
+        # compositions with negative amounts are skipped
+        mat_obj = to_GeneralMat_obj(composition, amounts_vars={'x': {'min_value': 0.0, 'max_value': 1.0}})
+        all_comps, var_mapping = mat_obj.get_critical_compositions(
+            skip_wrong_composition=True,
+            return_variable_mapping=True
+        )
+        self.assertEqual([{'x': 0.0}, {'x': 1.0}], var_mapping)
+        self.assertEqual({'Bi': 2.5, 'Na': 0.5, 'Nb': 2.0, 'O': 9.0}, all_comps[0].composition)
+        self.assertIsNone(all_comps[1])
+        # undeclared variables other than x, y, z
+        self.assertIsNone(to_GeneralMat_obj({'amount': '1.0', 'elements': {'Li': '1+q', 'O': '1'}}))
+
+    def test_warm_start(self):
+        comp = CompositionInHouse('Y1Fe10O15')
+        els, el_amt, all_oxids = comp.get_oxid_state_guess_essentials(all_metal_oxi_states=True)
+        # hint from Y0.1Fe2O3
+        counts = CompositionInHouse.get_initial_counts(
+            els, all_oxids, el_amt, {'Y': 3.0, 'Fe': 2.85, 'O': -2.0}
+        )
+        self.assertEqual(0, sum(state * n for (el, state), n in counts.items()))
+        for el in els:
+            self.assertEqual(el_amt[el], sum(n for (e, _), n in counts.items() if e == el))
+        self.assertEqual(
+            CompositionInHouse.get_most_possible_solution(els, all_oxids, el_amt),
+            CompositionInHouse.get_most_possible_solution(
+                els, all_oxids, el_amt, initial_solution={'Y': 3.0, 'Fe': 2.85, 'O': -2.0}
+            ),
+        )
+
+        valence_cache = ValenceCache()
+        valence_cache.add('a', {'Y': 0.1, 'Fe': 2.0, 'O': 3.0}, {'Y': 3.0, 'Fe': 2.85, 'O': -2.0})
+        valence_cache.add('b', {'Y': 0.5, 'Fe': 2.0, 'O': 3.0}, {'Y': 3.0, 'Fe': 2.25, 'O': -2.0})
+        self.assertEqual(2.85, valence_cache.get_nearest({'Y': 0.2, 'Fe': 2.0, 'O': 3.0})['Fe'])
+        self.assertIsNone(valence_cache.get_nearest({'Y': 0.2, 'Co': 2.0, 'O': 3.0}))
+        mat_obj = to_GeneralMat_obj(
+            {'amount': '1.0', 'elements': {'Y': 'x', 'Fe': '2', 'O': '3'}},
+            amounts_vars={'x': {'values': [0.1, 0.2, 0.3]}}
+        )
+        self.assertEqual(get_material_valence(mat_obj), get_material_valence(mat_obj, valence_cache=ValenceCache()))
+
+    def test_compact_result(self):
+        for composition in [
+            'LiFePO4',
+            'FeNi',
+            'SrFeO3',
+            {'Nb': 0.333, 'Na': 2.0, 'Cr': 1.333, 'P': 3.0, 'O': 12.0},
+        ]:
+            output = CompositionInHouse.get_most_possible_oxi_state_of_composition(
+                composition,
+                return_details=True,
+                snap_max_denominator=12,
+            )
+            result = OxiStateResult(*output)
+            self.assertEqual(output, result.to_tuple(return_details=True))
+            self.assertEqual(output[:3], result.to_tuple())
+            self.assertFalse(hasattr(result, '__dict__'))
+        # element symbols are shared and common comments are stored as codes
+        result = OxiStateResult(*CompositionInHouse.get_most_possible_oxi_state_of_composition('SrFeO3'))
+        self.assertIs(result.elements, OxiStateResult([{'Sr': 2.0, 'Fe': 4.0, 'O': -2.0}], True, []).elements)
+        self.assertIsNone(result.other_comments)
+        self.assertEqual(
+            {'valence': None, 'is_usual': False, 'comments': []},
+            OxiStateResult([], False, []).to_dict()
+        )
+        with self.assertRaises(ValueError):
+            OxiStateResult([{'Fe': 2.0}, {'Fe': 3.0}], True, [])
+
+        valence_cache = ValenceCache({'Fe2O3': {'Fe': 3.0, 'O': -2.0}})
+        valence_cache.add('SrFeO3', {'Sr': 1.0, 'Fe': 1.0, 'O': 3.0}, result)
+        self.assertEqual({'Sr': 2.0, 'Fe': 4.0, 'O': -2.0}, valence_cache['SrFeO3'])
+        self.assertEqual(result.comments, valence_cache.get_result('SrFeO3').comments)
+        self.assertEqual({'Fe': 3.0, 'O': -2.0}, valence_cache.get('Fe2O3'))
+        self.assertEqual(
+            {'Fe2O3': {'Fe': 3.0, 'O': -2.0}, 'SrFeO3': {'Sr': 2.0, 'Fe': 4.0, 'O': -2.0}},
+            valence_cache.to_dict()
+        )
+        self.assertEqual(valence_cache.to_dict(), copy.deepcopy(valence_cache).to_dict())
+
+        # equal results hash the same and states out of the byte range are rejected
+        output = CompositionInHouse.get_most_possible_oxi_state_of_composition('SrFeO3', return_details=True)
+        self.assertEqual(1, len({OxiStateResult(*output), OxiStateResult(*output)}))
+        for state in [2.5, 200]:
+            with self.assertRaises(ValueError):
+                OxiStateResult([{'Fe': 2.0}], True, [], [{('Fe', state): 1.0}])
+        # dict views, json and pickle keep the valence and the chemsys index
+        self.assertIsInstance(valence_cache.items(), collections.abc.ItemsView)
+        self.assertIn({'Fe': 3.0, 'O': -2.0}, valence_cache.values())
+        self.assertEqual(valence_cache.to_dict(), json.loads(json.dumps(valence_cache)))
+        copied = pickle.loads(pickle.dumps(valence_cache))
+        self.assertEqual(valence_cache.to_dict(), copied.to_dict())
+        self.assertEqual(result.comments, copied.get_result('SrFeO3').comments)
+        self.assertEqual(4.0, copied.get_nearest({'Sr': 1.0, 'Fe': 1.0, 'O': 2.9})['Fe'])
+
+    def test_columnar_export(self):
+        results = [
+            (formula, CompositionInHouse.get_most_possible_oxi_state_of_composition(formula, return_details=True))
+            for formula in ['LiFePO4', 'SrFeO3', 'FeNi', 'Fe3O4']
+        ]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            all_rows = []
+            for file_name in ['valence.npy', 'valence.csv']:
+                path = os.path.join(tmp_dir, file_name)
+                with ValenceExporter(path, chunk_size=3) as exporter:
+                    for formula, result in results[:2]:
+                        exporter.add(formula, result)
+                # appended in a second run
+                with ValenceExporter(path) as exporter:
+                    for formula, result in results[2:]:
+                        exporter.add(formula, result)
+                rows = load_valence_rows(path)
+                self.assertEqual([0, 0, 0, 0, 1, 1, 1, 1, 2, 2, 3, 3], rows['composition_id'].tolist())
+                all_rows.append(rows)
+            rows_npy, rows_csv = all_rows
+            self.assertIsInstance(rows_npy, np.memmap)
+            for name in ['composition_id', 'element', 'amount', 'is_usual', 'comment_flags', 'ion_counts']:
+                self.assertTrue(np.array_equal(rows_npy[name], rows_csv[name]), name)
+
+            rows = rows_npy[rows_npy['composition_id'] == 0]
+            self.assertEqual([b'Li', b'Fe', b'P', b'O'], rows['element'].tolist())
+            self.assertEqual([1.0, 2.0, 5.0, -2.0], rows['valence'].tolist())
+            self.assertEqual(1.0, rows[1]['ion_counts'][OXI_STATES.index(2)])
+            rows = rows_npy[rows_npy['composition_id'] == 1]
+            # the compensator has no amount and the comment has code 2
+            self.assertEqual(b'X', rows[-1]['element'])
+            self.assertEqual(0.0, rows[-1]['amount'])
+            self.assertEqual(1 << 2, rows[0]['comment_flags'])
+            self.assertFalse(rows[0]['is_usual'])
+
+    def test_fast_formula(self):
+        compositions = [
+            'Fe2O3',
+            'Nb(PO4)3',
+            'K4[Fe(CN)6]',
+            'Y3N@C80',
+            'LiO',
+            'O0.25',
+            'Li1.2Mn0.54Ni0.13Co0.13O2',
+            {'Y': 1.0, 'Fe': 1.0, 'O': 3.0},
+            {'Na': 0.333, 'Nb': 0.667, 'O': 2},
+            {'Xe': 1, 'F': 2},
+            {'Ba': 1.0, 'Ti': 0.3, 'Fe': 11.2, 'Co': 0.3, 'O': 19.0},
+        ]
+        for composition in compositions:
+            el_amt = get_el_amt(composition)
+            comp = Composition(composition)
+            self.assertEqual(list(comp.get_el_amt_dict().items()), list(el_amt.items()))
+            formula, factor = comp.get_integer_formula_and_factor()
+            integer_el_amt, integer_factor = get_integer_el_amt(el_amt)
+            self.assertEqual(list(Composition(formula).get_el_amt_dict().items()), list(integer_el_amt.items()))
+            self.assertAlmostEqual(factor, integer_factor)
+        # left to pymatgen
+        self.assertIsNone(get_el_amt('Fe2+O'))
+        self.assertIsNone(get_el_amt({'Fe': -1.0}))
+        self.assertIsNone(get_el_amt(Composition('Fe2O3')))
+
+        # no pymatgen Composition is constructed for plain inputs
+        with mock.patch.object(CompositionInHouse, '__init__', side_effect=AssertionError):
+            oxi_state, _, _ = CompositionInHouse.get_most_possible_oxi_state_of_composition(
+                {'Y': 1.0, 'Fe': 1.0, 'O': 3.0}
+            )
+            self.assertEqual([{'Y': 3.0, 'Fe': 3.0, 'O': -2.0}], oxi_state)
+            oxi_state, _, _ = CompositionInHouse.get_most_possible_oxi_state_of_composition('Nb(PO4)3')
+            self.assertEqual(5.0, oxi_state[0]['P'])
+        self.assertEqual(
+            CompositionInHouse.get_most_possible_oxi_state_of_composition('Fe3O4'),
+            CompositionInHouse.get_most_possible_oxi_state_of_composition(Composition('Fe3O4')),
+        )
+        # symbols of dummy species are ordered as pymatgen does
+        el_amt = {'O': 4.0, 'Xa': 2.0}
+        formula, factor = Composition(el_amt).get_integer_formula_and_factor()
+        self.assertEqual(
+            (list(Composition(formula).get_el_amt_dict().items()), factor),
+            (list(get_integer_el_amt(el_amt)[0].items()), get_integer_el_amt(el_amt)[1]),
+        )
+
+    def test_annotate_reactions(self):
+        def get_reaction(target, target_vars, precursors, element_substitution):
+            return {
+                'reaction': {'element_substitution': element_substitution},
+                'target': {
+                    'composition': [{'amount': '1.0', 'elements': target}],
+                    'amounts_vars': target_vars,
+                },
+                'precursors': [
+                    {
+                        'composition': [{'amount': '1.0', 'elements': elements}],
+                        'amounts_vars': {},
+                    }
+                    for elements in precursors
+                ],
+            }
+
+        reactions = [
+            get_reaction(
+                {'Li': '1+x', 'Mn': '2-x', 'O': '4'},
+                {'x': {'values': [0.1, 0.2]}},
+                [{'Li': '2', 'C': '1', 'O': '3'}, {'Mn': '1', 'O': '2'}],
+                {},
+            ),
+            get_reaction(
+                {'RE': '1', 'Fe': '1', 'O': '3'},
+                {},
+                [{'RE': '2', 'O': '3'}, {'Fe': '2', 'O': '3'}],
+                {'RE': 'La'},
+            ),
+            get_reaction(
+                {'Li': '1', 'Mn': '2', 'O': '4'},
+                {},
+                [{'Li': '2', 'C': '1', 'O': '3'}, {'Mn': '1', 'O': '2'}, {'Ne': '1', 'Ar': '1'}],
+                {},
+            ),
+        ]
+        expected = copy.deepcopy(reactions)
+        valence_cache = {}
+        for reaction in expected:
+            for record, composition, amounts_vars in [
+                (reaction['target'], reaction['target']['composition'], reaction['target']['amounts_vars'])
+            ] + [
+                (tmp_comp, tmp_comp, tmp_pre['amounts_vars'])
+                for tmp_pre in reaction['precursors'] for tmp_comp in tmp_pre['composition']
+            ]:
+                tmp_mat_obj = to_GeneralMat_obj(
+                    composition=composition,
+                    amounts_vars=amounts_vars,
+                    elements_vars=reaction['reaction']['element_substitution']
+                )
+                record['valence'] = get_material_valence(tmp_mat_obj, valence_cache=valence_cache)
+
+        metrics.reset()
+        batch_valence_cache = ValenceCache()
+        counter = annotate_reactions(reactions, valence_cache=batch_valence_cache, max_workers=4)
+        self.assertEqual(expected, reactions)
+        self.assertEqual(valence_cache, batch_valence_cache.to_dict())
+        # each composition is solved once, including NeAr without solution
+        self.assertEqual(len(valence_cache) + 1, counter['compositions solved'])
+        self.assertEqual(counter['compositions solved'], metrics.get_counter('valence_solver_cache_requests', result='miss'))
+        self.assertEqual(1, counter['valence not solved'])
+
+        reaction = annotate_reaction(copy.deepcopy(expected[1]), valence_cache=batch_valence_cache)
+        self.assertEqual(expected[1], reaction)
+
+    def test_solutions_by_charge(self):
+        for formula, min_charge, max_charge, add_compensator in [
+            ('PO4', -5, 0, False),
+            ('Fe3O4', -3, 3, False),
+            ('CN', -2, 1, False),
+            ('LiFePO4', -1, 1, False),
+            ('SrFeO3', -1, 1, True),
+        ]:
+            comp = CompositionInHouse(formula)
+            els, el_amt, all_oxids = comp.get_oxid_state_guess_essentials(add_compensator=add_compensator)
+            solutions = CompositionInHouse.get_most_possible_solutions_by_charge(
+                els, all_oxids, el_amt, min_charge, max_charge, add_compensator=add_compensator
+            )
+            for charge in range(min_charge, max_charge + 1):
+                solution, score, valence_detail = CompositionInHouse.get_most_possible_solution(
+                    els, all_oxids, el_amt, add_compensator=add_compensator, target_charge=charge
+                )
+                if not solution:
+                    self.assertNotIn(charge, solutions, formula)
+                    continue
+                dp_solution, dp_score, dp_detail = solutions[charge]
+                self.assertEqual(score, dp_score, formula)
+                self.assertEqual(charge, sum(state * n for (el, state), n in dp_detail.items()))
+                for el in els:
+                    self.assertEqual(el_amt[el], sum(n for (e, _), n in dp_detail.items() if e == el))
+
+        results = CompositionInHouse('PO4').oxi_state_guesses_by_charge(-5, 0)
+        self.assertEqual([-5, -4, -3], sorted(results))
+        self.assertEqual({'P': 5.0, 'O': -2.0}, results[-3][0])
+
+    def test_cli(self):
+        lines = [
+            'Fe2O3\n',
+            '"LiFePO4"\n',
+            '{"Fe": 3, "O": 4}\n',
+            '{"id": 7, "composition": "SrFeO3"}\n',
+            '\n',
+            'FeO1.5\n',
+            'Xyz\n',
+        ]
+        output = io.StringIO()
+        cache = {}
+        counter = solve_lines(lines, output, cache=cache)
+        results = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(6, len(results))
+        self.assertEqual({'Fe': 3.0, 'O': -2.0}, results[0]['oxi_state'])
+        self.assertEqual({'Fe': 3, 'O': 4}, results[2]['input'])
+        self.assertEqual(7, results[3]['id'])
+        self.assertFalse(results[3]['is_usual'])
+        self.assertIn('error', results[5])
+        # FeO1.5 has the same integer formula as Fe2O3
+        self.assertEqual(1, counter['cached'])
+        self.assertEqual(1, counter['error'])
+        self.assertEqual(4, len(cache))
+
+        output = io.StringIO()
+        counter = solve_lines(lines, output, workers=2, cache=cache, ordered=False)
+        self.assertEqual(
+            sorted(map(json.dumps, results)),
+            sorted(json.dumps(json.loads(line)) for line in output.getvalue().splitlines()),
+        )
+        self.assertEqual(5, counter['cached'])
+
+        # the cache keeps the most recently used compositions only
+        cache = collections.OrderedDict()
+        counter = solve_lines(lines, io.StringIO(), cache=cache, cache_size=2)
+        self.assertEqual(2, len(cache))
+        self.assertEqual(0, counter['cached'])
+
+    def test_material_cache(self):
+        composition = [{'amount': '1.0', 'elements': {'Li': '1+x', 'Mn': '2-x', 'O': '4'}, 'formula': 'a'}]
+        amounts_vars = {'x': {'values': [0.1, 0.2]}}
+        key = get_material_key(composition, amounts_vars)
+        reordered = [{'formula': 'b', 'elements': {'O': '4', 'Mn': '2-x', 'Li': '1+x'}}]
+        self.assertEqual(key, get_material_key(reordered, amounts_vars))
+        self.assertNotEqual(key, get_material_key(composition, {'x': {'values': [0.1]}}))
+        self.assertNotEqual(key, get_material_key(composition, amounts_vars, {'Li': 'Na'}))
+
+        expected = get_material_valence(to_GeneralMat_obj(composition, amounts_vars))
+        material_cache = MaterialValenceCache(max_size=2)
+        self.assertEqual(expected, material_cache.get_material_valence(composition, amounts_vars))
+        with mock.patch('ValenceSolver.core.material_cache.to_GeneralMat_obj') as to_mat_obj:
+            valence = material_cache.get_material_valence(reordered, amounts_vars)
+            to_mat_obj.assert_not_called()
+        self.assertEqual(expected, valence)
+        # the returned valence is a copy
+        valence[0]['valence']['Li'] = 0.0
+        self.assertEqual(expected, material_cache.get(key))
+
+        # least recently used materials are evicted
+        material_cache.get_material_valence({'elements': {'Fe': '2', 'O': '3'}})
+        material_cache.get(key)
+        material_cache.get_material_valence({'elements': {'Ne': '1', 'Ar': '1'}})
+        self.assertEqual(2, len(material_cache))
+        self.assertIn(key, material_cache)
+        self.assertNotIn(get_material_key({'elements': {'Fe': '2', 'O': '3'}}), material_cache)
+        self.assertIsNone(material_cache.get_material_valence({'elements': {'Ne': '1', 'Ar': '1'}}))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'material_cache.json')
+            material_cache.save(path)
+            loaded = MaterialValenceCache(max_size=2, path=path)
+            self.assertEqual(expected, loaded.get(key))
+            self.assertEqual(2, len(loaded))
+
+        # repeated materials in a batch of reactions are parsed once
+        reactions = [
+            {
+                'reaction': {'element_substitution': {}},
+                'target': {'composition': composition, 'amounts_vars': amounts_vars},
+                'precursors': [
+                    {'composition': [{'amount': '1.0', 'elements': {'Mn': '1', 'O': '2'}}], 'amounts_vars': {}},
+                ],
+            }
+            for _ in range(3)
+        ]
+        expected_reactions = copy.deepcopy(reactions)
+        annotate_reactions(expected_reactions)
+        material_cache = MaterialValenceCache()
+        counter = annotate_reactions(reactions, material_cache=material_cache)
+        self.assertEqual(expected_reactions, reactions)
+        self.assertEqual(4, counter['materials cached'])
+        self.assertEqual(2, len(material_cache))
+        reactions[0]['target']['valence'][0]['valence']['Li'] = 0.0
+        self.assertEqual(expected_reactions[1], reactions[1])
+
+    def test_slow_log(self):
+        material = to_GeneralMat_obj(
+            [{'amount': '1.0', 'elements': {'Sr': '1', 'Fe': '1-x', 'Co': 'x', 'O': '3'}}],
+            {'x': {'values': [0.5]}},
+        )
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch.object(CompositionInHouse, 'precomputed_index_path', False):
+            path = os.path.join(tmp_dir, 'slow_calls.jsonl')
+            slow_log.enable(path, threshold=0.0)
+            try:
+                CompositionInHouse.get_most_possible_oxi_state_of_composition('SrFeO3')
+                valence = get_material_valence(material)
+            finally:
+                slow_log.disable()
+            # not logged when disabled
+            CompositionInHouse.get_most_possible_oxi_state_of_composition('Fe2O3')
+            calls = slow_log.load_slow_calls(path)
+
+        self.assertEqual(['oxi_state_guesses_most_possible', 'get_material_valence'], [c['function'] for c in calls])
+        call = calls[0]
+        self.assertEqual({'Sr': 1.0, 'Fe': 1.0, 'O': 3.0}, call['input'])
+        self.assertEqual(['default', 'compensator'], [s['stage'] for s in call['stages']])
+        self.assertEqual(['default', 'compensator'], [m['stage'] for m in call['models']])
+        self.assertEqual(['Sr', 'Fe', 'O', 'X'], call['models'][1]['all_els'])
+        self.assertTrue(call['models'][1]['add_compensator'])
+        output, _ = slow_log.replay_call(call)
+        self.assertEqual(call['output'], json.loads(json.dumps(output)))
+        (solution, _, _), _ = slow_log.replay_model(call['models'][1])
+        self.assertEqual(call['output'][0][0], {el: v for el, v in solution.items() if el != 'X'})
+
+        # the solve of each composition of a material is a stage, nested calls are not logged again
+        call = calls[1]
+        self.assertEqual(valence, call['output'])
+        self.assertEqual({'x': [0.5]}, call['input']['fraction_vars'])
+        self.assertTrue(all(s['stage'].startswith('Sr1.0 ') for s in call['stages']))
+        self.assertEqual(valence, slow_log.replay_call(call)[0])
+
+    def test_slow_log_write_error(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch.object(CompositionInHouse, 'precomputed_index_path', False), \
+                mock.patch('sys.stderr', new_callable=io.StringIO) as stderr:
+            # a directory cannot be opened for appending
+            slow_log.enable(tmp_dir, threshold=0.0)
+            try:
+                cal_valence, _, _ = CompositionInHouse.get_most_possible_oxi_state_of_composition('SrFeO3')
+                with mock.patch.object(CompositionInHouse, 'get_most_possible_solution',
+                                       side_effect=ZeroDivisionError('original')):
+                    with self.assertRaises(ZeroDivisionError):
+                        CompositionInHouse('SrFeO3').oxi_state_guesses_most_possible()
+            finally:
+                slow_log.disable()
+        self.assertEqual({'Sr': 2.0, 'Fe': 4.0, 'O': -2.0}, cal_valence[0])
+        self.assertEqual(2, stderr.getvalue().count('failed to write the slow call log'))
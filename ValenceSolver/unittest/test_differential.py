@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+import os
+import random
+import time
+import unittest
+from collections import defaultdict
+
+from pymatgen.core import Composition
+
+from ValenceSolver.core.composition_inhouse import CompositionInHouse
+
+__author__ = 'Tanjin He'
+__maintainer__ = 'Tanjin He'
+__email__ = 'tanjin_he@berkeley.edu'
+
+
+"""
+Differential tests of the fast solver paths. Random compositions are generated
+from realistic element pools and every engine is compared with the linear programming
+in get_most_possible_solution (CBC), the reference. Where the scoring is the same,
+oxi_state_guesses in pymatgen is compared as well. A failing composition is shrunk
+to a minimal formula before it is reported.
+
+Set VALENCE_DIFF_SEED and VALENCE_DIFF_CASES to reproduce or extend a run, and run
+with -s to see the speedup of each engine.
+"""
+
+SEED = int(os.environ.get('VALENCE_DIFF_SEED', 0))
+NUM_CASES = int(os.environ.get('VALENCE_DIFF_CASES', 30))
+CATIONS = [
+    'Li', 'Na', 'K', 'Mg', 'Ca', 'Sr', 'Ba', 'Al', 'Ti', 'V', 'Cr', 'Mn',
+    'Fe', 'Co', 'Ni', 'Cu', 'Zn', 'Nb', 'Mo', 'La', 'Ce', 'Sn',
+]
+ANIONS = ['O', 'F', 'S', 'Cl', 'N', 'Se']
+DECIMALS = [0.1, 0.2, 0.25, 0.3, 0.5, 0.75]
+# engines enumerating the sums of each element are only run for small amounts
+MAX_ENUMERATED_AMOUNT = 6
+EPS = 1e-6
+
+
+def random_composition(rng, decimal=False):
+    """
+    :param rng: random.Random
+    :param decimal: bool. use decimal amounts for cations or not
+    :return: dict of {el: amount}
+    """
+    el_amt = {}
+    for el in rng.sample(CATIONS, rng.randint(1, 3)):
+        if decimal and rng.random() < 0.7:
+            el_amt[el] = rng.randint(0, 1) + rng.choice(DECIMALS)
+        else:
+            el_amt[el] = rng.randint(1, 3)
+    for el in rng.sample(ANIONS, rng.randint(1, 2 if len(el_amt) < 3 else 1)):
+        el_amt[el] = rng.randint(1, 6)
+    return el_amt
+
+
+def to_formula(el_amt):
+    return ''.join('{}{}'.format(el, amt) for el, amt in el_amt.items())
+
+
+def get_smaller_compositions(el_amt):
+    """
+    candidates for shrinking: drop one element, turn a decimal amount into an integer,
+    or decrease an amount
+    """
+    if len(el_amt) > 2:
+        for el in el_amt:
+            yield {e: amt for e, amt in el_amt.items() if e != el}
+    for el, amt in el_amt.items():
+        if amt != int(amt):
+            yield dict(el_amt, **{el: max(int(amt), 1)})
+    for el, amt in el_amt.items():
+        if amt == int(amt) and amt > 1:
+            yield dict(el_amt, **{el: amt - 1})
+
+
+def shrink(el_amt, check):
+    """
+    greedily shrink a failing composition until no smaller candidate fails
+
+    :param el_amt: dict of {el: amount}. a composition that fails
+    :param check: function returning an error message or None
+    :return: (el_amt, error message) of the minimal composition
+    """
+    error = check(el_amt)
+    shrunk = True
+    while shrunk:
+        shrunk = False
+        for smaller in get_smaller_compositions(el_amt):
+            smaller_error = check(smaller)
+            if smaller_error:
+                el_amt, error = smaller, smaller_error
+                shrunk = True
+                break
+    return el_amt, error
+
+
+def is_charge_balanced(solution, el_amt, target_charge=0):
+    return abs(sum(v * el_amt[el] for el, v in solution.items()) - target_charge) < EPS
+
+
+def check_engines(el_amt, timings=None):
+    """
+    compare every engine with the linear programming on the plain stage of solving,
+    i.e. icsd oxidation states without compensator
+
+    :param el_amt: dict of {el: amount}
+    :param timings: dict of {engine: [seconds of engine, seconds of reference]}
+        updated in place
+    :return: error message or None
+    """
+    if timings is None:
+        timings = defaultdict(lambda: [0.0, 0.0])
+    formula, _ = CompositionInHouse(el_amt).get_integer_formula_and_factor()
+    comp = CompositionInHouse(formula)
+    els, int_amt, all_oxids = comp.get_oxid_state_guess_essentials()
+
+    start = time.perf_counter()
+    ref_sol, ref_score, _ = CompositionInHouse.get_most_possible_solution(els, all_oxids, int_amt)
+    ref_time = time.perf_counter() - start
+
+    def run(engine, func):
+        start = time.perf_counter()
+        result = func()
+        timings[engine][0] += time.perf_counter() - start
+        timings[engine][1] += ref_time
+        return result
+
+    greedy_sol, greedy_score, _ = run('greedy', lambda: CompositionInHouse.get_greedy_solution(
+        els, all_oxids, int_amt
+    ))
+    if greedy_sol and (greedy_sol != ref_sol or abs(greedy_score - ref_score) > EPS):
+        return 'greedy {} ({}) != cbc {} ({})'.format(greedy_sol, greedy_score, ref_sol, ref_score)
+
+    k_best = run('k-best', lambda: CompositionInHouse.get_k_most_possible_solutions(
+        els, all_oxids, int_amt, k=3
+    ))
+    if bool(k_best) != bool(ref_sol):
+        return 'k-best found {} solutions, cbc found {}'.format(len(k_best), ref_sol)
+    if k_best and abs(k_best[0][1] - ref_score) > EPS:
+        return 'k-best score {} != cbc score {}'.format(k_best[0][1], ref_score)
+    for i, (sol, score, _) in enumerate(k_best):
+        if not is_charge_balanced(sol, int_amt):
+            return 'k-best solution {} is not charge balanced'.format(sol)
+        if i > 0 and score > k_best[i-1][1] + EPS:
+            return 'k-best scores are not sorted: {}'.format([s[1] for s in k_best])
+
+    marginals = run('marginals', lambda: comp.get_oxi_state_marginals())
+    if marginals and not ref_sol:
+        return 'marginals found but cbc has no solution'
+    if marginals:
+        for el, probs in marginals.items():
+            if abs(sum(probs.values()) - 1) > EPS:
+                return 'marginals of {} sum to {}'.format(el, sum(probs.values()))
+        expected = {el: sum(s * p for s, p in probs.items()) for el, probs in marginals.items()}
+        if not is_charge_balanced(expected, int_amt):
+            return 'expected charge of marginals {} is not balanced'.format(expected)
+
+    if max(int_amt.values()) > MAX_ENUMERATED_AMOUNT:
+        return None
+    # the scores of sums are clipped at 0 in oxi_state_guesses (same as pymatgen),
+    # so the scores are only the same as cbc when all ions are observed in ICSD
+    all_observed = all(
+        CompositionInHouse.get_oxi_state_score(el, tmp_state) > 0
+        for el in els for tmp_state in all_oxids[el]
+    )
+    lazy = run('lazy', lambda: list(comp.iter_oxi_state_guesses(max_solutions=1, return_scores=True)))
+    if bool(lazy) != bool(ref_sol):
+        return 'lazy found {}, cbc found {}'.format(lazy, ref_sol)
+    if lazy and lazy[0][1] < ref_score - EPS:
+        return 'lazy score {} < cbc score {}'.format(lazy[0][1], ref_score)
+    if lazy and all_observed and abs(lazy[0][1] - ref_score) > EPS:
+        return 'lazy score {} != cbc score {}'.format(lazy[0][1], ref_score)
+
+    if not all_observed:
+        return None
+    pmg_guesses = run('pymatgen', lambda: Composition(formula).oxi_state_guesses())
+    if bool(pmg_guesses) != bool(ref_sol):
+        return 'pymatgen found {}, cbc found {}'.format(pmg_guesses[:1], ref_sol)
+    if pmg_guesses:
+        # ties might be ordered differently, so the scores are compared
+        pmg_score = sum(
+            CompositionInHouse.get_oxi_state_score(el, tmp_state)
+            for el, states in pymatgen_best_combo(formula).items() for tmp_state in states
+        )
+        if abs(pmg_score - ref_score) > EPS:
+            return 'pymatgen score {} != cbc score {}'.format(pmg_score, ref_score)
+    return None
+
+
+def pymatgen_best_combo(formula):
+    """
+    :return: dict of {el: (state1, state2, ...)}. the oxidation state of each ion in the
+        best guess of pymatgen
+    """
+    _, all_oxid_combo = Composition(formula)._get_oxi_state_guesses(False, None, {}, 0)
+    return all_oxid_combo[0]
+
+
+class DifferentialTest(unittest.TestCase):
+
+    def setUp(self):
+        # loads the probability table
+        CompositionInHouse('O')
+
+    def check_random_compositions(self, decimal):
+        rng = random.Random(SEED + int(decimal))
+        timings = defaultdict(lambda: [0.0, 0.0])
+        for _ in range(NUM_CASES):
+            el_amt = random_composition(rng, decimal=decimal)
+            if check_engines(el_amt, timings):
+                el_amt, error = shrink(el_amt, check_engines)
+                self.fail('{} (seed {}): {}'.format(to_formula(el_amt), SEED, error))
+        print()
+        for engine, (engine_time, ref_time) in sorted(timings.items()):
+            print('{}: {:.3f}s, cbc: {:.3f}s, speedup {:.1f}x'.format(
+                engine, engine_time, ref_time, ref_time / max(engine_time, 1e-9)
+            ))
+
+    def test_integer_compositions(self):
+        self.check_random_compositions(decimal=False)
+
+    def test_decimal_compositions(self):
+        self.check_random_compositions(decimal=True)
+
+    def test_shrink(self):
+        def check(el_amt):
+            if el_amt.get('Fe', 0) >= 2 and 'O' in el_amt:
+                return 'too much Fe'
+            return None
+        el_amt, error = shrink({'Li': 1.5, 'Fe': 3, 'Mn': 0.5, 'O': 4}, check)
+        self.assertEqual({'Fe': 2, 'O': 1}, el_amt)
+        self.assertEqual('too much Fe', error)
+
+
+if __name__ == '__main__':
+    unittest.main()
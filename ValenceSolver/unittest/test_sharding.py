@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from ValenceSolver.core.sharding import get_shard, merge_shards, get_shard_paths
+from ValenceSolver.core.utils import to_GeneralMat_obj, get_material_valence
+
+__author__ = 'Tanjin He'
+__maintainer__ = 'Tanjin He'
+__email__ = 'tanjin_he@berkeley.edu'
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class ShardingTest(unittest.TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.materials = [
+            {'composition': {'amount': '1.0', 'elements': {'Fe': '2', 'O': '3'}}},
+            {'composition': {'amount': '1.0', 'elements': {'Li': '1', 'Fe': '1', 'P': '1', 'O': '4'}}},
+            {
+                'composition': {'amount': '1.0', 'elements': {'Li': '1+x', 'Mn': '2-x', 'O': '4'}},
+                'amounts_vars': {'x': {'values': [0.1, 0.2]}},
+            },
+            {'composition': {'amount': '1.0', 'elements': {'Sr': '1', 'Fe': '1', 'O': '3'}}},
+            {
+                'composition': {'amount': '1.0', 'elements': {'RE': '1', 'Co': '1', 'O': '3'}},
+                'elements_vars': {'RE': 'La'},
+            },
+            {'composition': {'amount': '1.0', 'elements': {'Ba': '1', 'C': '1', 'O': '3'}}},
+            {'composition': {'amount': '1.0', 'elements': {'Fe': '2', 'O': '3'}, 'formula': 'Fe2O3'}},
+            {'composition': {'amount': '1.0', 'elements': {'Cu': '1', 'O': '1'}}},
+        ]
+
+    def test_stable_shard(self):
+        # identical materials are in the same shard
+        self.assertEqual(get_shard(self.materials[0], 3), get_shard(self.materials[6], 3))
+        # the hash does not depend on the python process
+        script = (
+            'import json, sys\n'
+            'from ValenceSolver.core.sharding import get_shard\n'
+            'print(get_shard(json.loads(sys.argv[1]), 7))\n'
+        )
+        output = subprocess.check_output(
+            [sys.executable, '-c', script, json.dumps(self.materials[2])],
+            cwd=ROOT_DIR,
+        )
+        self.assertEqual(get_shard(self.materials[2], 7), int(output))
+
+    def test_sharded_annotation(self):
+        num_shards = 3
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_path = os.path.join(tmp_dir, 'materials.json')
+            output_dir = os.path.join(tmp_dir, 'shards')
+            with open(input_path, 'w') as fw:
+                json.dump(self.materials, fw)
+            # each node is a process coordinating with others only through files
+            nodes = [
+                subprocess.Popen(
+                    [
+                        sys.executable, '-m', 'ValenceSolver.core.sharding', 'annotate',
+                        '--input', input_path,
+                        '--output-dir', output_dir,
+                        '--shard', str(shard),
+                        '--num-shards', str(num_shards),
+                    ],
+                    cwd=ROOT_DIR,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                )
+                for shard in range(num_shards)
+            ]
+            for node in nodes:
+                self.assertEqual(0, node.wait())
+
+            output_path = os.path.join(tmp_dir, 'annotated.json')
+            materials, valence_cache = merge_shards(input_path, output_dir, num_shards, output_path=output_path)
+            with open(output_path, 'rb') as fr:
+                merged_output = fr.read()
+            merge_shards(input_path, output_dir, num_shards, output_path=output_path)
+            with open(output_path, 'rb') as fr:
+                self.assertEqual(merged_output, fr.read())
+
+            valence_cache_single = {}
+            for material in materials:
+                tmp_mat_obj = to_GeneralMat_obj(
+                    composition=material['composition'],
+                    amounts_vars=material.get('amounts_vars'),
+                    elements_vars=material.get('elements_vars')
+                )
+                valence = get_material_valence(tmp_mat_obj, valence_cache=valence_cache_single)
+                self.assertEqual(json.loads(json.dumps(valence)), material['valence'])
+            self.assertEqual(set(valence_cache_single), set(valence_cache))
+
+            os.remove(get_shard_paths(output_dir, 1, num_shards)[0])
+            with self.assertRaises(ValueError):
+                merge_shards(input_path, output_dir, num_shards)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from ValenceSolver.core import metrics
+from ValenceSolver.core.composition_inhouse import CompositionInHouse
+from ValenceSolver.core.utils import to_GeneralMat_obj, get_material_valence
+
+__author__ = 'Tanjin He'
+__maintainer__ = 'Tanjin He'
+__email__ = 'tanjin_he@berkeley.edu'
+
+
+"""
+Budget of solver work for a fixed corpus of formulas. The number of problems solved
+by CBC is deterministic, unlike timing, so a change multiplying the solver work fails
+here. Raise a budget only when more solves are expected.
+"""
+
+# formula: (max number of solves of get_most_possible_solution,
+#           max number of variables of each model)
+# 0 solves means the greedy path is expected to find the solution
+BUDGETS = [
+    ('Li2CO3', 0, 0),
+    ('YFeO3', 0, 0),
+    ('BaTiO3', 0, 0),
+    ('Li4Ti5O12', 0, 0),
+    ('Ca3(PO4)2', 0, 0),
+    ('Fe3O4', 1, 5),
+    ('CuO', 1, 5),
+    ('Y0.1Fe2O3', 1, 5),
+    ('LiFePO4', 1, 10),
+    ('LiCoO2', 1, 10),
+    ('LiMn2O4', 1, 10),
+    ('LiNO3', 1, 10),
+    ('KMnO4', 1, 10),
+    ({'Cr': 1.9, 'Mn': 0.1, 'Al': 1.0}, 1, 10),
+    ({'Ba': 1.0, 'Ti': 0.3, 'Fe': 11.2, 'Co': 0.3, 'O': 19.0}, 1, 20),
+    # relaxation with compensator
+    ('SrFeO3', 2, 20),
+    ({'Sr': 0.7, 'La': 0.3, 'Fe': 1.0, 'O': 3.0}, 2, 20),
+    ('Na2O2', 2, 5),
+    ({'Y': 2.0, 'Ba': 1.0, 'Cu': 1.0, 'O': 45.0}, 2, 20),
+    # relaxation with doubled amount
+    ('Nb(PO4)3', 3, 20),
+]
+
+
+def get_max_observed(name, **labels):
+    """
+    :return: the smallest bucket bound covering all observations of a histogram, 0 if none
+    """
+    histogram = metrics.get_histogram(name, **labels)
+    if histogram is None:
+        return 0
+    return min(bound for bound, count in histogram['buckets'].items() if count == histogram['count'])
+
+
+class SolverBudgetTest(unittest.TestCase):
+
+    def setUp(self):
+        # the precomputed index would answer without solving
+        self.default_index_path = CompositionInHouse.precomputed_index_path
+        CompositionInHouse.precomputed_index_path = False
+        metrics.reset()
+
+    def tearDown(self):
+        CompositionInHouse.precomputed_index_path = self.default_index_path
+
+    def test_most_possible_solution_budget(self):
+        for formula, max_solves, max_variables in BUDGETS:
+            metrics.reset()
+            CompositionInHouse.get_most_possible_oxi_state_of_composition(formula)
+            num_solves = metrics.get_counter('valence_solver_solver_calls', solver='get_most_possible_solution')
+            self.assertLessEqual(num_solves, max_solves, formula)
+            self.assertLessEqual(
+                get_max_observed('valence_solver_model_variables', solver='get_most_possible_solution'),
+                max_variables,
+                formula
+            )
+            self.assertEqual(0, metrics.get_counter('valence_solver_solver_calls', solver='get_possible_sums'))
+            self.assertEqual(0, metrics.get_counter(
+                'valence_solver_solver_calls', solver='get_k_most_possible_solutions'
+            ))
+
+    def test_possible_sums_budget(self):
+        for formula in ['Fe3O4', 'LiMn2O4', 'SrFeO3', 'LiFePO4']:
+            metrics.reset()
+            comp = CompositionInHouse(formula)
+            comp.oxi_state_guesses()
+            els, el_amt, all_oxids = comp.get_oxid_state_guess_essentials()
+            # one solve for each possible sum of each element
+            max_solves = sum(
+                (max(all_oxids[el]) - min(all_oxids[el])) * int(el_amt[el]) + 1 for el in els
+            )
+            self.assertLessEqual(
+                metrics.get_counter('valence_solver_solver_calls', solver='get_possible_sums'),
+                max_solves,
+                formula
+            )
+
+    def test_k_most_possible_solutions_budget(self):
+        comp = CompositionInHouse('Fe3O4')
+        comp._oxi_state_guesses_most_possible(k=3)
+        # one solve for each solution and one more to prove no more solutions exist
+        self.assertLessEqual(
+            metrics.get_counter('valence_solver_solver_calls', solver='get_k_most_possible_solutions'),
+            4
+        )
+
+    def test_cache_miss_budget(self):
+        valence_cache = {}
+        for values in [[0.1, 0.2], [0.2, 0.3], [0.1, 0.3]]:
+            mat_obj = to_GeneralMat_obj(
+                {'amount': '1.0', 'elements': {'Y': 'x', 'Fe': '2', 'O': '3'}},
+                amounts_vars={'x': {'values': values}}
+            )
+            get_material_valence(mat_obj, valence_cache=valence_cache)
+        # 3 distinct compositions in 6 lookups
+        self.assertEqual(3, metrics.get_counter('valence_solver_cache_requests', result='miss'))
+        self.assertEqual(3, metrics.get_counter('valence_solver_cache_requests', result='hit'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from pymatgen.core import Composition
+
+from ValenceSolver.core.composition_inhouse import CompositionInHouse
+from ValenceSolver.core.utils import get_most_possible_oxi_states_in_threads
+from ValenceSolver.core.utils import get_material_valences_in_processes
+from ValenceSolver.core.shared_cache import SharedValenceCache
+
+__author__ = 'Tanjin He'
+__maintainer__ = 'Tanjin He'
+__email__ = 'tanjin_he@berkeley.edu'
+
+_valence_cache = None
+
+
+def _init_worker(valence_cache):
+    global _valence_cache
+    _valence_cache = valence_cache
+
+
+def _solve_with_cache(formula):
+    if formula in _valence_cache:
+        return _valence_cache[formula], True
+    oxi_state, _, _ = CompositionInHouse.get_most_possible_oxi_state_of_composition(formula)
+    _valence_cache[formula] = oxi_state[0]
+    return oxi_state[0], False
+
+
+class ThreadSafetyTest(unittest.TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.compositions = [
+            'Li2CO3',
+            'LiFePO4',
+            'YFeO3',
+            'SrFeO3',
+            'Fe3O4',
+            'Na2O2',
+            'Nb(PO4)3',
+            'Y0.1Fe2O3',
+            {'Sr': 0.7, 'La': 0.3, 'Fe': 1.0, 'O': 3.0},
+            {'Ba': 1.0, 'Ti': 0.3, 'Fe': 11.2, 'Co': 0.3, 'O': 19.0},
+            {'Cr': 1.9, 'Mn': 0.1, 'Al': 1.0},
+            {'Y': 2.0, 'Ba': 1.0, 'Cu': 1.0, 'O': 45.0},
+        ]
+
+    def test_concurrent_solving(self):
+        sequential = [
+            CompositionInHouse.get_most_possible_oxi_state_of_composition(comp, return_details=True)
+            for comp in self.compositions
+        ]
+        # the table of probabilities is loaded concurrently by the first threads
+        compositions = self.compositions * 8
+        with mock.patch.object(Composition, 'oxi_prob', None), \
+                ThreadPoolExecutor(max_workers=16) as executor:
+            concurrent = list(executor.map(
+                lambda comp: CompositionInHouse.get_most_possible_oxi_state_of_composition(
+                    comp, return_details=True
+                ),
+                compositions
+            ))
+        for i, result in enumerate(concurrent):
+            self.assertEqual(sequential[i % len(self.compositions)], result)
+
+    def test_batch_in_threads(self):
+        sequential = [
+            CompositionInHouse.get_most_possible_oxi_state_of_composition(comp)
+            for comp in self.compositions
+        ]
+        batch = get_most_possible_oxi_states_in_threads(self.compositions, max_workers=8)
+        self.assertEqual(sequential, batch)
+
+    def test_shared_valence_cache(self):
+        unique_formulas = ['Li2CO3', 'LiFePO4', 'YFeO3', 'SrFeO3', 'Fe3O4']
+        formulas = unique_formulas * 8
+        with SharedValenceCache(num_slots=64) as valence_cache:
+            with multiprocessing.Pool(
+                processes=4, initializer=_init_worker, initargs=(valence_cache, )
+            ) as pool:
+                first_results = pool.map(_solve_with_cache, unique_formulas, chunksize=1)
+                results = pool.map(_solve_with_cache, formulas, chunksize=1)
+                # the lock of the cache cannot be sent with tasks
+                with self.assertRaises(RuntimeError):
+                    pool.apply(len, (valence_cache, ))
+            self.assertEqual(5, len(valence_cache))
+            # the compositions solved by one worker are reused by the others
+            self.assertEqual(0, sum(hit for _, hit in first_results))
+            self.assertEqual(len(formulas), sum(hit for _, hit in results))
+            for formula, (oxi_state, _) in zip(formulas, results):
+                self.assertEqual(valence_cache[formula], oxi_state)
+            self.assertNotIn('NaCl', valence_cache)
+
+    def test_batch_in_processes(self):
+        materials = [
+            {'composition': {'amount': '1.0', 'elements': {'Fe': '2', 'O': '3'}}},
+        ] * 4
+        self.assertEqual(4, len(get_material_valences_in_processes(materials, processes=2)))
+
+
+if __name__ == '__main__':
+    unittest.main()
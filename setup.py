@@ -11,13 +11,19 @@ if __name__ == "__main__":
           author_email="tanjin_he@berkeley.edu",
           license="MIT License",
           packages=find_packages(),
-          package_data={'ValenceSolver': ['core/analysis/icsd_bv.yaml']},
+          package_data={'ValenceSolver': ['core/analysis/icsd_bv.yaml', 'core/analysis/*.bin']},
           install_requires=[
               "sympy",
               "unidecode",
               "pymatgen",
               "pulp",
+              "numpy",
           ],
+          entry_points={
+              'console_scripts': [
+                  'valence-solve = ValenceSolver.core.cli:main',
+              ],
+          },
           
           zip_safe=False)
 